@@ -0,0 +1,144 @@
+"""Time training iterations of the local WGAN-GP (critic step and generator
+step) on the 28x28, 32x32 and 64x64 architectures with separate critic passes
+over real images, fake images and interpolates, and with a fused pass over real
+and fake images and a separate pass over interpolates, as done by
+train_local_wgan_gp, e.g.:
+
+python3 -m benchmarks.benchmark_critic_step --batch_size 64 --n_iterations 20
+"""
+
+import argparse
+import sys
+import time
+
+import torch
+
+from gan_experiments import gan_utils, models_definition
+
+IMG_SHAPES = {28: (1, 28, 28), 32: (3, 32, 32), 64: (3, 64, 64)}
+
+
+def separate_iteration(generator, discriminator, real_imgs, z, task_ids, args):
+    discriminator.zero_grad()
+    fake_imgs = generator(z, task_ids).detach()
+    d_loss_real = -torch.mean(discriminator(real_imgs))
+    d_loss_fake = torch.mean(discriminator(fake_imgs))
+    gradient_penalty = gan_utils.compute_gradient_penalty(
+        discriminator, real_imgs, fake_imgs, real_imgs.device, task_ids=None
+    )
+    d_loss = d_loss_fake + d_loss_real + args.lambda_gp * gradient_penalty
+    d_loss.backward()
+
+    generator.zero_grad()
+    g_loss = -torch.mean(discriminator(generator(z, task_ids)))
+    g_loss.backward()
+    return d_loss, g_loss
+
+
+def fused_iteration(generator, discriminator, real_imgs, z, task_ids, args):
+    discriminator.zero_grad()
+    fake_imgs = generator(z, task_ids)
+    d_output_real, d_output_fake = discriminator(
+        torch.cat([real_imgs, fake_imgs.detach()])
+    ).split(len(real_imgs))
+    gradient_penalty = gan_utils.compute_gradient_penalty(
+        discriminator, real_imgs, fake_imgs.detach(), real_imgs.device, task_ids=None
+    )
+    d_loss = (
+        torch.mean(d_output_fake)
+        - torch.mean(d_output_real)
+        + args.lambda_gp * gradient_penalty
+    )
+    d_loss.backward()
+
+    # Output of the generator reused for its step
+    generator.zero_grad()
+    g_loss = -torch.mean(discriminator(fake_imgs))
+    g_loss.backward()
+    return d_loss, g_loss
+
+
+ITERATIONS = {
+    "separate": separate_iteration,
+    "fused": fused_iteration,
+}
+
+
+def time_iterations(iteration, generator, discriminator, real_imgs, z, task_ids, args):
+    # Same interpolation weights in all variants
+    torch.manual_seed(0)
+    iteration(generator, discriminator, real_imgs, z, task_ids, args)
+    if real_imgs.is_cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(args.n_iterations):
+        losses = iteration(generator, discriminator, real_imgs, z, task_ids, args)
+    if real_imgs.is_cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start) / args.n_iterations, torch.stack(losses).tolist()
+
+
+def run(args):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(0)
+    print(
+        f"{'Image size':<12} {'Variant':<12} {'Time [ms]':>10} {'Speedup':>8} "
+        f"{'Max loss diff':>14}"
+    )
+    for img_size in args.img_sizes:
+        img_shape = IMG_SHAPES[img_size]
+        translator = models_definition.Translator(
+            latent_size=args.latent_dim,
+            device=device,
+            num_embeddings=1,
+            embedding_dim=1,
+        ).to(device)
+        generator = models_definition.Generator(
+            latent_dim=args.latent_dim,
+            img_shape=img_shape,
+            device=device,
+            translator=translator,
+            num_features=args.g_n_features,
+        ).to(device)
+        discriminator = models_definition.Discriminator(
+            img_shape=img_shape,
+            device=device,
+            num_features=args.d_n_features,
+            num_embeddings=0,
+            embedding_dim=0,
+        ).to(device)
+        real_imgs = torch.rand(args.batch_size, *img_shape, device=device) * 2 - 1
+        z = torch.randn(args.batch_size, args.latent_dim, device=device)
+        task_ids = torch.zeros(args.batch_size, device=device)
+
+        # Without optimizer steps every iteration sees the same weights, so
+        # the losses of all variants should match
+        results = {
+            name: time_iterations(
+                iteration, generator, discriminator, real_imgs, z, task_ids, args
+            )
+            for name, iteration in ITERATIONS.items()
+        }
+        separate_time, separate_losses = results["separate"]
+        for name, (elapsed, losses) in results.items():
+            loss_diff = max(abs(a - b) for a, b in zip(separate_losses, losses))
+            print(
+                f"{img_size:<12} {name:<12} {elapsed * 1000:>10.1f} "
+                f"{separate_time / elapsed:>7.2f}x {loss_diff:>14.2e}"
+            )
+
+
+def get_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--img_sizes", nargs="+", type=int, default=[28, 32, 64])
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--n_iterations", type=int, default=20)
+    parser.add_argument("--latent_dim", type=int, default=100)
+    parser.add_argument("--g_n_features", type=int, default=32)
+    parser.add_argument("--d_n_features", type=int, default=32)
+    parser.add_argument("--lambda_gp", type=float, default=10)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    run(get_args(sys.argv[1:]))
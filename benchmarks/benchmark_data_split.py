@@ -0,0 +1,90 @@
+"""Time data_split on a synthetic dataset with millions of labels and up to
+hundreds of tasks, e.g.:
+
+python3 -m benchmarks.benchmark_data_split --num_examples 10000000 --num_batches 200
+"""
+
+import argparse
+import contextlib
+import io
+import sys
+import time
+
+import torch
+
+from continual_benchmark.dataloaders.datasetGen import data_split
+
+
+class SyntheticLabels(torch.utils.data.Dataset):
+    def __init__(self, labels):
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.labels)
+
+
+def time_split(labels, **kwargs):
+    dataset = SyntheticLabels(labels)
+    generator = torch.Generator().manual_seed(0)
+    start = time.time()
+    # Skip printing sizes of all splits
+    with contextlib.redirect_stdout(io.StringIO()):
+        train_splits, _, _ = data_split(dataset=dataset, generator=generator, **kwargs)
+    elapsed = time.time() - start
+    n_examples = sum(len(split) for split in train_splits.values())
+    return elapsed, n_examples
+
+
+def run(args):
+    torch.manual_seed(0)
+    labels = torch.randint(0, args.num_classes, [args.num_examples])
+    dirichlet = torch.distributions.Dirichlet(
+        torch.ones(args.num_batches) * args.dirichlet_alpha
+    ).sample([args.num_classes])
+
+    settings = {
+        f"classes, {args.num_batches} tasks": dict(
+            dataset_name="omniglot",
+            num_batches=args.num_batches,
+            num_classes=args.num_classes,
+        ),
+        f"random, {args.num_batches} tasks": dict(
+            dataset_name="mnist",
+            num_batches=args.num_batches,
+            num_classes=args.num_classes,
+            random_split=True,
+        ),
+        f"dirichlet, {args.num_batches} tasks": dict(
+            dataset_name="mnist",
+            num_batches=args.num_batches,
+            num_classes=args.num_classes,
+            dirichlet_split=dirichlet,
+        ),
+        f"random, limit {args.limit_data}": dict(
+            dataset_name="mnist",
+            num_batches=args.num_batches,
+            num_classes=args.num_classes,
+            random_split=True,
+            limit_data=args.limit_data,
+        ),
+    }
+
+    print(f"{args.num_examples} examples, {args.num_classes} classes")
+    print(f"{'Split':<30} {'Examples':>12} {'Time [s]':>10}")
+    for name, kwargs in settings.items():
+        elapsed, n_examples = time_split(labels, **kwargs)
+        print(f"{name:<30} {n_examples:>12} {elapsed:>10.2f}")
+
+
+def get_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_examples", type=int, default=10000000)
+    parser.add_argument("--num_classes", type=int, default=1000)
+    parser.add_argument("--num_batches", type=int, default=200)
+    parser.add_argument("--dirichlet_alpha", type=float, default=1.0)
+    parser.add_argument("--limit_data", type=float, default=0.5)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    run(get_args(sys.argv[1:]))
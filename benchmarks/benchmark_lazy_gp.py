@@ -0,0 +1,175 @@
+"""Compare time of training steps of the local WGAN-GP and FID of the trained
+local generator on a Split-MNIST task with the gradient penalty computed on
+every critic step and lazily (every gp_every steps and/or on a fraction of the
+batch), e.g.:
+
+python3 -m benchmarks.benchmark_lazy_gp --task_id 0 --num_epochs 20 --gp_every 1 4 16 --gp_batch_fractions 1.0 0.25
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.utils.data as data
+import wandb
+
+import continual_benchmark.dataloaders.base
+from continual_benchmark.dataloaders.datasetGen import data_split
+from continual_benchmark.dataloaders.wrapper import FlatIndexDataset
+from gan_experiments import models_definition, training_functions
+from gan_experiments.validation import Validator
+
+
+def run(args):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    torch_g = torch.Generator().manual_seed(args.seed)
+    train_dataset, val_dataset = continual_benchmark.dataloaders.base.MNIST(
+        args.dataroot
+    )
+    num_classes = train_dataset.number_classes
+    train_dataset_splits, _, _ = data_split(
+        dataset=train_dataset,
+        dataset_name="mnist",
+        num_batches=args.num_batches,
+        num_classes=num_classes,
+        generator=torch_g,
+    )
+    val_dataset_splits, _, _ = data_split(
+        dataset=val_dataset,
+        dataset_name="mnist",
+        num_batches=args.num_batches,
+        num_classes=num_classes,
+        generator=torch_g,
+    )
+    task_loader = data.DataLoader(
+        FlatIndexDataset(train_dataset_splits[args.task_id]),
+        batch_size=args.batch_size,
+        shuffle=True,
+        generator=torch_g,
+    )
+    val_loaders = [
+        data.DataLoader(
+            FlatIndexDataset(val_dataset_splits[task_id]),
+            batch_size=args.val_batch_size,
+            shuffle=False,
+        )
+        for task_id in range(args.num_batches)
+    ]
+    validator = Validator(
+        n_classes=num_classes,
+        device=device,
+        dataset="MNIST",
+        stats_file_name=f"lazy_gp_seed_{args.seed}_batches_{args.num_batches}",
+        dataloaders=val_loaders,
+    )
+    img_shape = train_dataset[0][0].shape
+
+    def train(gp_every, gp_batch_fraction, n_epochs):
+        torch.manual_seed(args.seed)
+        np.random.seed(args.seed)
+        translator = models_definition.Translator(
+            latent_size=args.latent_dim,
+            device=device,
+            num_embeddings=args.num_batches,
+            embedding_dim=args.num_batches,
+        ).to(device)
+        generator = models_definition.Generator(
+            latent_dim=args.latent_dim,
+            img_shape=img_shape,
+            device=device,
+            translator=translator,
+            num_features=args.g_n_features,
+        ).to(device)
+        discriminator = models_definition.Discriminator(
+            img_shape=img_shape,
+            device=device,
+            num_features=args.d_n_features,
+            num_embeddings=0,
+            embedding_dim=0,
+        ).to(device)
+        training_functions.train_local(
+            local_generator=generator,
+            local_discriminator=discriminator,
+            n_epochs=n_epochs,
+            task_loader=task_loader,
+            task_id=args.task_id,
+            local_dis_lr=args.local_dis_lr,
+            local_gen_lr=args.local_gen_lr,
+            num_gen_images=args.num_gen_images,
+            local_scheduler_rate=args.local_scheduler_rate,
+            n_critic_steps=args.n_critic_steps,
+            lambda_gp=args.lambda_gp,
+            b1=args.local_b1,
+            b2=args.local_b2,
+            num_classes=num_classes,
+            gp_every=gp_every,
+            gp_batch_fraction=gp_batch_fraction,
+        )
+        return generator
+
+    # Untimed epoch, so that one-time costs are not counted in the first setting
+    train(args.gp_every[0], args.gp_batch_fractions[0], n_epochs=1)
+
+    results = {}
+    for gp_every in args.gp_every:
+        for gp_batch_fraction in args.gp_batch_fractions:
+            start = time.time()
+            generator = train(gp_every, gp_batch_fraction, args.num_epochs)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            step_time = (time.time() - start) / (args.num_epochs * len(task_loader))
+
+            fid, _, _, _ = validator.calculate_results(
+                curr_global_generator=generator,
+                task_id=args.task_id,
+                batch_size=args.val_batch_size,
+                calculate_class_dist=False,
+            )
+            results[(gp_every, gp_batch_fraction)] = (step_time, fid)
+
+    # Speedup relative to the first setting, every step with the whole batch
+    # by default
+    base_step_time = next(iter(results.values()))[0]
+    print(
+        f"{'gp_every':>10} {'Fraction':>10} {'Step [ms]':>10} {'Speedup':>8} "
+        f"{'FID':>10}"
+    )
+    for (gp_every, gp_batch_fraction), (step_time, fid) in results.items():
+        print(
+            f"{gp_every:>10} {gp_batch_fraction:>10.2f} {step_time * 1000:>10.1f} "
+            f"{base_step_time / step_time:>7.2f}x {fid:>10.2f}"
+        )
+
+
+def get_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataroot", type=str, default="data/")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--num_batches", type=int, default=5)
+    parser.add_argument("--task_id", type=int, default=0)
+    parser.add_argument("--num_epochs", type=int, default=20)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--val_batch_size", type=int, default=250)
+    parser.add_argument("--gp_every", nargs="+", type=int, default=[1, 4, 16])
+    parser.add_argument(
+        "--gp_batch_fractions", nargs="+", type=float, default=[1.0, 0.25]
+    )
+    parser.add_argument("--n_critic_steps", type=int, default=5)
+    parser.add_argument("--lambda_gp", type=int, default=10)
+    parser.add_argument("--latent_dim", type=int, default=100)
+    parser.add_argument("--g_n_features", type=int, default=32)
+    parser.add_argument("--d_n_features", type=int, default=32)
+    parser.add_argument("--local_gen_lr", type=float, default=0.0002)
+    parser.add_argument("--local_dis_lr", type=float, default=0.0002)
+    parser.add_argument("--local_scheduler_rate", type=float, default=0.99)
+    parser.add_argument("--local_b1", type=float, default=0.0)
+    parser.add_argument("--local_b2", type=float, default=0.9)
+    parser.add_argument("--num_gen_images", type=int, default=16)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    wandb.init(mode="disabled")
+    run(get_args(sys.argv[1:]))
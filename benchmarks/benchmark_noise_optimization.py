@@ -0,0 +1,123 @@
+"""Compare final reconstruction MSE and wall time of noise optimization started
+from random noise and from the predictions of an encoder trained on the local
+generator, e.g.:
+
+python3 -m benchmarks.benchmark_noise_optimization --dataset MNIST --generator_path results/MNIST/CI_5/model1_curr_local_generator --task_id 1
+"""
+
+import argparse
+import sys
+import time
+
+import torch
+import wandb
+
+import continual_benchmark.dataloaders as dataloaders
+import continual_benchmark.dataloaders.base
+from continual_benchmark.dataloaders.datasetGen import data_split
+from gan_experiments import gan_utils, training_functions
+
+
+def reconstruction_mse(generator, images, noise, task_ids):
+    with torch.no_grad():
+        return torch.mean((generator(noise, task_ids) - images) ** 2).item()
+
+
+def run(args):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    generator = torch.load(args.generator_path, map_location=device)
+    generator.device = device
+    generator.translator.device = device
+    generator.eval()
+
+    train_dataset, _ = dataloaders.base.__dict__[args.dataset](args.dataroot)
+    num_classes = (
+        10 if args.dataset.lower() == "celeba" else train_dataset.number_classes
+    )
+    train_dataset_splits, _, _ = data_split(
+        dataset=train_dataset,
+        dataset_name=args.dataset.lower(),
+        num_batches=args.num_batches,
+        num_classes=num_classes,
+    )
+    task_loader = torch.utils.data.DataLoader(
+        train_dataset_splits[args.task_id], batch_size=args.num_examples
+    )
+    images = next(iter(task_loader))[0].to(device)
+    task_ids = (torch.zeros([len(images)]) + args.task_id).to(device)
+
+    results = {}
+
+    start = time.time()
+    noise = gan_utils.optimize_noise(
+        images,
+        generator,
+        args.num_epochs_noise_optim,
+        args.task_id,
+        lr=args.optim_noise_lr,
+    )
+    results[f"random init, {args.num_epochs_noise_optim} steps"] = (
+        reconstruction_mse(generator, images, noise, task_ids),
+        time.time() - start,
+    )
+
+    start = time.time()
+    encoder = training_functions.train_encoder(
+        generator,
+        args.task_id,
+        n_iterations=args.encoder_iterations,
+        lr=args.encoder_lr,
+    )
+    encoder_time = time.time() - start
+    with torch.no_grad():
+        init_noise = encoder(images, task_ids)
+    results["encoder, 0 steps"] = (
+        reconstruction_mse(generator, images, init_noise, task_ids),
+        encoder_time,
+    )
+    for n_steps in args.refine_iterations:
+        start = time.time()
+        noise = gan_utils.optimize_noise(
+            images,
+            generator,
+            n_steps,
+            args.task_id,
+            lr=args.optim_noise_lr,
+            init_noise=init_noise,
+        )
+        results[f"encoder, {n_steps} steps"] = (
+            reconstruction_mse(generator, images, noise, task_ids),
+            encoder_time + time.time() - start,
+        )
+
+    print(f"{'Initialization':<30} {'MSE':>10} {'Time [s]':>10}")
+    for name, (mse, elapsed) in results.items():
+        print(f"{name:<30} {mse:>10.4f} {elapsed:>10.2f}")
+
+
+def get_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", type=str, default="MNIST")
+    parser.add_argument("--dataroot", type=str, default="data/")
+    parser.add_argument(
+        "--generator_path",
+        type=str,
+        required=True,
+        help="Path to local generator saved by main.py",
+    )
+    parser.add_argument("--task_id", type=int, default=1)
+    parser.add_argument("--num_batches", type=int, default=5)
+    parser.add_argument("--num_examples", type=int, default=1024)
+    parser.add_argument("--num_epochs_noise_optim", type=int, default=1000)
+    parser.add_argument("--optim_noise_lr", type=float, default=0.1)
+    parser.add_argument("--encoder_iterations", type=int, default=2000)
+    parser.add_argument("--encoder_lr", type=float, default=0.001)
+    parser.add_argument(
+        "--refine_iterations", nargs="+", type=int, default=[50, 100, 200]
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    wandb.init(mode="disabled")
+    run(get_args(sys.argv[1:]))
@@ -0,0 +1,121 @@
+import math
+
+import torch
+import torch.nn.functional as F
+import torch.utils.data as data
+from torchvision import transforms
+from torchvision.transforms import InterpolationMode
+
+
+def _supported(step):
+    if isinstance(step, transforms.ConvertImageDtype):
+        return step.dtype.is_floating_point
+    if isinstance(step, transforms.RandomCrop):
+        padding = step.padding if step.padding is not None else 0
+        padding = [padding] if isinstance(padding, int) else list(padding)
+        return (
+            len(padding) == 1
+            and step.fill == 0
+            and step.padding_mode == "constant"
+            and not step.pad_if_needed
+        )
+    if isinstance(step, transforms.RandomRotation):
+        return (
+            step.center is None
+            and not step.expand
+            and not step.fill
+            and step.interpolation
+            in [InterpolationMode.NEAREST, InterpolationMode.BILINEAR]
+        )
+    return isinstance(step, (transforms.RandomHorizontalFlip, transforms.Normalize))
+
+
+class BatchAugment:
+    """
+    Steps of a torchvision transform (ConvertImageDtype, RandomRotation,
+    RandomCrop, RandomHorizontalFlip, Normalize) applied to a whole batch of
+    decoded uint8 images (N x C x H x W) with tensor operations on the device
+    of the images. Random parameters of every image are drawn from a CPU
+    generator seeded with seed, combined with the seed of the DataLoader worker
+    in worker processes.
+    """
+
+    def __init__(self, steps, seed=None):
+        self.steps = list(steps)
+        self.seed = torch.initial_seed() if seed is None else seed
+        self.generator = torch.Generator().manual_seed(self.seed)
+        self.worker_seed = None
+
+    @staticmethod
+    def supports(steps):
+        return all(_supported(step) for step in steps)
+
+    def __repr__(self):
+        return f"BatchAugment({transforms.Compose(self.steps)})"
+
+    def _get_generator(self):
+        # Workers hold copies of the generator, each of them is reseeded once
+        worker_info = data.get_worker_info()
+        if worker_info is not None and worker_info.seed != self.worker_seed:
+            self.worker_seed = worker_info.seed
+            self.generator.manual_seed((self.seed + worker_info.seed) % 2 ** 63)
+        return self.generator
+
+    def _rand(self, n, device):
+        return torch.rand(n, generator=self._get_generator()).to(device)
+
+    def _rotate(self, imgs, step):
+        angles = step.degrees[0] + self._rand(len(imgs), imgs.device) * (
+            step.degrees[1] - step.degrees[0]
+        )
+        angles = angles * math.pi / 180
+        cos, sin = torch.cos(angles), torch.sin(angles)
+        zeros = torch.zeros_like(cos)
+        theta = torch.stack(
+            [torch.stack([cos, -sin, zeros], 1), torch.stack([sin, cos, zeros], 1)], 1
+        )
+        grid = F.affine_grid(theta, list(imgs.shape), align_corners=False)
+        return F.grid_sample(
+            imgs,
+            grid,
+            mode=step.interpolation.value,
+            padding_mode="zeros",
+            align_corners=False,
+        )
+
+    def _crop(self, imgs, step):
+        padding = step.padding if step.padding is not None else 0
+        padding = padding if isinstance(padding, int) else padding[0]
+        imgs = F.pad(imgs, [padding] * 4)
+        height, width = step.size
+        n, _, padded_height, padded_width = imgs.shape
+        if (padded_height, padded_width) == (height, width):
+            return imgs
+        top = (self._rand(n, imgs.device) * (padded_height - height + 1)).long()
+        left = (self._rand(n, imgs.device) * (padded_width - width + 1)).long()
+        rows = (top[:, None] + torch.arange(height, device=imgs.device))[:, :, None]
+        cols = (left[:, None] + torch.arange(width, device=imgs.device))[:, None, :]
+        # Flat positions of pixels of every crop in the padded image
+        crop_indices = (rows * padded_width + cols).view(n, 1, -1)
+        imgs = imgs.flatten(2).gather(2, crop_indices.expand(-1, imgs.shape[1], -1))
+        return imgs.view(n, -1, height, width)
+
+    def _flip(self, imgs, step):
+        flip = self._rand(len(imgs), imgs.device) < step.p
+        imgs = imgs.clone()
+        imgs[flip] = imgs[flip].flip(-1)
+        return imgs
+
+    def __call__(self, imgs):
+        for step in self.steps:
+            if isinstance(step, transforms.ConvertImageDtype):
+                imgs = transforms.functional.convert_image_dtype(imgs, step.dtype)
+            elif isinstance(step, transforms.RandomRotation):
+                imgs = self._rotate(imgs, step)
+            elif isinstance(step, transforms.RandomCrop):
+                imgs = self._crop(imgs, step)
+            elif isinstance(step, transforms.RandomHorizontalFlip):
+                imgs = self._flip(imgs, step)
+            else:
+                imgs = step(imgs)
+        return imgs
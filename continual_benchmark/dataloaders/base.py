@@ -1,72 +1,258 @@
 from locale import normalize
+import copy
+import hashlib
 import os
+import shutil
+import zipfile
 
 import numpy as np
-import pandas as pd
 import torch
 import torchvision
 from torch.utils.data import Dataset, DataLoader, TensorDataset, ConcatDataset
 from torchvision import transforms
 
-from .wrapper import CacheClassLabel
+from .augment import BatchAugment
+from .shards import ShardedDataset, write_shards
+from .wrapper import CacheClassLabel, available_cpus
 
 
 class FastCelebA(Dataset):
-    def __init__(self, data, attr):
-        self.dataset = data
-        self.attr = attr
+    """
+    CelebA decoded once into uint8 images (images.npy) with a separate array of
+    attributes (attr.npy). Images are memory-mapped lazily on first access, and
+    random horizontal flips (if flip) and normalization are applied to tensors
+    of whole batches.
+    """
+
+    def __init__(self, root, normalize=True, flip=True):
+        self.root = root
+        self.normalize = normalize
+        self.flip = flip
+        self.attr = torch.from_numpy(np.load(os.path.join(root, "attr.npy")))
+        self._images = None
+        self.batch_transform = self._batch_transform()
+
+    def _batch_transform(self):
+        steps = [transforms.ConvertImageDtype(torch.float)]
+        if self.flip:
+            steps.append(transforms.RandomHorizontalFlip())
+        if self.normalize:
+            steps.append(transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)))
+        return BatchAugment(steps)
+
+    @property
+    def images(self):
+        if self._images is None:
+            self._images = np.load(os.path.join(self.root, "images.npy"), mmap_mode="r")
+        return self._images
+
+    @property
+    def transform(self):
+        # Description of preprocessing, e.g. for hashes of reference statistics
+        return self.batch_transform
+
+    def __getstate__(self):
+        # Every DataLoader worker maps the file again instead of copying it
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+    def with_flip(self, flip):
+        """
+        The same examples with or without random flips, e.g. for evaluation.
+        Attributes are shared, so labels set by data_split are kept.
+        """
+        dataset = copy.copy(self)
+        dataset.flip = flip
+        dataset.batch_transform = dataset._batch_transform()
+        return dataset
 
     def __len__(self):
-        return len(self.dataset)
+        return len(self.attr)
 
     def __getitem__(self, index):
-        return self.dataset[index], self.attr[index]
+        img = torch.from_numpy(np.array(self.images[index]))
+        return self.batch_transform(img[None])[0], self.attr[index]
+
+    def __getitems__(self, indices):
+        imgs = torch.from_numpy(self.images[np.asarray(indices)])
+        return list(zip(self.batch_transform(imgs), self.attr[indices]))
+
+
+def _uint8_images(batch):
+    """Collate PIL images and targets into uint8 NCHW images and targets"""
+    imgs = np.stack(
+        [np.asarray(img, dtype=np.uint8).transpose(2, 0, 1) for img, _ in batch]
+    )
+    return imgs, torch.stack([torch.as_tensor(target) for _, target in batch])
+
+
+# Transforms of PIL images whose output depends only on the input image
+DETERMINISTIC_TRANSFORMS = (
+    transforms.Resize,
+    transforms.CenterCrop,
+    transforms.Grayscale,
+)
+
+
+def split_transform(transform):
+    """
+    Split transform into deterministic steps applied to PIL images before
+    ToTensor and remaining steps, which are applied to uint8 tensors converted
+    to float in [0, 1]. Returns None if transform has no ToTensor step.
+    """
+    steps = list(transform.transforms)
+    if not any(isinstance(step, transforms.ToTensor) for step in steps):
+        return None
+    n_decode_steps = 0
+    while isinstance(steps[n_decode_steps], DETERMINISTIC_TRANSFORMS):
+        n_decode_steps += 1
+    tensor_steps = [transforms.ConvertImageDtype(torch.float)] + [
+        step
+        for step in steps[n_decode_steps:]
+        if not isinstance(step, transforms.ToTensor)
+    ]
+    return (
+        transforms.Compose(steps[:n_decode_steps]),
+        transforms.Compose(tensor_steps),
+    )
+
+
+class DecodedDataset(Dataset):
+    """
+    Torchvision dataset with images decoded once after the deterministic part
+    of its transform into a uint8 memory-mapped array. Random augmentations and
+    normalization are applied afterwards to tensors.
+    """
+
+    def __init__(self, dataset, name):
+        decode_transform, self.tensor_transform = split_transform(dataset.transform)
+        # Transforms of whole batches of images, if all steps have batched versions
+        self.batch_transform = (
+            BatchAugment(self.tensor_transform.transforms)
+            if BatchAugment.supports(self.tensor_transform.transforms)
+            else None
+        )
+        self.name = name
+        self.root = dataset.root
+        self.transform = dataset.transform
+        self.classes = getattr(dataset, "classes", None)
+
+        cache_key = hashlib.sha1(
+            f"{name}_{len(dataset)}_{decode_transform}".encode()
+        ).hexdigest()[:16]
+        cache_dir = os.path.join(self.root, "decoded_cache")
+        images_path = os.path.join(cache_dir, f"{name}_{cache_key}_images.npy")
+        labels_path = os.path.join(cache_dir, f"{name}_{cache_key}_labels.npy")
+        if not os.path.exists(images_path):
+            print(f"Decoding {name} into {images_path}")
+            os.makedirs(cache_dir, exist_ok=True)
+            dataset.transform = decode_transform
+            images = None
+            labels = np.zeros(len(dataset), dtype=np.int64)
+            tmp_path = f"{images_path}.{os.getpid()}.tmp"
+            for i in range(len(dataset)):
+                img, labels[i] = dataset[i]
+                img = np.asarray(img, dtype=np.uint8)
+                img = img[None] if img.ndim == 2 else img.transpose(2, 0, 1)
+                if images is None:
+                    images = np.lib.format.open_memmap(
+                        tmp_path,
+                        mode="w+",
+                        dtype=np.uint8,
+                        shape=(len(dataset),) + img.shape,
+                    )
+                images[i] = img
+            images.flush()
+            del images
+            dataset.transform = self.transform
+            # Labels are replaced first, so that the images file marks a
+            # complete cache
+            tmp_labels_path = f"{labels_path}.{os.getpid()}.tmp"
+            with open(tmp_labels_path, "wb") as file:
+                np.save(file, labels)
+            os.replace(tmp_labels_path, labels_path)
+            os.replace(tmp_path, images_path)
+        self.images = np.load(images_path, mmap_mode="r")
+        self.targets = torch.from_numpy(np.load(labels_path))
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        img = self.tensor_transform(torch.from_numpy(np.array(self.images[index])))
+        return img, int(self.targets[index])
+
+    def __getitems__(self, indices):
+        # One read of all images of the batch from the memory map
+        imgs = torch.from_numpy(self.images[np.asarray(indices)])
+        if self.batch_transform is not None:
+            imgs = self.batch_transform(imgs)
+        else:
+            imgs = [self.tensor_transform(img) for img in imgs]
+        return [(img, int(self.targets[i])) for img, i in zip(imgs, indices)]
+
+
+def decoded(dataset, name, decoded_cache=True):
+    """Wrap torchvision dataset in DecodedDataset if its transform allows it"""
+    if not decoded_cache or split_transform(dataset.transform) is None:
+        return dataset
+    return DecodedDataset(dataset, name)
 
 
 def CelebA(
     root, skip_normalization=False, train_aug=False, image_size=64, target_type="attr"
 ):
-    if skip_normalization:
-        transform = transforms.Compose(
-            [
-                transforms.Resize(image_size),
-                transforms.RandomHorizontalFlip(),
-                transforms.CenterCrop(image_size),
-                transforms.ToTensor(),
-            ]
+    save_path = f"{root}/fast_celeba_{image_size}_{target_type}"
+    if not os.path.exists(save_path):
+        print("Decoding CelebA")
+        # Random flips are applied later, to batches of decoded images
+        dataset = torchvision.datasets.CelebA(
+            root=root,
+            download=True,
+            transform=transforms.Compose(
+                [transforms.Resize(image_size), transforms.CenterCrop(image_size)]
+            ),
+            target_type=target_type,
         )
-        print("Loading data")
-    else:
-        transform = transforms.Compose(
-            [
-                transforms.Resize(image_size),
-                transforms.RandomHorizontalFlip(),
-                transforms.CenterCrop(image_size),
-                transforms.ToTensor(),
-                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
-            ]
+        tmp_path = f"{save_path}.{os.getpid()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        images = np.lib.format.open_memmap(
+            os.path.join(tmp_path, "images.npy"),
+            mode="w+",
+            dtype=np.uint8,
+            shape=(len(dataset), 3, image_size, image_size),
         )
-        print("Loading data")
-        print("Data has been normalized")
-    print(transform)
-
-    save_path = f"{root}/fast_celeba"
-    if os.path.exists(save_path):
-        fast_celeba = torch.load(save_path)
-    else:
-        dataset = torchvision.datasets.CelebA(
-            root=root, download=True, transform=transform, target_type=target_type
+        attr = []
+        loader = DataLoader(
+            dataset,
+            batch_size=1024,
+            num_workers=available_cpus(),
+            collate_fn=_uint8_images,
         )
-        train_loader = DataLoader(dataset, batch_size=len(dataset))
-        data = next(iter(train_loader))
-        fast_celeba = FastCelebA(data[0], data[1])
-        torch.save(fast_celeba, save_path)
+        offset = 0
+        for imgs, targets in loader:
+            images[offset : offset + len(imgs)] = imgs
+            attr.append(targets.numpy())
+            offset += len(imgs)
+        images.flush()
+        del images
+        np.save(os.path.join(tmp_path, "attr.npy"), np.concatenate(attr))
+        try:
+            os.rename(tmp_path, save_path)
+        except OSError:
+            # Decoded by a concurrent run in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+    fast_celeba = FastCelebA(save_path, normalize=not skip_normalization)
+    print("Loading data")
+    if not skip_normalization:
+        print("Data has been normalized")
     # train_set = CacheClassLabel(train_set)
     # val_set = CacheClassLabel(val_set)
     return fast_celeba, None
 
 
-def MNIST(dataroot, skip_normalization=False, train_aug=False):
+def MNIST(dataroot, skip_normalization=False, train_aug=False, decoded_cache=True):
     normalize = transforms.Normalize(mean=(0.5,), std=(0.5,))  # for 28x28
     # normalize = transforms.Normalize(mean=(0.1000,), std=(0.2752,))  # for 32x32
 
@@ -97,17 +283,21 @@ def MNIST(dataroot, skip_normalization=False, train_aug=False):
     train_dataset = torchvision.datasets.MNIST(
         root=dataroot, train=True, download=True, transform=train_transform
     )
+    train_dataset = decoded(train_dataset, "MNIST_train", decoded_cache)
     train_dataset = CacheClassLabel(train_dataset)
 
     val_dataset = torchvision.datasets.MNIST(
         dataroot, train=False, transform=val_transform
     )
+    val_dataset = decoded(val_dataset, "MNIST_val", decoded_cache)
     val_dataset = CacheClassLabel(val_dataset)
 
     return train_dataset, val_dataset
 
 
-def MNISTBigGAN(dataroot, skip_normalization=False, train_aug=False):
+def MNISTBigGAN(
+    dataroot, skip_normalization=False, train_aug=False, decoded_cache=True
+):
     normalize = transforms.Normalize(mean=(0.5,), std=(0.5,))  # for 28x28
     # normalize = transforms.Normalize(mean=(0.1000,), std=(0.2752,))  # for 32x32
 
@@ -142,17 +332,19 @@ def MNISTBigGAN(dataroot, skip_normalization=False, train_aug=False):
     train_dataset = torchvision.datasets.MNIST(
         root=dataroot, train=True, download=True, transform=train_transform
     )
+    train_dataset = decoded(train_dataset, "MNIST_train", decoded_cache)
     train_dataset = CacheClassLabel(train_dataset)
 
     val_dataset = torchvision.datasets.MNIST(
         dataroot, train=False, transform=val_transform
     )
+    val_dataset = decoded(val_dataset, "MNIST_val", decoded_cache)
     val_dataset = CacheClassLabel(val_dataset)
 
     return train_dataset, val_dataset
 
 
-def Omniglot(dataroot, skip_normalization=False, train_aug=False):
+def Omniglot(dataroot, skip_normalization=False, train_aug=False, decoded_cache=True):
     # normalize = transforms.Normalize(mean=(0.1307,), std=(0.3081,))  # for 28x28
     # normalize = transforms.Normalize(mean=(0.1000,), std=(0.2752,))  # for 32x32
     normalize = transforms.Normalize(mean=(0.5,), std=(0.5,))
@@ -175,6 +367,7 @@ def Omniglot(dataroot, skip_normalization=False, train_aug=False):
     train_dataset = torchvision.datasets.Omniglot(
         root=dataroot, download=True, transform=train_transform
     )
+    train_dataset = decoded(train_dataset, "Omniglot_train", decoded_cache)
     train_dataset = CacheClassLabel(train_dataset)
 
     # val_dataset = torchvision.datasets.MNIST(
@@ -187,7 +380,9 @@ def Omniglot(dataroot, skip_normalization=False, train_aug=False):
     return train_dataset, train_dataset
 
 
-def FashionMNIST(dataroot, skip_normalization=False, train_aug=False):
+def FashionMNIST(
+    dataroot, skip_normalization=False, train_aug=False, decoded_cache=True
+):
     normalize = transforms.Normalize(mean=(0.5,), std=(0.5,))  # for  28x28
     # normalize = transforms.Normalize(mean=(0.1000,), std=(0.2752,))  # for 32x32
 
@@ -219,17 +414,21 @@ def FashionMNIST(dataroot, skip_normalization=False, train_aug=False):
     train_dataset = torchvision.datasets.FashionMNIST(
         root=dataroot, train=True, download=True, transform=train_transform
     )
+    train_dataset = decoded(train_dataset, "FashionMNIST_train", decoded_cache)
     train_dataset = CacheClassLabel(train_dataset)
 
     val_dataset = torchvision.datasets.FashionMNIST(
         dataroot, train=False, transform=val_transform
     )
+    val_dataset = decoded(val_dataset, "FashionMNIST_val", decoded_cache)
     val_dataset = CacheClassLabel(val_dataset)
 
     return train_dataset, val_dataset
 
 
-def DoubleMNIST(dataroot, skip_normalization=False, train_aug=False):
+def DoubleMNIST(
+    dataroot, skip_normalization=False, train_aug=False, decoded_cache=True
+):
     # normalize = transforms.Normalize(mean=(0.1307,), std=(0.3081,))  # for  28x28
     # normalize = transforms.Normalize(mean=(0.1000,), std=(0.2752,))  # for 32x32
     normalize = transforms.Normalize(mean=(0.5,), std=(0.5,))
@@ -262,21 +461,29 @@ def DoubleMNIST(dataroot, skip_normalization=False, train_aug=False):
     train_dataset_fashion = torchvision.datasets.FashionMNIST(
         root=dataroot, train=True, download=True, transform=train_transform
     )
+    train_dataset_fashion = decoded(
+        train_dataset_fashion, "FashionMNIST_train", decoded_cache
+    )
     # train_dataset_fashion = CacheClassLabel(train_dataset_fashion)
 
     train_dataset_mnist = torchvision.datasets.MNIST(
         root=dataroot, train=True, download=True, transform=train_transform
     )
+    train_dataset_mnist = decoded(train_dataset_mnist, "MNIST_train", decoded_cache)
     # train_dataset_mnist = CacheClassLabel(train_dataset_mnist)
 
     val_dataset_fashion = torchvision.datasets.FashionMNIST(
         dataroot, train=False, transform=val_transform
     )
+    val_dataset_fashion = decoded(
+        val_dataset_fashion, "FashionMNIST_val", decoded_cache
+    )
     # val_dataset_fashion = CacheClassLabel(val_dataset)
 
     val_dataset_mnist = torchvision.datasets.MNIST(
         dataroot, train=False, transform=val_transform
     )
+    val_dataset_mnist = decoded(val_dataset_mnist, "MNIST_val", decoded_cache)
     # val_dataset_mnist = CacheClassLabel(val_dataset)
     train_dataset_mnist.targets = train_dataset_mnist.targets + 10
     val_dataset_mnist.targets = val_dataset_mnist.targets + 10
@@ -289,7 +496,7 @@ def DoubleMNIST(dataroot, skip_normalization=False, train_aug=False):
     return train_dataset, val_dataset
 
 
-def CIFAR10(dataroot, skip_normalization=False, train_aug=True):
+def CIFAR10(dataroot, skip_normalization=False, train_aug=True, decoded_cache=True):
     # normalize = transforms.Normalize(mean=[0.491, 0.482, 0.447], std=[0.247, 0.243, 0.262])
     normalize = transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
 
@@ -323,48 +530,159 @@ def CIFAR10(dataroot, skip_normalization=False, train_aug=True):
     train_dataset = torchvision.datasets.CIFAR10(
         root=dataroot, train=True, download=True, transform=train_transform
     )
+    train_dataset = decoded(train_dataset, "CIFAR10_train", decoded_cache)
     train_dataset = CacheClassLabel(train_dataset)
 
     val_dataset = torchvision.datasets.CIFAR10(
         root=dataroot, train=False, download=True, transform=val_transform
     )
+    val_dataset = decoded(val_dataset, "CIFAR10_val", decoded_cache)
     val_dataset = CacheClassLabel(val_dataset)
 
     return train_dataset, val_dataset
 
 
-def CERN(dataroot, skip_normalization=False, train_aug=True, test_split=0.25):
-    data_cond = np.load(f"{dataroot}/cern/data_nonrandom_particles.npz")["arr_0"]
-    data_cond = pd.DataFrame(
-        data_cond,
-        columns=["Energy", "Vx", "Vy", "Vz", "Px", "Py", "Pz", "mass", "charge"],
-    )
-    data = np.load(f"{dataroot}/cern/data_nonrandom_responses.npz")["arr_0"]
+class CERNResponses(Dataset):
+    """
+    Calorimeter responses of CERN particles from a memory-mapped array,
+    opened lazily on first access, with energy-bin labels
+    """
+
+    def __init__(self, root, indices):
+        self.root = root
+        self.indices = indices
+        self.targets = torch.from_numpy(np.load(os.path.join(root, "labels.npy")))[
+            indices
+        ]
+        self._responses = None
+
+    @property
+    def responses(self):
+        if self._responses is None:
+            self._responses = np.load(
+                os.path.join(self.root, "responses.npy"), mmap_mode="r"
+            )
+        return self._responses
+
+    def __getstate__(self):
+        # Every DataLoader worker maps the file again instead of copying it
+        state = self.__dict__.copy()
+        state["_responses"] = None
+        return state
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        response = np.array(self.responses[self.indices[index]], dtype=np.float32)
+        return torch.from_numpy(response), int(self.targets[index])
+
+    def __getitems__(self, indices):
+        responses = self.responses[self.indices[np.asarray(indices)]]
+        responses = torch.from_numpy(responses.astype(np.float32))
+        return [
+            (response, int(self.targets[i])) for response, i in zip(responses, indices)
+        ]
+
+
+def _npz_chunks(path, chunk_size, key="arr_0"):
+    """Read array stored in npz file in chunks of chunk_size rows"""
+    with zipfile.ZipFile(path) as archive, archive.open(f"{key}.npy") as file:
+        version = np.lib.format.read_magic(file)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+        assert not fortran_order
+        row_size = int(np.prod(shape[1:])) * dtype.itemsize
+        yield shape
+        for start in range(0, shape[0], chunk_size):
+            n_rows = min(chunk_size, shape[0] - start)
+            chunk = np.frombuffer(file.read(n_rows * row_size), dtype=dtype)
+            yield chunk.reshape((n_rows,) + tuple(shape[1:]))
+
+
+def quantile_bins(values, n_bins):
+    """
+    Bins with equal numbers of values, labeled 0 to n_bins - 1, the same as
+    pd.qcut(values, q=n_bins, labels=False) with right-closed intervals
+    """
+    edges = np.quantile(values, np.linspace(0, 1, n_bins + 1))
+    return np.searchsorted(edges[1:-1], values, side="left")
+
+
+def CERN(
+    dataroot,
+    skip_normalization=False,
+    train_aug=True,
+    test_split=0.25,
+    dtype="float32",
+    chunk_size=10000,
+):
     n_classes = 10
-    bin_labels = list(range(n_classes))
-    data_cond["label"] = pd.qcut(data_cond["Energy"], q=n_classes, labels=bin_labels)
-    data = np.log(data + 1)
-    data = np.expand_dims(data, 1)
-    train_cond = data_cond.sample(int(len(data_cond) * (1 - test_split)))
-    test_cond = data_cond.drop(train_cond.index)
-
-    train_dataset = TensorDataset(
-        torch.Tensor(data[train_cond.index]).float(),
-        torch.Tensor(train_cond["label"].values.astype(int)).long(),
+    responses_path = f"{dataroot}/cern/data_nonrandom_responses.npz"
+    cond_path = f"{dataroot}/cern/data_nonrandom_particles.npz"
+    source = [
+        (os.path.getsize(path), os.path.getmtime(path))
+        for path in [responses_path, cond_path]
+    ]
+    cache_key = hashlib.sha1(
+        f"{source}_{n_classes}_{test_split}_{dtype}".encode()
+    ).hexdigest()[:16]
+    cache_dir = f"{dataroot}/cern/cache_{cache_key}"
+    if not os.path.exists(cache_dir):
+        print(f"Preparing CERN data in {cache_dir}")
+        tmp_dir = f"{cache_dir}.{os.getpid()}.tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        chunks = _npz_chunks(responses_path, chunk_size)
+        shape = next(chunks)
+        responses = np.lib.format.open_memmap(
+            os.path.join(tmp_dir, "responses.npy"),
+            mode="w+",
+            dtype=dtype,
+            shape=(shape[0], 1) + tuple(shape[1:]),
+        )
+        start = 0
+        for chunk in chunks:
+            responses[start : start + len(chunk), 0] = np.log(chunk + 1)
+            start += len(chunk)
+        responses.flush()
+        del responses
+
+        energy = np.load(cond_path)["arr_0"][:, 0]
+        labels = quantile_bins(energy, n_classes)
+        np.save(os.path.join(tmp_dir, "labels.npy"), labels.astype(np.int64))
+        permutation = np.random.permutation(len(labels))
+        n_train = int(len(labels) * (1 - test_split))
+        np.save(os.path.join(tmp_dir, "train_indices.npy"), permutation[:n_train])
+        np.save(
+            os.path.join(tmp_dir, "test_indices.npy"), np.sort(permutation[n_train:])
+        )
+        try:
+            os.rename(tmp_dir, cache_dir)
+        except OSError:
+            # Prepared by a concurrent run in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    train_dataset = CERNResponses(
+        cache_dir, np.load(os.path.join(cache_dir, "train_indices.npy"))
     )
-    test_dataset = TensorDataset(
-        torch.Tensor(data[test_cond.index]).float(),
-        torch.Tensor(test_cond["label"].values.astype(int)).long(),
+    test_dataset = CERNResponses(
+        cache_dir, np.load(os.path.join(cache_dir, "test_indices.npy"))
     )
 
-    train_dataset.root = dataroot
     train_dataset = CacheClassLabel(train_dataset)
-    test_dataset.root = dataroot
     test_dataset = CacheClassLabel(test_dataset)
     return train_dataset, test_dataset
 
 
-def Flowers(dataroot, skip_normalization=False, train_aug=True):
+def Flowers(
+    dataroot,
+    skip_normalization=False,
+    train_aug=True,
+    decoded_cache=True,
+    batch_augment=False,
+):
     normalize = transforms.Normalize(
         mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
     )
@@ -390,27 +708,28 @@ def Flowers(dataroot, skip_normalization=False, train_aug=True):
 
     train_transform = val_transform
     if train_aug:
-        if skip_normalization:
-            train_transform = transforms.Compose(
-                [
-                    transforms.RandomRotation(30),
-                    transforms.Resize(100),
-                    transforms.RandomCrop(size),
-                    transforms.RandomHorizontalFlip(),
-                    transforms.ToTensor(),
-                ]
-            )
+        if batch_augment:
+            # Images decoded once at a fixed size and rotated in batches. Unlike
+            # the default augmentation, random crops come from the central
+            # 100x100 square only
+            steps = [
+                transforms.Resize(100),
+                transforms.CenterCrop(100),
+                transforms.RandomRotation(30),
+            ]
         else:
-            train_transform = transforms.Compose(
-                [
-                    transforms.RandomRotation(30),
-                    transforms.Resize(100),
-                    transforms.RandomCrop(size),
-                    transforms.RandomHorizontalFlip(),
-                    transforms.ToTensor(),
-                    normalize,
-                ]
-            )
+            steps = [transforms.RandomRotation(30), transforms.Resize(100)]
+        steps += [
+            transforms.RandomCrop(size),
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor(),
+        ]
+        if not skip_normalization:
+            steps.append(normalize)
+        train_transform = transforms.Compose(steps)
+    # Images rotated before resizing have different sizes, so they cannot be
+    # decoded into one array
+    decoded_cache = decoded_cache and (not train_aug or batch_augment)
 
     train_dir = dataroot + "/flower_data/train/"
     val_dir = dataroot + "/flower_data/valid/"
@@ -420,69 +739,55 @@ def Flowers(dataroot, skip_normalization=False, train_aug=True):
         train_dir, transform=train_transform
     )
     # If doesn't work please download data from https://www.kaggle.com/c/oxford-102-flower-pytorch
-
+    train_dataset = decoded(train_dataset, "Flowers_train", decoded_cache)
     train_dataset = CacheClassLabel(train_dataset)
 
     val_dataset = torchvision.datasets.ImageFolder(val_dir, transform=train_transform)
-
+    val_dataset = decoded(val_dataset, "Flowers_val", decoded_cache)
     val_dataset = CacheClassLabel(val_dataset)
 
     return train_dataset, val_dataset
 
 
-def LSUN(dataroot, skip_normalization=False, train_aug=False):
-    raise NotImplementedError()  # Dataset is too big
+def LSUN(dataroot, skip_normalization=False, train_aug=False, shard_size=10000):
+    # Dataset is too big to be kept in memory, images are resized once into
+    # uint8 shards and streamed from them
     normalize = transforms.Normalize(
         mean=[0.491, 0.482, 0.447], std=[0.247, 0.243, 0.262]
     )
 
-    if skip_normalization:
-        val_transform = transforms.Compose(
-            [
-                transforms.ToTensor(),
-            ]
-        )
-    else:
-        val_transform = transforms.Compose(
-            [
-                transforms.ToTensor(),
-                normalize,
-            ]
-        )
-
+    val_transform = [transforms.ConvertImageDtype(torch.float)]
+    if not skip_normalization:
+        val_transform.append(normalize)
     train_transform = val_transform
     if train_aug:
-        train_transform = transforms.Compose(
-            [
-                transforms.Resize(64),
-                transforms.CenterCrop(64),
-                # transforms.RandomCrop(32, padding=4),
-                transforms.RandomHorizontalFlip(),
-                transforms.ToTensor(),
-                normalize,
-            ]
+        train_transform = [transforms.RandomHorizontalFlip()] + val_transform
+
+    datasets = []
+    for split, transform in [("train", train_transform), ("val", val_transform)]:
+        shards_root = os.path.join(dataroot, "lsun_shards", split)
+        if not os.path.exists(shards_root):
+            write_shards(
+                torchvision.datasets.LSUN(
+                    root=dataroot,
+                    classes=split,
+                    transform=transforms.Compose(
+                        [transforms.Resize(64), transforms.CenterCrop(64)]
+                    ),
+                ),
+                shards_root,
+                shard_size=shard_size,
+                num_workers=available_cpus(),
+            )
+        datasets.append(
+            ShardedDataset(shards_root, transform=transforms.Compose(transform))
         )
-
-    train_dataset = torchvision.datasets.LSUN(
-        root=dataroot,
-        classes="train",
-        # download=True,
-        transform=train_transform,
-    )
-    train_dataset = CacheClassLabel(train_dataset)
-
-    val_dataset = torchvision.datasets.LSUN(
-        root=dataroot,
-        classes="test",
-        # download=True,
-        transform=val_transform,
-    )
-    val_dataset = CacheClassLabel(val_dataset)
+    train_dataset, val_dataset = datasets
 
     return train_dataset, val_dataset
 
 
-def CIFAR100(dataroot, skip_normalization=False, train_aug=False):
+def CIFAR100(dataroot, skip_normalization=False, train_aug=False, decoded_cache=True):
     # normalize = transforms.Normalize(mean=[0.507, 0.487, 0.441], std=[0.267, 0.256, 0.276])
     normalize = transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
 
@@ -515,11 +820,13 @@ def CIFAR100(dataroot, skip_normalization=False, train_aug=False):
     train_dataset = torchvision.datasets.CIFAR100(
         root=dataroot, train=True, download=True, transform=train_transform
     )
+    train_dataset = decoded(train_dataset, "CIFAR100_train", decoded_cache)
     train_dataset = CacheClassLabel(train_dataset)
 
     val_dataset = torchvision.datasets.CIFAR100(
         root=dataroot, train=False, download=True, transform=val_transform
     )
+    val_dataset = decoded(val_dataset, "CIFAR100_val", decoded_cache)
     val_dataset = CacheClassLabel(val_dataset)
 
     return train_dataset, val_dataset
@@ -1,3 +1,8 @@
+import hashlib
+import os
+import shutil
+
+import numpy as np
 import torch
 
 from random import shuffle
@@ -99,6 +104,152 @@ def SplitGen(
     return train_dataset_splits, val_dataset_splits, task_output_space
 
 
+def group_by_task(task_assignment, num_batches):
+    """
+    Indices of examples of every task, in increasing order, from a vector with
+    task of every example (-1 for examples outside of all tasks)
+    """
+    _, order = torch.sort(task_assignment, stable=True)
+    counts = torch.bincount(task_assignment + 1, minlength=num_batches + 1)
+    offsets = torch.cumsum(counts, 0).tolist()
+    return {
+        task: order[offsets[task] : offsets[task + 1]] for task in range(num_batches)
+    }
+
+
+def dirichlet_assignment(
+    class_indices, dirichlet_split, num_classes, num_batches, generator
+):
+    """
+    Task of every example when examples of every class are randomly permuted
+    and consecutive parts of dirichlet_split[class, task] of them go to tasks
+    """
+    task_assignment = torch.full([len(class_indices)], -1, dtype=torch.long)
+    # Examples grouped by class, in increasing order within every class
+    _, class_order = torch.sort(class_indices, stable=True)
+    class_counts = torch.bincount(
+        class_indices[class_indices >= 0], minlength=num_classes
+    )
+    class_starts = (
+        torch.cumsum(class_counts, 0) - class_counts + (class_indices < 0).sum()
+    ).tolist()
+    for in_class in range(num_classes):
+        n_samples = int(class_counts[in_class])
+        start = class_starts[in_class]
+        class_idx = class_order[start : start + n_samples]
+        class_idx = class_idx[torch.randperm(n_samples, generator=generator)]
+        # Number of examples of the class taken by consecutive tasks
+        split_points = (n_samples * dirichlet_split[in_class, :num_batches]).long()
+        split_ends = torch.cumsum(split_points, 0).clamp(max=n_samples)
+        tasks = torch.searchsorted(split_ends, torch.arange(n_samples), right=True)
+        taken = tasks < num_batches
+        task_assignment[class_idx[taken]] = tasks[taken]
+    return task_assignment
+
+
+def class_split_indices(class_indices, batch_split, num_batches):
+    """
+    Indices of examples of every task given classes of tasks in batch_split
+    """
+    n_class_values = int(class_indices.max()) + 2
+    class_tasks = torch.zeros(n_class_values, num_batches, dtype=torch.bool)
+    for task, split in batch_split.items():
+        split = torch.tensor(split).flatten().long()
+        split = split[(split >= -1) & (split < n_class_values - 1)]
+        class_tasks[split + 1, task] = True
+    # Offset by one for examples without class (-1)
+    example_classes = class_indices + 1
+    if (class_tasks.sum(1) <= 1).all():
+        task_of_class = torch.where(
+            class_tasks.any(1), class_tasks.long().argmax(1), torch.tensor(-1)
+        )
+        return group_by_task(task_of_class[example_classes], num_batches)
+    # Classes shared between tasks
+    return {
+        task: torch.where(class_tasks[:, task][example_classes])[0]
+        for task in batch_split
+    }
+
+
+def split_manifest_key(class_indices, targets, generator, **split_args):
+    """Hash of split arguments, labels of the dataset and state of generator"""
+    key = hashlib.sha1()
+    for name, value in sorted(split_args.items()):
+        key.update(name.encode())
+        if isinstance(value, torch.Tensor):
+            key.update(value.detach().cpu().numpy().tobytes())
+        else:
+            key.update(repr(value).encode())
+    key.update(class_indices.long().numpy().tobytes())
+    key.update(targets.numpy().tobytes())
+    key.update(generator.get_state().numpy().tobytes())
+    return key.hexdigest()
+
+
+def save_split_manifest(path, manifest, generator):
+    """
+    Save manifest as flat index arrays with task offsets, together with the
+    state of generator after the split, into a directory moved into place at
+    once
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    os.makedirs(tmp_path, exist_ok=True)
+    names = sorted(manifest["train"])
+    np.save(os.path.join(tmp_path, "names.npy"), np.array(names, dtype=np.int64))
+    for part in ["train", "val", "shuffles"]:
+        arrays = [manifest[part][name].numpy().astype(np.int64) for name in names]
+        np.save(os.path.join(tmp_path, f"{part}.npy"), np.concatenate(arrays))
+        np.save(
+            os.path.join(tmp_path, f"{part}_offsets.npy"),
+            np.cumsum([0] + [len(array) for array in arrays]),
+        )
+    np.save(
+        os.path.join(tmp_path, "class_histograms.npy"),
+        np.stack([manifest["class_histograms"][name].numpy() for name in names]),
+    )
+    np.save(
+        os.path.join(tmp_path, "task_sizes.npy"),
+        np.array([manifest["task_sizes"][name] for name in names]),
+    )
+    np.save(
+        os.path.join(tmp_path, "generator_state.npy"), generator.get_state().numpy()
+    )
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Saved by a concurrent run in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_split_manifest(path, generator):
+    """
+    Memory-map manifest saved by save_split_manifest and set generator to its
+    state after the split. Returns None if there is no manifest under path.
+    """
+    if not os.path.isdir(path):
+        return None
+    print(f"Loading split manifest from {path}")
+    names = np.load(os.path.join(path, "names.npy")).tolist()
+    manifest = {}
+    for part in ["train", "val", "shuffles"]:
+        indices = np.load(os.path.join(path, f"{part}.npy"), mmap_mode="r")
+        offsets = np.load(os.path.join(path, f"{part}_offsets.npy"))
+        manifest[part] = {
+            name: torch.from_numpy(np.array(indices[offsets[i] : offsets[i + 1]]))
+            for i, name in enumerate(names)
+        }
+    class_histograms = np.load(os.path.join(path, "class_histograms.npy"))
+    task_sizes = np.load(os.path.join(path, "task_sizes.npy"))
+    manifest["class_histograms"] = {
+        name: torch.from_numpy(class_histograms[i]) for i, name in enumerate(names)
+    }
+    manifest["task_sizes"] = {name: int(task_sizes[i]) for i, name in enumerate(names)}
+    generator.set_state(
+        torch.from_numpy(np.load(os.path.join(path, "generator_state.npy")))
+    )
+    return manifest
+
+
 def data_split(
     dataset,
     dataset_name,
@@ -112,7 +263,16 @@ def data_split(
     reverse=False,
     limit_classes=-1,
     generator=None,
+    manifest_dir=None,
 ):
+    """
+    Split dataset into tasks. If manifest_dir is given, indices of the splits,
+    fixed shuffles and class histograms of the train splits are saved there
+    under a hash of the split arguments, labels and state of generator, and
+    loaded instead of being recomputed in later calls. Shuffles and class
+    histograms are then available as shuffle and class_histogram attributes
+    of the train splits.
+    """
     if limit_classes > 0:
         num_classes = limit_classes
     if dataset_name.lower() == "celeba":
@@ -185,14 +345,16 @@ def data_split(
         print(batch_split)
 
     if dataset_name.lower() == "flowers":
-        class_indices = torch.zeros(len(dataset)) - 1
         inv_class_splits = {}
         for k, v in class_split.items():
             for values in v:
                 inv_class_splits[values] = k
-        for label, group in inv_class_splits.items():
-            class_indices[dataset.labels == label] = group
-        class_indices = class_indices.long()
+        labels = torch.as_tensor(dataset.labels).long()
+        group_of_label = torch.full([int(labels.max()) + 1], -1, dtype=torch.long)
+        group_of_label[list(inv_class_splits.keys())] = torch.tensor(
+            list(inv_class_splits.values())
+        )
+        class_indices = group_of_label[labels]
 
     elif dataset_name.lower() in ["celeba"]:
         class_indices = torch.zeros(len(dataset)) - 1
@@ -212,45 +374,98 @@ def data_split(
         class_indices = (
             class_indices - class_indices % 2
         ) // 2  # To have the same classes as batch indices in normal setup
-    # dirichlet_split_alpha = 1
-    batch_indices = torch.zeros(len(dataset), num_batches)
-    if dirichlet_split is not None:
-        if dirichlet_equal_split:
-            dirichlet_split = (
-                dirichlet_split
-                * num_classes
-                / (dirichlet_split.sum(0) * (num_batches + 2))
+    # Labels returned with examples, counted in class histograms of tasks
+    targets = (
+        class_indices.long()
+        if dataset_name.lower() == "celeba"
+        else torch.as_tensor(dataset.labels).long()
+    )
+    if generator is None:
+        generator = torch.default_generator
+
+    manifest = None
+    if manifest_dir is not None:
+        manifest_path = os.path.join(
+            manifest_dir,
+            split_manifest_key(
+                class_indices,
+                targets,
+                generator,
+                dataset_name=dataset_name.lower(),
+                num_batches=num_batches,
+                num_classes=num_classes,
+                random_split=random_split,
+                random_mini_shuffle=random_mini_shuffle,
+                limit_data=limit_data,
+                dirichlet_split=dirichlet_split,
+                dirichlet_equal_split=dirichlet_equal_split,
+                reverse=reverse,
+            ),
+        )
+        manifest = load_split_manifest(manifest_path, generator)
+
+    if manifest is None:
+        # dirichlet_split_alpha = 1
+        if dirichlet_split is not None:
+            if dirichlet_equal_split:
+                dirichlet_split = (
+                    dirichlet_split
+                    * num_classes
+                    / (dirichlet_split.sum(0) * (num_batches + 2))
+                )
+            task_indices = group_by_task(
+                dirichlet_assignment(
+                    class_indices.long(),
+                    dirichlet_split,
+                    num_classes,
+                    num_batches,
+                    generator,
+                ),
+                num_batches,
             )
-
-        class_split_list = []
-        n_samples_classes = []
-        for in_class in range(num_classes):
-            class_idx = torch.where(class_indices == in_class)[0]
-            class_split_list.append(
-                class_idx[torch.randperm(len(class_idx), generator=generator)]
+        elif random_split:
+            task_indices = group_by_task(
+                torch.randint(
+                    low=0, high=num_batches, size=[len(dataset)], generator=generator
+                ),
+                num_batches,
             )
-            n_samples_classes.append(len(class_idx))
-        for in_class in range(num_classes):
-            for batch in range(num_batches):
-                split_point = int(
-                    n_samples_classes[in_class] * dirichlet_split[in_class, batch]
-                )
-                selected_class_idx = class_split_list[in_class][:split_point]
-                class_split_list[in_class] = class_split_list[in_class][split_point:]
-                batch_indices[selected_class_idx, batch] = 1
-    elif random_split:
-        batch_indices[
-            range(len(dataset)),
-            torch.randint(
-                low=0, high=num_batches, size=[len(dataset)], generator=generator
-            ),
-        ] = 1
-    else:
-        for task in batch_split:
-            split = batch_split[task]
-            batch_indices[
-                (class_indices[..., None] == torch.tensor(split)).any(-1), task
-            ] = 1  # class_indices in split
+        else:
+            task_indices = class_split_indices(
+                class_indices.long(), batch_split, num_batches
+            )
+
+        val_size = 0.0 if dataset_name.lower() != "celeba" else 0.3
+        random_samples = torch.rand(len(dataset), generator=generator)
+        is_train = random_samples >= val_size
+
+        manifest = {"train": {}, "val": {}, "task_sizes": {}}
+        for name in batch_split:
+            current_indices = task_indices[name]
+            current_is_train = is_train[current_indices]
+            train_indices = current_indices[current_is_train]
+            if limit_data:
+                # Draw random numbers for the whole dataset to keep splits of a seed
+                random_subset = torch.rand(len(dataset), generator=generator)
+                train_indices = train_indices[
+                    random_subset[train_indices] <= limit_data
+                ]
+            manifest["train"][name] = train_indices
+            manifest["val"][name] = current_indices[~current_is_train]
+            manifest["task_sizes"][name] = len(current_indices)
+        if manifest_dir is not None:
+            # Fixed order of examples of every task and class histograms
+            manifest["shuffles"] = {
+                name: torch.randperm(len(manifest["train"][name]), generator=generator)
+                for name in batch_split
+            }
+            manifest["class_histograms"] = {
+                name: torch.bincount(
+                    targets[manifest["train"][name]].flatten(), minlength=num_classes
+                )[:num_classes]
+                for name in batch_split
+            }
+            save_split_manifest(manifest_path, manifest, generator)
 
     dataset.attr = class_indices.view(-1, 1).long()
 
@@ -258,33 +473,29 @@ def data_split(
     val_dataset_splits = {}
     task_output_space = {}
 
-    val_size = 0.0 if dataset_name.lower() != "celeba" else 0.3
-    random_samples = torch.rand(len(dataset), generator=generator)
-    train_set_indices = torch.ones(len(dataset))
-    train_set_indices[random_samples < val_size] = 0
-
     for name in batch_split:
-        current_batch_indices = batch_indices[:, name] == 1
-        current_train_indices = train_set_indices * current_batch_indices
-        current_val_indices = (1 - train_set_indices) * current_batch_indices
-        if limit_data:
-            random_subset = torch.rand(len(current_train_indices), generator=generator)
-            current_train_indices[random_subset > limit_data] = 0
-        train_subset = Subset(dataset, torch.where(current_train_indices == 1)[0])
+        train_indices = manifest["train"][name]
+        val_indices = manifest["val"][name]
+        train_subset = Subset(dataset, train_indices)
 
         if dataset_name.lower() == "celeba":
-            train_subset.labels = class_indices[current_train_indices == 1]
+            train_subset.labels = class_indices[train_indices]
         train_subset.class_list = batch_split[name]
 
-        val_subset = Subset(dataset, torch.where(current_val_indices == 1)[0])
+        val_subset = Subset(dataset, val_indices)
         if dataset_name.lower() == "celeba":
-            val_subset.labels = class_indices[current_val_indices == 1]
+            val_subset.labels = class_indices[val_indices]
         val_subset.class_list = batch_split[name]
         # val_subset.attr = val_subset.labels
 
         train_dataset_splits[name] = AppendName(train_subset, name)
         val_dataset_splits[name] = AppendName(val_subset, name)
-        task_output_space[name] = (batch_indices[:, name] == 1).sum()
+        if "shuffles" in manifest:
+            train_dataset_splits[name].shuffle = manifest["shuffles"][name]
+            train_dataset_splits[name].class_histogram = manifest["class_histograms"][
+                name
+            ]
+        task_output_space[name] = torch.tensor(manifest["task_sizes"][name])
     if dirichlet_split is not None:
         print("Created dataset with class split:")
         for i in range(num_batches):
@@ -0,0 +1,144 @@
+import copy
+import math
+
+import torch
+import torch.utils.data as data
+from torchvision import transforms
+
+# Transforms with a different output on every call
+RANDOM_TRANSFORMS = (
+    transforms.RandomApply,
+    transforms.RandomChoice,
+    transforms.RandomOrder,
+    transforms.RandomCrop,
+    transforms.RandomResizedCrop,
+    transforms.RandomHorizontalFlip,
+    transforms.RandomVerticalFlip,
+    transforms.RandomRotation,
+    transforms.RandomAffine,
+    transforms.RandomPerspective,
+    transforms.RandomErasing,
+    transforms.RandomGrayscale,
+    transforms.ColorJitter,
+    transforms.GaussianBlur,
+)
+
+
+def _base_dataset(dataset):
+    while hasattr(dataset, "dataset"):
+        dataset = dataset.dataset
+    return dataset
+
+
+def _with_base(dataset, base):
+    """Shallow copy of the chain of wrappers of dataset around another base"""
+    if not hasattr(dataset, "dataset"):
+        return base
+    dataset = copy.copy(dataset)
+    dataset.dataset = _with_base(dataset.dataset, base)
+    return dataset
+
+
+def _is_random(transform):
+    steps = getattr(transform, "transforms", getattr(transform, "steps", [transform]))
+    return any(isinstance(step, RANDOM_TRANSFORMS) for step in steps)
+
+
+def _identity(x):
+    return x
+
+
+class TensorLoader:
+    """
+    Loader of a small dataset kept as contiguous tensors on the training
+    device (or in pinned host memory), producing batches by index slicing.
+    Without shuffling batches come in dataset order, as from a DataLoader
+    with shuffle=False, otherwise every epoch uses a new permutation drawn on
+    the storage device. If the base dataset has a batch_transform (decoded
+    uint8 images), the images are stored before it and it is applied to every
+    batch, so that random augmentations differ between epochs. Other random
+    transforms would be frozen in the stored tensors and are not supported.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        batch_size,
+        shuffle=False,
+        device="cpu",
+        pin_memory=False,
+        drop_last=False,
+        generator=None,
+        num_workers=0,
+    ):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.device = torch.device(device)
+        self.drop_last = drop_last
+
+        base = _base_dataset(dataset)
+        self.batch_transform = getattr(base, "batch_transform", None)
+        if self.batch_transform is not None:
+            # Stored as uint8 images, transformed batch by batch
+            raw_base = copy.copy(base)
+            raw_base.batch_transform = _identity
+            if hasattr(raw_base, "tensor_transform"):
+                raw_base.tensor_transform = _identity
+            dataset = _with_base(dataset, raw_base)
+        elif _is_random(getattr(base, "transform", None)):
+            raise ValueError(
+                f"Random transform of {type(base).__name__} would be applied only "
+                "once to the stored tensors"
+            )
+
+        # Read all examples once, in dataset order
+        tensors = None
+        for batch in data.DataLoader(
+            dataset, batch_size=1024, shuffle=False, num_workers=num_workers
+        ):
+            if tensors is None:
+                tensors = [[] for _ in batch]
+            for stored, x in zip(tensors, batch):
+                stored.append(torch.as_tensor(x))
+        self.pin_memory = pin_memory and self.device.type != "cpu"
+        storage_device = "cpu" if self.pin_memory else self.device
+        self.tensors = []
+        for stored in tensors:
+            tensor = torch.cat(stored).to(storage_device)
+            self.tensors.append(tensor.pin_memory() if self.pin_memory else tensor)
+
+        # Seed of permutations drawn from given generator, if any
+        seed = torch.randint(2 ** 62, [1], generator=generator).item()
+        self.generator = torch.Generator(device=storage_device).manual_seed(seed)
+
+    def with_shuffle(self, shuffle):
+        """Loader over the same stored tensors with other shuffling"""
+        loader = copy.copy(self)
+        loader.shuffle = shuffle
+        return loader
+
+    def __len__(self):
+        n_examples = len(self.tensors[0])
+        if self.drop_last:
+            return n_examples // self.batch_size
+        return math.ceil(n_examples / self.batch_size)
+
+    def __iter__(self):
+        n_examples = len(self.tensors[0])
+        if self.shuffle:
+            order = torch.randperm(
+                n_examples, device=self.generator.device, generator=self.generator
+            )
+        for i in range(len(self)):
+            start = i * self.batch_size
+            end = min(start + self.batch_size, n_examples)
+            if self.shuffle:
+                batch = [tensor[order[start:end]] for tensor in self.tensors]
+            else:
+                batch = [tensor[start:end] for tensor in self.tensors]
+            if self.pin_memory:
+                batch = [x.to(self.device, non_blocking=True) for x in batch]
+            if self.batch_transform is not None:
+                batch[0] = self.batch_transform(batch[0])
+            yield batch
@@ -0,0 +1,197 @@
+import os
+import queue
+import shutil
+import threading
+
+import numpy as np
+import torch
+import torch.utils.data as data
+
+from .wrapper import FlatIndexDataset
+
+
+def _uint8_batch(batch):
+    """Collate (image, label) pairs into uint8 CHW images and int64 labels"""
+    images = []
+    for img, _ in batch:
+        img = np.asarray(img, dtype=np.uint8)
+        images.append(img[None] if img.ndim == 2 else img.transpose(2, 0, 1))
+    labels = np.array([int(label) for _, label in batch], dtype=np.int64)
+    return np.stack(images), labels
+
+
+def write_shards(dataset, root, shard_size=10000, num_workers=0):
+    """
+    Save images of dataset (PIL images or HWC uint8 arrays with labels) as
+    uint8 shards of shard_size examples, shard_XXXXX.npy, with an index.npz
+    holding labels of all examples and sizes of shards. Only one shard is kept
+    in memory while writing.
+    """
+    tmp_root = f"{root}.{os.getpid()}.tmp"
+    os.makedirs(tmp_root, exist_ok=True)
+    loader = data.DataLoader(
+        dataset,
+        batch_size=min(shard_size, 256),
+        num_workers=num_workers,
+        collate_fn=_uint8_batch,
+    )
+    labels = []
+    shard_sizes = []
+    pending = []
+
+    def flush(images):
+        np.save(os.path.join(tmp_root, f"shard_{len(shard_sizes):05d}.npy"), images)
+        shard_sizes.append(len(images))
+
+    for idx, (images, batch_labels) in enumerate(loader):
+        labels.append(batch_labels)
+        pending.append(images)
+        n_pending = sum(len(images) for images in pending)
+        if n_pending >= shard_size:
+            images = np.concatenate(pending)
+            flush(images[:shard_size])
+            pending = [images[shard_size:]]
+        print(f"{idx}/{len(loader)} sharded")
+    if sum(len(images) for images in pending):
+        flush(np.concatenate(pending))
+    np.savez(
+        os.path.join(tmp_root, "index.npz"),
+        labels=np.concatenate(labels),
+        shard_sizes=np.array(shard_sizes, dtype=np.int64),
+    )
+    try:
+        os.rename(tmp_root, root)
+    except OSError:
+        # Written by a concurrent run in the meantime
+        shutil.rmtree(tmp_root, ignore_errors=True)
+
+
+class ShardedDataset(data.IterableDataset):
+    """
+    Dataset streamed from uint8 shards saved by write_shards. Shards are read
+    one at a time by a background thread into a buffer of at most prefetch
+    shards, so memory use does not depend on the size of the dataset. With
+    shuffling, the order of shards and the order of examples within every
+    shard change every epoch. Subsets for tasks are created from the label
+    index only, see subset().
+    """
+
+    def __init__(self, root, transform=None, shuffle=False, prefetch=2, seed=0):
+        super(ShardedDataset, self).__init__()
+        self.root = root
+        self.transform = transform
+        self.shuffle = shuffle
+        self.prefetch = prefetch
+        self.seed = seed
+        self.epoch = 0
+        self.name = None
+        with np.load(os.path.join(root, "index.npz")) as index:
+            self.all_labels = torch.from_numpy(index["labels"])
+            shard_sizes = index["shard_sizes"]
+        self.shard_offsets = np.concatenate([[0], np.cumsum(shard_sizes)])
+        self.indices = torch.arange(len(self.all_labels))
+        self.labels = self.all_labels
+        self.number_classes = len(torch.unique(self.all_labels))
+
+    def subset(self, indices, name=None):
+        """
+        Dataset of examples with given indices into this dataset, returning
+        name of the task with every example if it is given
+        """
+        subset = self.with_shuffle(self.shuffle)
+        subset.dataset = self
+        subset.name = name
+        subset.indices = self.indices[torch.as_tensor(indices).long()]
+        subset.labels = self.all_labels[subset.indices]
+        return subset
+
+    def with_shuffle(self, shuffle):
+        """The same examples with other shuffling"""
+        dataset = object.__new__(type(self))
+        dataset.__dict__.update(self.__dict__)
+        dataset.shuffle = shuffle
+        return dataset
+
+    def __len__(self):
+        return len(self.indices)
+
+    def _load_shard(self, shard):
+        return np.load(
+            os.path.join(self.root, f"shard_{shard:05d}.npy"), mmap_mode="r"
+        )
+
+    def _sample(self, img, label):
+        img = torch.from_numpy(np.array(img))
+        if self.transform is not None:
+            img = self.transform(img)
+        if self.name is None:
+            return img, label
+        return img, label, self.name
+
+    def __getitem__(self, index):
+        """Random access to a single example, e.g. to read the image shape"""
+        example = int(self.indices[index])
+        shard = int(np.searchsorted(self.shard_offsets, example, side="right")) - 1
+        img = self._load_shard(shard)[example - self.shard_offsets[shard]]
+        return self._sample(img, int(self.all_labels[example]))
+
+    def _shard_rows(self, generator):
+        """Shards with rows of examples of this dataset, in order of reading"""
+        examples = self.indices.sort()[0].numpy()
+        shards = np.searchsorted(self.shard_offsets, examples, side="right") - 1
+        bounds = np.searchsorted(shards, np.arange(len(self.shard_offsets)))
+        shard_rows = [
+            (shard, examples[bounds[shard] : bounds[shard + 1]])
+            for shard in range(len(self.shard_offsets) - 1)
+            if bounds[shard + 1] > bounds[shard]
+        ]
+        if self.shuffle:
+            order = torch.randperm(len(shard_rows), generator=generator).tolist()
+            shard_rows = [shard_rows[i] for i in order]
+        return shard_rows
+
+    def __iter__(self):
+        worker_info = data.get_worker_info()
+        if worker_info is None:
+            seed = self.seed + self.epoch
+            self.epoch += 1
+        else:
+            # Copies of the dataset in workers are recreated every epoch, base
+            # seed of the workers is the same in all of them and new each epoch
+            seed = worker_info.seed - worker_info.id
+        generator = torch.Generator().manual_seed(seed)
+        shard_rows = self._shard_rows(generator)
+        if worker_info is not None:
+            shard_rows = shard_rows[worker_info.id :: worker_info.num_workers]
+        buffer = queue.Queue(maxsize=self.prefetch)
+
+        def read_shards():
+            for shard, examples in shard_rows:
+                rows = examples - self.shard_offsets[shard]
+                buffer.put((np.asarray(self._load_shard(shard)[rows]), examples))
+            buffer.put(None)
+
+        reader = threading.Thread(target=read_shards, daemon=True)
+        reader.start()
+        while True:
+            item = buffer.get()
+            if item is None:
+                break
+            images, examples = item
+            order = (
+                torch.randperm(len(examples), generator=generator).tolist()
+                if self.shuffle
+                else range(len(examples))
+            )
+            for i in order:
+                yield self._sample(images[i], int(self.all_labels[examples[i]]))
+        reader.join()
+
+
+def stream_split(split):
+    """
+    Stream examples of a task split built by data_split over a ShardedDataset,
+    reading only the shards holding examples of the task
+    """
+    flat = FlatIndexDataset(split)
+    return flat.dataset.subset(flat.indices, name=flat.name)
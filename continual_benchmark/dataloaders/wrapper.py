@@ -1,3 +1,5 @@
+import hashlib
+import os
 from os import path
 from copy import deepcopy
 
@@ -5,21 +7,104 @@ import torch
 import torch.utils.data as data
 
 
+def fast_labels(dataset):
+    """
+    Labels read directly from targets, samples or tensors of the dataset,
+    None if the dataset does not expose them
+    """
+    if getattr(dataset, 'target_transform', None) is not None:
+        return None
+    if isinstance(dataset, data.ConcatDataset):
+        labels = [fast_labels(d) for d in dataset.datasets]
+        if any(l is None for l in labels):
+            return None
+        return torch.cat(labels)
+    if hasattr(dataset, 'targets'):
+        return torch.as_tensor(dataset.targets).long().flatten()
+    if hasattr(dataset, 'samples'):
+        return torch.LongTensor([target for _, target in dataset.samples])
+    if isinstance(dataset, data.TensorDataset) and len(dataset.tensors) > 1:
+        return dataset.tensors[1].long().flatten()
+    return None
+
+
+def available_cpus():
+    """Number of CPUs this process may run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        # Linux only
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def dataset_indices(dataset):
+    """
+    Compose indices of nested Subset wrappers, returning indices of the examples
+    of dataset in the innermost dataset, together with that dataset
+    """
+    indices = None
+    while hasattr(dataset, 'dataset'):
+        if hasattr(dataset, 'indices'):
+            subset_indices = torch.as_tensor(dataset.indices).long()
+            indices = subset_indices if indices is None else subset_indices[indices]
+        dataset = dataset.dataset
+    if indices is None:
+        indices = torch.arange(len(dataset))
+    return indices, dataset
+
+
+def label_fingerprint(dataset, n_probes=64):
+    """
+    Hash of type, size, simple attributes (e.g. root, split) and targets of
+    evenly spaced examples of the dataset, together with paths, sizes and
+    modification times of all files under its root except label caches
+    """
+    key = hashlib.sha1()
+    key.update(str(type(dataset)).encode())
+    key.update(str(len(dataset)).encode())
+    for name, value in sorted(vars(dataset).items()):
+        if isinstance(value, (str, int, float, bool)):
+            key.update(f'{name}={value}'.encode())
+    root = path.abspath(dataset.root)
+    key.update(root.encode())
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.startswith('labels_') or filename.endswith('.tmp'):
+                continue
+            file_path = path.join(dirpath, filename)
+            stat = os.stat(file_path)
+            relative_path = path.relpath(file_path, root)
+            key.update(f'{relative_path}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    for i in torch.linspace(0, len(dataset) - 1, n_probes).long().unique().tolist():
+        key.update(str(int(dataset[i][1])).encode())
+    return key.hexdigest()
+
+
 class CacheClassLabel(data.Dataset):
     """
     A dataset wrapper that has a quick access to all labels of data.
     """
-    def __init__(self, dataset):
+    def __init__(self, dataset, num_workers=None):
         super(CacheClassLabel, self).__init__()
         self.dataset = dataset
-        self.labels = torch.LongTensor(len(dataset)).fill_(-1)
-        label_cache_filename = path.join(dataset.root, str(type(dataset))+'_'+str(len(dataset))+'.pth')
-        if path.exists(label_cache_filename):
-            self.labels = torch.load(label_cache_filename)
-        else:
-            for i, data in enumerate(dataset):
-                self.labels[i] = data[1]
-            torch.save(self.labels, label_cache_filename)
+        self.labels = fast_labels(dataset)
+        if self.labels is None:
+            label_cache_filename = path.join(
+                dataset.root, 'labels_' + label_fingerprint(dataset) + '.pth'
+            )
+            if path.exists(label_cache_filename):
+                self.labels = torch.load(label_cache_filename)
+            else:
+                # Decode examples in parallel workers just to read their targets
+                if num_workers is None:
+                    num_workers = available_cpus()
+                loader = data.DataLoader(
+                    dataset, batch_size=256, num_workers=num_workers
+                )
+                self.labels = torch.cat(
+                    [torch.as_tensor(batch[1]).long() for batch in loader]
+                )
+                torch.save(self.labels, label_cache_filename)
         self.number_classes = len(torch.unique(self.labels))
 
     def __len__(self):
@@ -94,6 +179,76 @@ class Subclass(data.Dataset):
         return img, target
 
 
+class FlatIndexDataset(data.Dataset):
+    """
+    A chain of Subset, Subclass, CacheClassLabel and AppendName wrappers (as
+    built by data_split and SplitGen) collapsed into one index array into the
+    innermost dataset, with label remapping, label offset and task name.
+    Batches are fetched with __getitems__, using a single batched read of the
+    innermost dataset if it supports one.
+    """
+    def __init__(self, dataset):
+        super(FlatIndexDataset, self).__init__()
+        self.indices = None
+        self.class_mapping = None
+        self.first_class_ind = 0
+        self.name = None
+        labels = None
+        level = dataset
+        while True:
+            if isinstance(level, AppendName):
+                if self.class_mapping is not None:
+                    raise ValueError('AppendName inside of Subclass is not supported')
+                self.first_class_ind += level.first_class_ind
+                self.name = level.name if self.name is None else self.name
+            elif isinstance(level, (data.Subset, Subclass)):
+                if isinstance(level, Subclass) and level.remap:
+                    if self.class_mapping is not None:
+                        raise ValueError('Nested Subclass wrappers are not supported')
+                    self.class_mapping = level.class_mapping
+                level_indices = torch.as_tensor(level.indices).long()
+                self.indices = (
+                    level_indices if self.indices is None else level_indices[self.indices])
+            elif isinstance(level, CacheClassLabel):
+                labels = level.labels
+            else:
+                break
+            level = level.dataset
+        self.dataset = level
+        if self.indices is None:
+            self.indices = torch.arange(len(level))
+        if labels is not None:
+            self.labels = labels[self.indices]
+            if self.class_mapping is not None:
+                self.labels = torch.LongTensor(
+                    [self.class_mapping[label] for label in self.labels.tolist()])
+            self.labels = self.labels + self.first_class_ind
+
+    def __len__(self):
+        return len(self.indices)
+
+    def _sample(self, img, target):
+        if self.class_mapping is not None:
+            raw_target = target.item() if isinstance(target, torch.Tensor) else target
+            target = self.class_mapping[raw_target]
+        target = target + self.first_class_ind
+        if self.name is None:
+            return img, target
+        return img, target, self.name
+
+    def __getitem__(self, index):
+        img, target = self.dataset[int(self.indices[index])]
+        return self._sample(img, target)
+
+    def __getitems__(self, indices):
+        base_indices = self.indices[indices].tolist()
+        if hasattr(self.dataset, '__getitems__'):
+            samples = self.dataset.__getitems__(base_indices)
+        else:
+            samples = [self.dataset[index] for index in base_indices]
+        return [self._sample(img, target) for img, target in samples]
+
+
 class Permutation(data.Dataset):
     """
     A dataset wrapper that permute the position of features
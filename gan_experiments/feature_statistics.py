@@ -0,0 +1,78 @@
+import numpy as np
+
+
+class RunningStatistics:
+    """
+    Mean and covariance of features accumulated batch by batch in float64,
+    merging batches with the parallel algorithm of Chan et al.
+    """
+
+    def __init__(self, dims):
+        self.dims = dims
+        self.n = 0
+        self.mean = np.zeros(dims, dtype=np.float64)
+        self.m2 = np.zeros((dims, dims), dtype=np.float64)
+
+    def update(self, features):
+        features = np.asarray(features, dtype=np.float64).reshape(-1, self.dims)
+        n_batch = len(features)
+        if not n_batch:
+            return
+        mean_batch = features.mean(axis=0)
+        centered = features - mean_batch
+        m2_batch = centered.T.dot(centered)
+
+        n = self.n + n_batch
+        delta = mean_batch - self.mean
+        self.mean = self.mean + delta * n_batch / n
+        self.m2 = self.m2 + m2_batch + np.outer(delta, delta) * self.n * n_batch / n
+        self.n = n
+
+    @property
+    def mu(self):
+        return self.mean
+
+    @property
+    def sigma(self):
+        """Unbiased covariance, the same as np.cov(features, rowvar=False)"""
+        return self.m2 / max(self.n - 1, 1)
+
+    @classmethod
+    def from_moments(cls, mu, sigma, n):
+        stats = cls(len(mu))
+        stats.n = int(n)
+        stats.mean = np.asarray(mu, dtype=np.float64)
+        stats.m2 = np.asarray(sigma, dtype=np.float64) * max(stats.n - 1, 1)
+        return stats
+
+
+class ReservoirSample:
+    """
+    Uniform sample of at most capacity feature vectors out of a stream of
+    batches (reservoir sampling, algorithm R)
+    """
+
+    def __init__(self, capacity, dims, seed=None):
+        self.capacity = capacity
+        self.dims = dims
+        self.n_seen = 0
+        self.sample = np.zeros((capacity, dims), dtype=np.float32)
+        self.rng = np.random.default_rng(seed)
+
+    def update(self, features):
+        features = np.asarray(features, dtype=np.float32).reshape(-1, self.dims)
+        n_fill = min(max(self.capacity - self.n_seen, 0), len(features))
+        if n_fill:
+            self.sample[self.n_seen : self.n_seen + n_fill] = features[:n_fill]
+        rest = features[n_fill:]
+        if len(rest):
+            # Position of every remaining feature in the stream decides its chance to be kept
+            positions = self.n_seen + n_fill + np.arange(len(rest))
+            slots = (self.rng.random(len(rest)) * (positions + 1)).astype(np.int64)
+            for idx in np.nonzero(slots < self.capacity)[0]:
+                self.sample[slots[idx]] = rest[idx]
+        self.n_seen += len(features)
+
+    @property
+    def data(self):
+        return self.sample[: min(self.n_seen, self.capacity)]
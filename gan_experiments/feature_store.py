@@ -0,0 +1,145 @@
+import contextlib
+import fcntl
+import hashlib
+import os
+
+import numpy as np
+import torch
+
+from continual_benchmark.dataloaders.wrapper import dataset_indices
+
+
+def _update_with_array(key, array):
+    array = array.detach().cpu().numpy() if torch.is_tensor(array) else array
+    array = np.ascontiguousarray(array)
+    key.update(str(array.dtype).encode())
+    key.update(str(array.shape).encode())
+    key.update(array.tobytes())
+
+
+def split_fingerprint(key, dataset):
+    """
+    Update hash with exact examples of the split: indices in the innermost
+    dataset, labels held by the wrappers, wrapper types and preprocessing
+    """
+    indices, base_dataset = dataset_indices(dataset)
+    # Reference statistics do not depend on the order of examples
+    _update_with_array(key, indices.long().sort()[0])
+    level = dataset
+    while True:
+        key.update(type(level).__name__.encode())
+        key.update(str(getattr(level, "first_class_ind", "")).encode())
+        for name in ["labels", "attr", "targets"]:
+            value = getattr(level, name, None)
+            if torch.is_tensor(value) or isinstance(value, np.ndarray):
+                _update_with_array(key, value)
+        if level is base_dataset:
+            break
+        level = level.dataset
+    key.update(str(len(base_dataset)).encode())
+    key.update(repr(getattr(base_dataset, "transform", None)).encode())
+    key.update(repr(getattr(base_dataset, "target_transform", None)).encode())
+
+
+def model_fingerprint(key, model):
+    """Update hash with names and values of all model weights"""
+    for name, tensor in model.state_dict().items():
+        key.update(name.encode())
+        _update_with_array(key, tensor)
+
+
+class FeatureStore:
+    """
+    Content-addressed store of reference feature statistics shared between
+    runs. Entries are written atomically and guarded by file locks, and the
+    least recently used entries are evicted when the store exceeds max_size_gb.
+    """
+
+    def __init__(self, root, max_size_gb=20.0):
+        self.root = root
+        self.max_size = int(max_size_gb * 2 ** 30)
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(dataset_name, dataset, model, **params):
+        """
+        Hash of dataset name, examples and preprocessing of the split, weights
+        of the scoring model and other parameters of the stored features
+        """
+        key = hashlib.sha1()
+        key.update(dataset_name.encode())
+        split_fingerprint(key, dataset)
+        if model is not None:
+            model_fingerprint(key, model)
+        key.update(str(sorted(params.items())).encode())
+        return key.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, f"{key}.npz")
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """
+        Exclusive lock of a single entry, so that concurrent runs compute the
+        features of a split only once
+        """
+        with open(os.path.join(self.root, f"{key}.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load(self, key):
+        path = self.path(key)
+        try:
+            # Modification time marks the last use for eviction
+            os.utime(path)
+            with np.load(path) as entry:
+                return {name: entry[name] for name in entry.files}
+        except FileNotFoundError:
+            return None
+
+    def save(self, key, **arrays):
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries above the size limit"""
+        with open(os.path.join(self.root, "store.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            entries = []
+            for file_name in os.listdir(self.root):
+                if not file_name.endswith(".npz") or ".tmp" in file_name:
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.root, file_name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, file_name))
+            total_size = sum(size for _, size, _ in entries)
+            for _, size, file_name in sorted(entries)[:-1]:
+                if total_size <= self.max_size:
+                    break
+                if self._remove_entry(file_name[: -len(".npz")]):
+                    total_size -= size
+
+    def _remove_entry(self, key):
+        """
+        Remove entry and its lock file, unless the entry is locked by a run
+        which is computing or loading it
+        """
+        lock_path = os.path.join(self.root, f"{key}.lock")
+        with open(lock_path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            print(f"Evicting reference features: {key}")
+            for path in [self.path(key), lock_path]:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+        return True
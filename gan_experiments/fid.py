@@ -11,6 +11,10 @@ def calculate_frechet_distance(distribution_1, distribution_2, eps=1e-6):
     mu2 = np.mean(distribution_2, axis=0)
     sigma2 = np.cov(distribution_2, rowvar=False)
 
+    return calculate_frechet_distance_from_moments(mu1, sigma1, mu2, sigma2, eps)
+
+
+def calculate_frechet_distance_from_moments(mu1, sigma1, mu2, sigma2, eps=1e-6):
     """Numpy implementation of the Frechet Distance.
     The Frechet distance between two multivariate Gaussians X_1 ~ N(mu_1, C_1)
     and X_2 ~ N(mu_2, C_2) is
@@ -64,3 +68,86 @@ def calculate_frechet_distance(distribution_1, distribution_2, eps=1e-6):
             np.trace(sigma2) - 2 * tr_covmean)
 
 
+class FrechetDistanceEngine:
+    """
+    Frechet distance against fixed reference statistics. For every reference a
+    symmetric eigendecomposition of its covariance is computed once and cached,
+    and the trace term is evaluated as
+            Tr(sqrt(C_1*C_2)) = Tr(sqrt(sqrt(C_2)*C_1*sqrt(C_2))),
+    where the right hand side is a symmetric PSD matrix, so eigvalsh can be used
+    instead of the general sqrtm. The torch backend evaluates several generated
+    covariances against their references in a single batched call.
+    """
+
+    def __init__(self, backend="numpy", device="cpu"):
+        assert backend in ["numpy", "torch"], f"Unknown FID backend: {backend}"
+        self.backend = backend
+        self.device = device
+        self.references = {}
+
+    def add_reference(self, key, mu, sigma):
+        """Factorize reference covariance, unless reference with this key is cached"""
+        if key in self.references:
+            return
+        sigma = np.atleast_2d(sigma).astype(np.float64)
+        eigenvalues, eigenvectors = linalg.eigh(sigma)
+        sqrt_sigma = (eigenvectors * np.sqrt(np.clip(eigenvalues, 0, None))).dot(
+            eigenvectors.T
+        )
+        mu = np.atleast_1d(mu).astype(np.float64)
+        if self.backend == "torch":
+            import torch
+
+            mu = torch.from_numpy(mu).to(self.device)
+            sqrt_sigma = torch.from_numpy(sqrt_sigma).to(self.device)
+        self.references[key] = (mu, sqrt_sigma, np.trace(sigma))
+
+    def distance(self, key, mu, sigma):
+        return self.distances([key], [mu], [sigma])[0]
+
+    def distances(self, keys, mus, sigmas):
+        """Frechet distances of all (mu, sigma) pairs to the references under keys"""
+        references = [self.references[key] for key in keys]
+        if self.backend == "torch":
+            import torch
+
+            mu_ref = torch.stack([mu for mu, _, _ in references])
+            sqrt_sigma_ref = torch.stack(
+                [sqrt_sigma for _, sqrt_sigma, _ in references]
+            )
+            trace_ref = torch.tensor(
+                [trace for _, _, trace in references],
+                dtype=torch.float64,
+                device=self.device,
+            )
+            mus = torch.stack(
+                [torch.as_tensor(mu, dtype=torch.float64) for mu in mus]
+            ).to(self.device)
+            sigmas = torch.stack(
+                [torch.as_tensor(sigma, dtype=torch.float64) for sigma in sigmas]
+            ).to(self.device)
+            product = sqrt_sigma_ref @ sigmas @ sqrt_sigma_ref
+            eigenvalues = torch.linalg.eigvalsh(product)
+            tr_covmean = torch.sqrt(torch.clamp(eigenvalues, min=0)).sum(-1)
+            diff = mus - mu_ref
+            results = (
+                (diff * diff).sum(-1)
+                + torch.diagonal(sigmas, dim1=-2, dim2=-1).sum(-1)
+                + trace_ref
+                - 2 * tr_covmean
+            )
+            return results.cpu().numpy().tolist()
+
+        results = []
+        for (mu_ref, sqrt_sigma_ref, trace_ref), mu, sigma in zip(
+            references, mus, sigmas
+        ):
+            sigma = np.atleast_2d(sigma).astype(np.float64)
+            diff = np.atleast_1d(mu) - mu_ref
+            product = sqrt_sigma_ref.dot(sigma).dot(sqrt_sigma_ref)
+            eigenvalues = linalg.eigvalsh(product)
+            tr_covmean = np.sqrt(np.clip(eigenvalues, 0, None)).sum()
+            results.append(
+                diff.dot(diff) + np.trace(sigma) + trace_ref - 2 * tr_covmean
+            )
+        return results
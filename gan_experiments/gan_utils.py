@@ -1,37 +1,80 @@
+import hashlib
+import os
+import queue
+import threading
+
 import numpy as np
 import torch
 import torch.autograd as autograd
 import wandb
 from matplotlib import pyplot as plt
 from mpl_toolkits.axes_grid1 import ImageGrid
-from torch import Tensor
-from torch.autograd import Variable
+
+from continual_benchmark.dataloaders.wrapper import dataset_indices
 
 
-def compute_gradient_penalty(D, real_samples, fake_samples, device, task_ids):
-    """Calculates the gradient penalty loss for WGAN GP"""
+def compute_gradient_penalty(
+    D, real_samples, fake_samples, device, task_ids, scaler=None
+):
+    """
+    Calculates the gradient penalty loss for WGAN GP. With an enabled fp16
+    GradScaler, the gradients are computed from the scaled critic output to
+    avoid underflow and unscaled before the penalty, which is computed in fp32.
+    """
     # Random weight term for interpolation between real and fake samples
-    alpha = Tensor(np.random.random((real_samples.size(0), 1, 1, 1))).to(device)
+    alpha = torch.rand(real_samples.size(0), 1, 1, 1, device=device)
     # Get random interpolation between real and fake samples
     interpolates = (alpha * real_samples + ((1 - alpha) * fake_samples)).requires_grad_(
         True
     )
     d_interpolates = D(interpolates, task_ids)
-    fake = Variable(
-        Tensor(real_samples.shape[0], 1).fill_(1.0), requires_grad=False
-    ).to(device)
+    scaled = scaler is not None and scaler.is_enabled()
+    if scaled:
+        d_interpolates = scaler.scale(d_interpolates)
     # Get gradient w.r.t. interpolates
     gradients = autograd.grad(
         outputs=d_interpolates,
         inputs=interpolates,
-        grad_outputs=fake,
+        grad_outputs=torch.ones_like(d_interpolates),
         create_graph=True,
         retain_graph=True,
         only_inputs=True,
     )[0]
+    gradients = gradients.float()
+    if scaled:
+        gradients = gradients / scaler.get_scale()
     gradients = gradients.view(gradients.size(0), -1)
-    gradient_penalty = ((gradients.norm(2, dim=1) - 1) ** 2).mean()
-    return gradient_penalty
+    return ((gradients.norm(2, dim=1) - 1) ** 2).mean()
+
+
+class PrecisionPolicy:
+    """
+    Precision of training: fp32, bf16 autocast (also on CPU) or fp16 autocast
+    with gradient scaling. Losses and other reductions are computed in fp32 by
+    the training functions, and optimizer states are kept in fp32.
+    """
+
+    def __init__(self, precision="fp32", device="cpu"):
+        if precision not in ["fp32", "bf16", "fp16"]:
+            raise ValueError(f"Unknown precision: {precision}")
+        self.precision = precision
+        self.device_type = torch.device(device).type
+        self.dtype = {"bf16": torch.bfloat16, "fp16": torch.float16}.get(precision)
+
+    def autocast(self):
+        return torch.autocast(
+            self.device_type,
+            dtype=self.dtype,
+            enabled=self.dtype is not None,
+        )
+
+    def grad_scaler(self):
+        """Scaler of losses of one optimizer, a no-op unless in fp16"""
+        enabled = self.precision == "fp16"
+        if hasattr(torch, "amp") and hasattr(torch.amp, "GradScaler"):
+            # Device-generic scaler of torch >= 2.3
+            return torch.amp.GradScaler(self.device_type, enabled=enabled)
+        return torch.cuda.amp.GradScaler(enabled=enabled)
 
 
 def weights_init_normal(m):
@@ -150,6 +193,270 @@ def generate_previous_data(
         return generations, random_noise, task_ids
 
 
+class ReplayPool:
+    """
+    Preallocated store of (generation, noise, task_id) triples sampled from the
+    frozen global generator. The pool is filled once per task (and optionally
+    refreshed) and then serves shuffled minibatches of replays, so that the
+    teacher does not have to be run on every batch of the global training.
+    """
+
+    def __init__(
+        self,
+        pool_size,
+        n_prev_tasks,
+        curr_global_generator,
+        class_table=None,
+        biggan_training=False,
+        chunk_size=1024,
+        mmap_path=None,
+    ):
+        """
+        :param pool_size: (int) Number of replays to store
+        :param n_prev_tasks: (int) Number of previous tasks to replay
+        :param curr_global_generator: Frozen global generator used as a teacher
+        :param class_table: (torch.Tensor) Class distribution of previous tasks
+        :param chunk_size: (int) Number of replays generated in one forward pass
+        :param mmap_path: (str) If given, the pool is stored in memory-mapped
+                          files with this path prefix on disk instead of on
+                          the generator's device
+        """
+        # Keep equal number of examples per task when class_table is not used
+        pool_size = max(pool_size - pool_size % n_prev_tasks, n_prev_tasks)
+        chunk_size = max(chunk_size - chunk_size % n_prev_tasks, n_prev_tasks)
+
+        self.pool_size = pool_size
+        self.n_prev_tasks = n_prev_tasks
+        self.curr_global_generator = curr_global_generator
+        self.class_table = class_table
+        self.biggan_training = biggan_training
+        self.chunk_size = chunk_size
+        self.mmap_path = mmap_path
+        self.device = curr_global_generator.device
+
+        img_shape = self._infer_img_shape()
+        latent_dim = curr_global_generator.latent_dim
+        if mmap_path is None:
+            self.examples = torch.empty(
+                [pool_size, *img_shape], device=self.device
+            )
+            self.noise = torch.empty([pool_size, latent_dim], device=self.device)
+            self.task_ids = torch.empty([pool_size], device=self.device)
+        else:
+            os.makedirs(os.path.dirname(mmap_path) or ".", exist_ok=True)
+            self.examples = self._memmap("examples", (pool_size, *img_shape))
+            self.noise = self._memmap("noise", (pool_size, latent_dim))
+            self.task_ids = self._memmap("task_ids", (pool_size,))
+
+        self.refresh()
+
+    def _memmap_filename(self, name):
+        return f"{self.mmap_path}_{name}.dat"
+
+    def _memmap(self, name, shape):
+        return torch.from_numpy(
+            np.memmap(
+                self._memmap_filename(name), dtype=np.float32, mode="w+", shape=shape
+            )
+        )
+
+    def close(self):
+        """Release the pool and remove its memory-mapped files, if any"""
+        self.examples = self.noise = self.task_ids = None
+        if self.mmap_path is not None:
+            for name in ["examples", "noise", "task_ids"]:
+                try:
+                    os.remove(self._memmap_filename(name))
+                except FileNotFoundError:
+                    pass
+
+    def _infer_img_shape(self):
+        generations, _, _ = generate_previous_data(
+            n_prev_tasks=self.n_prev_tasks,
+            n_prev_examples=self.n_prev_tasks,
+            curr_global_generator=self.curr_global_generator,
+            class_table=self.class_table,
+            biggan_training=self.biggan_training,
+        )
+        return tuple(generations.shape[1:])
+
+    def refresh(self):
+        """Resample the whole pool from the global generator"""
+        print(f"[Replay pool] Sampling {self.pool_size} replays")
+        filled = 0
+        while filled < self.pool_size:
+            n_examples = min(self.chunk_size, self.pool_size - filled)
+            generations, noise, task_ids = generate_previous_data(
+                n_prev_tasks=self.n_prev_tasks,
+                n_prev_examples=n_examples,
+                curr_global_generator=self.curr_global_generator,
+                class_table=self.class_table,
+                biggan_training=self.biggan_training,
+            )
+            self.examples[filled : filled + n_examples] = generations.to(
+                self.examples.device
+            )
+            self.noise[filled : filled + n_examples] = noise.to(self.noise.device)
+            self.task_ids[filled : filled + n_examples] = task_ids.float().to(
+                self.task_ids.device
+            )
+            filled += n_examples
+        self._permutation = torch.randperm(self.pool_size)
+        self._position = 0
+
+    def sample(self, n_examples):
+        """Return next shuffled minibatch of replays, reshuffling the pool when exhausted"""
+        if not n_examples:
+            return (
+                torch.Tensor().to(self.device),
+                torch.Tensor().to(self.device),
+                torch.Tensor().to(self.device),
+            )
+        if self._position + n_examples > self.pool_size:
+            self._permutation = torch.randperm(self.pool_size)
+            self._position = 0
+        idx = self._permutation[self._position : self._position + n_examples]
+        self._position += n_examples
+        if self.mmap_path is None:
+            idx = idx.to(self.device)
+        return (
+            self.examples[idx].to(self.device),
+            self.noise[idx].to(self.device),
+            self.task_ids[idx].to(self.device),
+        )
+
+
+class MetricLogger:
+    """
+    Logger of scalar training metrics without a device sync on every step.
+    Metrics of every step are kept as detached device tensors and copied to
+    host together every flush_every steps, then logged to wandb step by step
+    by a background thread fed through a queue of at most max_pending flushes.
+    """
+
+    def __init__(self, flush_every=100, max_pending=4):
+        self.flush_every = max(flush_every, 1)
+        self.steps = []
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._log_records, daemon=True)
+        self.thread.start()
+
+    def _log_records(self):
+        while True:
+            records = self.queue.get()
+            if records is None:
+                break
+            for record in records:
+                try:
+                    wandb.log(record)
+                except Exception as e:
+                    print(f"Logging metrics failed: {e}")
+
+    def log(self, metrics):
+        """Add metrics of a single step, tensors are copied to host later"""
+        self.steps.append(
+            {
+                name: value.detach() if torch.is_tensor(value) else value
+                for name, value in metrics.items()
+            }
+        )
+        if len(self.steps) >= self.flush_every:
+            self.flush()
+
+    def log_now(self, metrics):
+        """Log metrics (e.g. images) right after the pending steps"""
+        self.flush()
+        self.queue.put([metrics])
+
+    def flush(self):
+        if not self.steps:
+            return
+        tensors = [
+            value.float().reshape([])
+            for step in self.steps
+            for value in step.values()
+            if torch.is_tensor(value)
+        ]
+        # Single copy of metrics of all pending steps
+        values = iter(torch.stack(tensors).cpu().tolist() if tensors else [])
+        records = [
+            {
+                name: np.round(next(values), 3) if torch.is_tensor(value) else value
+                for name, value in step.items()
+            }
+            for step in self.steps
+        ]
+        self.steps = []
+        self.queue.put(records)
+
+    def close(self):
+        """Log pending metrics and wait until all of them are logged"""
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+
+class AnomalyMonitor:
+    """
+    Check of losses and gradients for non-finite values every check_every
+    steps (never if check_every is 0). A step with a non-finite value is run
+    again from the same random state under torch.autograd.detect_anomaly to
+    report the operation which produced it, and training is stopped.
+    """
+
+    def __init__(self, check_every=0, name="", device="cpu"):
+        self.check_every = check_every
+        self.name = name
+        self.device = torch.device(device)
+
+    def _rng_state(self):
+        state = [np.random.get_state(), torch.get_rng_state()]
+        if self.device.type == "cuda":
+            state.append(torch.cuda.get_rng_state(self.device))
+        return state
+
+    def _set_rng_state(self, state):
+        np.random.set_state(state[0])
+        torch.set_rng_state(state[1])
+        if self.device.type == "cuda":
+            torch.cuda.set_rng_state(state[2], self.device)
+
+    def run(self, step, step_fn, modules, scaler=None):
+        """
+        Run step_fn (forward and backward pass returning losses) before the
+        optimizer step, checking its losses and gradients of modules. With an
+        enabled GradScaler, non-finite values are left to the scaler (which
+        skips the optimizer step and lowers the scale) as long as they may
+        come from an overflow of the scaled values, i.e. while the scale is
+        above 1.
+        """
+        if not self.check_every or step % self.check_every:
+            return step_fn()
+        rng_state = self._rng_state()
+        losses = step_fn()
+        finite = [torch.isfinite(loss.detach()).all() for loss in losses] + [
+            torch.isfinite(param.grad).all()
+            for module in modules
+            for param in module.parameters()
+            if param.grad is not None
+        ]
+        # Single sync with the device
+        if torch.stack(finite).all():
+            return losses
+        if scaler is not None and scaler.is_enabled() and scaler.get_scale() > 1:
+            return losses
+
+        print(f"[{self.name}] Non-finite value at step {step}, rerunning the step")
+        for module in modules:
+            module.zero_grad()
+        self._set_rng_state(rng_state)
+        with torch.autograd.detect_anomaly():
+            step_fn()
+        raise FloatingPointError(
+            f"[{self.name}] Non-finite loss or gradient at step {step}"
+        )
+
+
 def optimize_noise(
     images,
     generator,
@@ -159,7 +466,23 @@ def optimize_noise(
     log=False,
     labels=None,
     biggan_training=False,
+    tolerance=0.0,
+    patience=0,
+    min_delta=1e-3,
+    init_noise=None,
+    precision="fp32",
 ):
+    """
+    Optimize noise so that the generator reconstructs given images, starting
+    from init_noise if given or from random noise otherwise. With bf16 or fp16
+    precision only the generator runs under autocast, reconstruction losses,
+    noise and its optimizer state stay in fp32.
+    Reconstruction loss is tracked separately for each example. An example is
+    frozen when its loss drops below tolerance, or when it has not improved by
+    a relative min_delta for patience iterations (patience=0 disables it).
+    Frozen examples are removed from the optimized batch, and the optimization
+    stops as soon as all of them are frozen.
+    """
     generator.eval()
 
     images = images.to(generator.device)
@@ -171,24 +494,43 @@ def optimize_noise(
     if biggan_training:
         task_ids = generator.shared(task_ids.long())
 
-    criterion = torch.nn.MSELoss()
-
-    noise = torch.randn(len(images), generator.latent_dim).to(generator.device)
+    if init_noise is None:
+        noise = torch.randn(len(images), generator.latent_dim).to(generator.device)
+    else:
+        noise = init_noise.detach().clone().to(generator.device)
     noise.requires_grad = True
 
+    # Examples that are still optimized, with their best loss so far
+    active_idx = torch.arange(len(images), device=generator.device)
+    best_loss = torch.full([len(images)], float("inf"), device=generator.device)
+    n_not_improved = torch.zeros(
+        [len(images)], dtype=torch.long, device=generator.device
+    )
+    final_noise = noise.detach().clone()
+
+    precision_policy = PrecisionPolicy(precision, generator.device)
+    scaler = precision_policy.grad_scaler()
     optimizer = torch.optim.Adam([noise], lr=lr)
     for i in range(n_iterations):
         optimizer.zero_grad()
-        generations = generator(noise, task_ids)
-        loss = criterion(generations, images)
+        with precision_policy.autocast():
+            generations = generator(noise, task_ids[active_idx])
+        sample_loss = (
+            ((generations.float() - images[active_idx]) ** 2)
+            .view(len(active_idx), -1)
+            .mean(1)
+        )
+        # Normalized by the full batch so that gradients do not change when examples are frozen
+        loss = sample_loss.sum() / len(images)
         if biggan_training:
-            loss.backward(retain_graph=True)
+            scaler.scale(loss).backward(retain_graph=True)
         else:
-            loss.backward()
-        optimizer.step()
+            scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
         if i % 100 == 0:
             print(
-                f"[Noise optimization] [Epoch {i}/{n_iterations}] [Loss: {loss.item():.3f}]"
+                f"[Noise optimization] [Epoch {i}/{n_iterations}] [Loss: {loss.item():.3f}] [Active: {len(active_idx)}/{len(images)}]"
             )
 
         if log:
@@ -198,4 +540,190 @@ def optimize_noise(
                 }
             )
 
-    return noise
+        if not tolerance and not patience:
+            continue
+
+        sample_loss = sample_loss.detach()
+        improved = sample_loss < best_loss[active_idx] * (1 - min_delta)
+        best_loss[active_idx] = torch.min(best_loss[active_idx], sample_loss)
+        n_not_improved[active_idx] = torch.where(
+            improved,
+            torch.zeros_like(n_not_improved[active_idx]),
+            n_not_improved[active_idx] + 1,
+        )
+        converged = sample_loss < tolerance
+        if patience:
+            converged |= n_not_improved[active_idx] >= patience
+        if converged.any():
+            # Freeze converged examples and shrink optimized batch together with Adam state
+            final_noise[active_idx[converged]] = noise.detach()[converged]
+            keep = ~converged
+            active_idx = active_idx[keep]
+            if not len(active_idx):
+                print(
+                    f"[Noise optimization] All examples converged after {i + 1} iterations"
+                )
+                break
+            state = optimizer.state[noise]
+            noise = noise.detach()[keep].requires_grad_(True)
+            optimizer = torch.optim.Adam([noise], lr=lr)
+            # Empty if the fp16 scaler has skipped all steps so far
+            if state:
+                optimizer.state[noise] = {
+                    "step": state["step"],
+                    "exp_avg": state["exp_avg"][keep],
+                    "exp_avg_sq": state["exp_avg_sq"][keep],
+                }
+    else:
+        i = n_iterations - 1
+
+    if len(active_idx):
+        final_noise[active_idx] = noise.detach()
+    n_converged = len(images) - len(active_idx)
+    print(
+        f"[Noise optimization] [Iterations: {i + 1}/{n_iterations}] [Converged: {n_converged}/{len(images)}]"
+    )
+    if log:
+        wandb.log(
+            {
+                f"noise_optimization_iterations/task_{task_id}": i + 1,
+                f"noise_optimization_converged/task_{task_id}": n_converged
+                / len(images),
+            }
+        )
+
+    return final_noise
+
+
+def latent_cache_key(generator, task_loader, encoder=None, **hparams):
+    """
+    Hash of generator (and encoder) weights, task split indices and inversion
+    hyperparameters
+    """
+    key = hashlib.sha1()
+    for model in [generator, encoder]:
+        if model is None:
+            continue
+        for name, tensor in model.state_dict().items():
+            key.update(name.encode())
+            key.update(tensor.detach().cpu().numpy().tobytes())
+    indices, base_dataset = dataset_indices(task_loader.dataset)
+    key.update(str(type(base_dataset)).encode())
+    key.update(str(len(base_dataset)).encode())
+    key.update(indices.numpy().astype(np.int64).tobytes())
+    key.update(str(sorted(hparams.items())).encode())
+    return key.hexdigest()
+
+
+def optimize_noise_for_task(
+    task_loader,
+    generator,
+    n_iterations,
+    task_id,
+    lr,
+    chunk_size=2048,
+    log=False,
+    class_cond=False,
+    biggan_training=False,
+    cache_dir=None,
+    tolerance=0.0,
+    patience=0,
+    min_delta=1e-3,
+    encoder=None,
+    precision="fp32",
+):
+    """
+    Invert whole task split into the latent space of the generator. Batches of
+    the loader are gathered into chunks of chunk_size examples (or the whole
+    split if chunk_size <= 0), and each chunk is optimized with a single call to
+    optimize_noise (see it for tolerance, patience and min_delta). If encoder
+    is given, its predictions are used as the initial noise. Returns one tensor
+    of latents aligned with the order of the task_loader, so the loader must
+    not shuffle the data.
+    If cache_dir is given, latents are stored there in a memory-mapped .npy file
+    keyed by the generator weights, data split and hyperparameters, and loaded
+    from it without optimization when the same inversion is requested again.
+    """
+    if cache_dir is not None:
+        cache_path = os.path.join(
+            cache_dir,
+            latent_cache_key(
+                generator,
+                task_loader,
+                n_iterations=n_iterations,
+                task_id=task_id,
+                lr=lr,
+                chunk_size=chunk_size,
+                class_cond=class_cond,
+                biggan_training=biggan_training,
+                encoder=encoder,
+                tolerance=tolerance,
+                patience=patience,
+                min_delta=min_delta,
+                precision=precision,
+            )
+            + ".npy",
+        )
+        if os.path.exists(cache_path):
+            print(f"[Noise optimization] Loading cached latents from: {cache_path}")
+            return torch.from_numpy(np.load(cache_path, mmap_mode="c"))
+
+    noise_all = []
+    images_chunk, labels_chunk = [], []
+    n_chunk = 0
+
+    def optimize_chunk(first_chunk):
+        images = torch.cat(images_chunk)
+        labels = torch.cat(labels_chunk) if class_cond else None
+        init_noise = None
+        if encoder is not None:
+            with torch.no_grad():
+                init_noise = encoder(
+                    images.to(encoder.device),
+                    (torch.zeros([len(images)]) + task_id).to(encoder.device)
+                    if labels is None
+                    else labels.to(encoder.device),
+                )
+        noise = optimize_noise(
+            images,
+            generator,
+            n_iterations,
+            task_id,
+            lr=lr,
+            log=log and first_chunk,
+            labels=labels,
+            biggan_training=biggan_training,
+            tolerance=tolerance,
+            patience=patience,
+            min_delta=min_delta,
+            init_noise=init_noise,
+            precision=precision,
+        )
+        noise_all.append(noise.detach())
+
+    for batch in task_loader:
+        images_chunk.append(batch[0])
+        labels_chunk.append(batch[1])
+        n_chunk += len(batch[0])
+        if 0 < chunk_size <= n_chunk:
+            optimize_chunk(first_chunk=not noise_all)
+            images_chunk, labels_chunk = [], []
+            n_chunk = 0
+    if n_chunk:
+        optimize_chunk(first_chunk=not noise_all)
+    noise_all = torch.cat(noise_all)
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Write to temporary file first so that concurrent runs never read partial cache
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        cached_noise = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.float32, shape=tuple(noise_all.shape)
+        )
+        cached_noise[:] = noise_all.cpu().numpy()
+        cached_noise.flush()
+        del cached_noise
+        os.replace(tmp_path, cache_path)
+        print(f"[Noise optimization] Latents cached in: {cache_path}")
+
+    return noise_all
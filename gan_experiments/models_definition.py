@@ -543,3 +543,53 @@ class Translator(nn.Module):
         x = torch.cat([x, task_id], dim=1)
         out = self.fc(x)
         return out
+
+
+class Encoder(nn.Module):
+    """
+    Lightweight inverse network of the Generator, predicting noise that the
+    generator maps to a given image. Used to initialize noise optimization.
+    """
+
+    def __init__(
+        self, latent_dim, img_shape, device, num_features, num_embeddings, embedding_dim
+    ):
+        super(Encoder, self).__init__()
+        self.latent_dim = latent_dim
+        self.img_shape = img_shape
+        self.device = device
+
+        def encoder_block(in_filters, out_filters):
+            return [
+                nn.Conv2d(
+                    in_filters,
+                    out_filters,
+                    kernel_size=(4, 4),
+                    stride=(2, 2),
+                    padding=1,
+                    bias=False,
+                ),
+                nn.BatchNorm2d(out_filters),
+                nn.LeakyReLU(0.2, inplace=True),
+            ]
+
+        self.model = nn.Sequential(
+            *encoder_block(img_shape[0], num_features),
+            *encoder_block(num_features, num_features * 2),
+            *encoder_block(num_features * 2, num_features * 4),
+            nn.AdaptiveAvgPool2d(1),
+        )
+
+        self.task_embedding = nn.Embedding(
+            num_embeddings=num_embeddings, embedding_dim=embedding_dim
+        )
+        self.fc = nn.Sequential(
+            nn.Linear(num_features * 4 + embedding_dim, latent_dim * 4),
+            nn.LeakyReLU(0.2),
+            nn.Linear(latent_dim * 4, latent_dim),
+        )
+
+    def forward(self, img, task_id):
+        out = self.model(img).view(img.shape[0], -1)
+        task_id = self.task_embedding(task_id.long().to(self.device))
+        return self.fc(torch.cat([out, task_id], dim=1))
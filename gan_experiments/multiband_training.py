@@ -32,8 +32,24 @@ def train_multiband_gan(
     class_cond=False,
     class_table=None,
     num_classes=None,
+    class_histogram=None,
     local_GD=None,
     only_generations=False,
+    replay_pool_size=0,
+    replay_pool_refresh=0,
+    replay_pool_dir=None,
+    noise_optim_batch_size=2048,
+    noise_cache_dir=None,
+    noise_optim_tolerance=0.0,
+    noise_optim_patience=0,
+    noise_optim_min_delta=1e-3,
+    encoder_iterations=0,
+    encoder_lr=0.001,
+    metrics_flush_every=100,
+    anomaly_check_every=0,
+    precision="fp32",
+    gp_every=1,
+    gp_batch_fraction=1.0,
 ):
     print(f"Started training local GAN model on task nr {task_id}")
     tmp_table = training_functions.train_local(
@@ -53,12 +69,31 @@ def train_multiband_gan(
         b2=local_b2,
         class_cond=class_cond,
         num_classes=num_classes,
+        class_histogram=class_histogram,
+        metrics_flush_every=metrics_flush_every,
+        anomaly_check_every=anomaly_check_every,
+        precision=precision,
+        gp_every=gp_every,
+        gp_batch_fraction=gp_batch_fraction,
     )
     print(f"Done training local GAN model on task nr {task_id}")
     if class_table is not None:
         class_table[task_id] = tmp_table
         local_generator.class_table = tmp_table
     curr_global_discriminator = copy.deepcopy(local_discriminator)
+    encoder = None
+    if task_id and encoder_iterations and not only_generations:
+        print(f"Started training encoder on task nr {task_id}")
+        encoder = training_functions.train_encoder(
+            local_generator=local_generator,
+            task_id=task_id,
+            n_iterations=encoder_iterations,
+            lr=encoder_lr,
+            class_cond=class_cond,
+            class_table=class_table,
+            biggan_training=(local_GD is not None),
+        )
+        print(f"Done training encoder on task nr {task_id}")
     if not task_id:
         curr_global_generator = copy.deepcopy(local_generator)
     else:
@@ -81,6 +116,18 @@ def train_multiband_gan(
         class_table=class_table,
         biggan_training=(local_GD is not None),
         only_generations=only_generations,
+        replay_pool_size=replay_pool_size,
+        replay_pool_refresh=replay_pool_refresh,
+        replay_pool_dir=replay_pool_dir,
+        noise_optim_batch_size=noise_optim_batch_size,
+        noise_cache_dir=noise_cache_dir,
+        noise_optim_tolerance=noise_optim_tolerance,
+        noise_optim_patience=noise_optim_patience,
+        noise_optim_min_delta=noise_optim_min_delta,
+        encoder=encoder,
+        anomaly_check_every=anomaly_check_every,
+        precision=precision,
+        metrics_flush_every=metrics_flush_every,
     )
 
         print(f"Done training global GAN model on task nr {task_id}")
@@ -6,6 +6,8 @@
 #   - default dpi changed from 150 to 300
 #   - added handling of cases where P = Q, where precision/recall may be
 #     just above 1, leading to errors for the f_beta computation
+#   - added compute_prd_from_embedding_torch, running all k-means fits as one
+#     batched k-means in torch
 #
 # Copyright 2018 Google LLC & Hwalsuk Lee.
 #
@@ -40,6 +42,7 @@ from __future__ import print_function
 from matplotlib import pyplot as plt
 import numpy as np
 import sklearn.cluster
+import torch
 
 
 def compute_prd(eval_dist, ref_dist, num_angles=1001, epsilon=1e-10):
@@ -176,6 +179,200 @@ def compute_prd_from_embedding(eval_data, ref_data, num_clusters=20,
     return precision, recall
 
 
+def _squared_distances(x, centers):
+    """Squared distances [num_fits, len(x), num_centers] of points x to the
+    centers of all fits, computed with matrix products.
+    """
+    dists = ((x ** 2).sum(-1)[None, :, None]
+             - 2 * torch.matmul(x[None], centers.transpose(1, 2))
+             + (centers ** 2).sum(-1)[:, None, :])
+    return dists.clamp(min=0)
+
+
+def _kmeans_plus_plus(fetch_rows, n_points, num_clusters, num_fits,
+                      sample_size=10000):
+    """Batched k-means++ initialization of num_fits independent k-means fits.
+    Centers are drawn from a random subset of at most sample_size points.
+    """
+    points = fetch_rows(torch.randperm(n_points)[:sample_size].sort()[0])
+    first = torch.randint(len(points), [num_fits], device=points.device)
+    centers = points[first][:, None]
+    min_dists = _squared_distances(points, centers)[..., 0]
+    for _ in range(1, num_clusters):
+        chosen = torch.multinomial(min_dists + 1e-12, 1)
+        centers = torch.cat([centers, points[chosen]], dim=1)
+        min_dists = torch.min(min_dists,
+                              _squared_distances(points, centers[:, -1:])[..., 0])
+    return centers
+
+
+def _batched_kmeans(fetch_rows, n_points, num_clusters, num_fits, max_iter=100,
+                    tol=1e-4, block_size=4096, minibatch_size=None,
+                    max_no_improvement=10):
+    """Fits num_fits independent k-means on the same data in one batched run.
+    Distances are computed in blocks of block_size points. If minibatch_size is
+    set, centers are updated on random minibatches of points as in
+    MiniBatchKMeans, so only the sampled rows are fetched in every step.
+    Iterations stop early when no center of any fit moves by more than tol
+    (squared distance) or, with minibatches, when the smoothed minibatch inertia
+    of no fit has improved for max_no_improvement steps, as in MiniBatchKMeans.
+    Args:
+      fetch_rows: Function returning a float tensor with the given (sorted) rows
+                  of the data on the k-means device.
+      n_points: Number of data points.
+      num_clusters: Number of cluster centers to fit.
+      num_fits: Number of independent fits.
+    Returns:
+      labels: Tensor of shape [num_fits, n_points] with cluster assignments.
+      inertia: Tensor of shape [num_fits] with the sums of squared distances of
+               the points to their closest centers.
+    """
+    centers = _kmeans_plus_plus(fetch_rows, n_points, num_clusters, num_fits)
+    counts = torch.zeros(num_fits, num_clusters, device=centers.device)
+
+    def cluster_sums(x):
+        min_dists, labels = _squared_distances(x, centers).min(-1)
+        one_hot = torch.nn.functional.one_hot(labels, num_clusters).to(x.dtype)
+        return (torch.einsum('bnk,nd->bkd', one_hot, x), one_hot.sum(1),
+                min_dists.sum(1))
+
+    if minibatch_size is not None:
+        # Weight of a minibatch in the moving average of the inertia
+        alpha = min(2 * minibatch_size / (n_points + 1), 1.0)
+        ewa_inertia = None
+        no_improvement = torch.zeros(num_fits, device=centers.device)
+
+    for _ in range(max_iter):
+        if minibatch_size is None:
+            sums = torch.zeros_like(centers)
+            new_counts = torch.zeros_like(counts)
+            for start in range(0, n_points, block_size):
+                block_sums, block_counts, _ = cluster_sums(fetch_rows(
+                    torch.arange(start, min(start + block_size, n_points))))
+                sums += block_sums
+                new_counts += block_counts
+            # Empty clusters keep their previous centers
+            new_centers = torch.where(new_counts[..., None] > 0,
+                                      sums / new_counts.clamp(min=1)[..., None],
+                                      centers)
+        else:
+            sums, new_counts, batch_inertia = cluster_sums(fetch_rows(
+                torch.randint(n_points, [minibatch_size]).sort()[0]))
+            batch_inertia = batch_inertia / minibatch_size
+            if ewa_inertia is None:
+                ewa_inertia = best_inertia = batch_inertia
+            else:
+                ewa_inertia = ewa_inertia * (1 - alpha) + batch_inertia * alpha
+                improved = ewa_inertia < best_inertia
+                best_inertia = torch.where(improved, ewa_inertia, best_inertia)
+                no_improvement = torch.where(improved,
+                                             torch.zeros_like(no_improvement),
+                                             no_improvement + 1)
+            counts += new_counts
+            # Per-center learning rate of 1 / number of points assigned so far
+            rate = (new_counts / counts.clamp(min=1))[..., None]
+            new_centers = centers + rate * (
+                sums / new_counts.clamp(min=1)[..., None] - centers)
+        shift = ((new_centers - centers) ** 2).sum(-1).max()
+        centers = new_centers
+        converged = shift <= tol
+        if minibatch_size is not None:
+            converged |= (no_improvement >= max_no_improvement).all()
+        if converged:
+            break
+
+    labels = []
+    inertia = torch.zeros(num_fits, device=centers.device)
+    for start in range(0, n_points, block_size):
+        x = fetch_rows(torch.arange(start, min(start + block_size, n_points)))
+        min_dists, block_labels = _squared_distances(x, centers).min(-1)
+        labels.append(block_labels)
+        inertia += min_dists.sum(1)
+    return torch.cat(labels, dim=1), inertia
+
+
+def compute_prd_from_embedding_torch(eval_data, ref_data, num_clusters=20,
+                                     num_angles=1001, num_runs=10, n_init=10,
+                                     enforce_balance=True, device='cpu',
+                                     block_size=4096, minibatch_size=1024):
+    """Computes PRD data from sample embeddings with k-means in torch.
+    Same as compute_prd_from_embedding, but the num_runs x n_init k-means fits
+    are run together as one batched k-means on the given device. In every run
+    the fit with the lowest inertia is kept, as with n_init in sklearn.
+    As in MiniBatchKMeans, centers are fitted on minibatches of minibatch_size
+    points, set it to None for full-batch Lloyd iterations. eval_data and
+    ref_data may be memory-mapped arrays: only the rows of every minibatch and
+    blocks of block_size rows are fetched, so the data is never loaded at once.
+    Args:
+      eval_data: NumPy array of data points from the distribution to be evaluated.
+      ref_data: NumPy array of data points from the reference distribution.
+      num_clusters: Number of cluster centers to fit. The default value is 20.
+      num_angles: Number of angles for which to compute PRD. Must be in [3, 1e6].
+                  The default value is 1001.
+      num_runs: Number of independent runs over which to average the PRD data.
+      n_init: Number of k-means initializations in every run.
+      enforce_balance: If enabled, throws exception if eval_data and ref_data do
+                       not have the same length. The default value is True.
+      device: Torch device on which k-means is computed.
+      block_size: Number of points for which distances are computed at once.
+      minibatch_size: Number of points in every k-means update, None to use all
+                      points. The default value is 1024.
+    Returns:
+      precision: NumPy array of shape [num_angles] with the precision for the
+                 different ratios.
+      recall: NumPy array of shape [num_angles] with the recall for the different
+              ratios.
+    Raises:
+      ValueError: If len(eval_data) != len(ref_data) and enforce_balance is set to
+                  True.
+    """
+
+    if enforce_balance and len(eval_data) != len(ref_data):
+        raise ValueError(
+            'The number of points in eval_data %d is not equal to the number of '
+            'points in ref_data %d. To disable this exception, set enforce_balance '
+            'to False (not recommended).' % (len(eval_data), len(ref_data)))
+
+    n_eval = len(eval_data)
+    n_points = n_eval + len(ref_data)
+
+    def fetch_rows(idx):
+        # Rows of the stacked eval_data and ref_data, without stacking them
+        idx = idx.numpy()
+        split = np.searchsorted(idx, n_eval)
+        rows = np.concatenate([np.asarray(eval_data[idx[:split]]),
+                               np.asarray(ref_data[idx[split:] - n_eval])])
+        return torch.as_tensor(rows, dtype=torch.float32, device=device)
+
+    labels, inertia = _batched_kmeans(fetch_rows, n_points, num_clusters,
+                                      num_runs * n_init, block_size=block_size,
+                                      minibatch_size=minibatch_size)
+    best_fit = inertia.view(num_runs, n_init).argmin(1)
+    labels = labels.view(num_runs, n_init, n_points)[
+        torch.arange(num_runs, device=labels.device), best_fit]
+
+    # Same as np.histogram with density=True over bins of width 1
+    def bins(part_labels):
+        counts = torch.zeros(num_runs, num_clusters, dtype=torch.float64,
+                             device=labels.device)
+        counts.scatter_add_(1, part_labels, torch.ones(
+            part_labels.shape, dtype=torch.float64, device=labels.device))
+        return (counts / part_labels.shape[1]).cpu().numpy()
+
+    eval_bins = bins(labels[:, :n_eval])
+    ref_bins = bins(labels[:, n_eval:])
+
+    precisions = []
+    recalls = []
+    for eval_dist, ref_dist in zip(eval_bins, ref_bins):
+        precision, recall = compute_prd(eval_dist, ref_dist, num_angles)
+        precisions.append(precision)
+        recalls.append(recall)
+    precision = np.mean(precisions, axis=0)
+    recall = np.mean(recalls, axis=0)
+    return precision, recall
+
+
 def _prd_to_f_beta(precision, recall, beta=1, epsilon=1e-10):
     """Computes F_beta scores for the given precision/recall values.
     The F_beta scores for all precision/recall pairs will be computed and
@@ -1,16 +1,13 @@
 import copy
+import os
 
 import numpy as np
 import torch
 import wandb
 from matplotlib import pyplot as plt
-from torch import Tensor
-from torch.autograd import Variable
 import torch.nn.functional as F
 
-from gan_experiments import gan_utils
-
-torch.autograd.set_detect_anomaly(True)
+from gan_experiments import gan_utils, models_definition
 
 
 def train_local_biggan(
@@ -24,26 +21,43 @@ def train_local_biggan(
     n_critic_steps,
     class_cond=False,
     num_classes=None,
+    class_histogram=None,
+    metrics_flush_every=100,
+    anomaly_check_every=0,
+    precision="fp32",
 ):
     # Create batch of latent vectors that we will use to visualize
     # the progression of the generator
     fixed_noise = torch.randn(
         num_gen_images, local_generator.latent_dim, device=local_generator.device
     )
-
-    table_tmp = torch.zeros(num_classes, dtype=torch.long)
+    metric_logger = gan_utils.MetricLogger(flush_every=metrics_flush_every)
+    anomaly_monitor = gan_utils.AnomalyMonitor(
+        anomaly_check_every, name=f"Local task {task_id}", device=local_generator.device
+    )
+    precision_policy = gan_utils.PrecisionPolicy(precision, local_generator.device)
+    scaler_d = precision_policy.grad_scaler()
+    scaler_g = precision_policy.grad_scaler()
+
+    # Count classes in the first epoch unless known from the split manifest
+    count_classes = class_histogram is None
+    table_tmp = (
+        torch.zeros(num_classes, dtype=torch.long)
+        if count_classes
+        else class_histogram.clone().long()
+    )
 
     for epoch in range(n_epochs):
         local_generator.train()
         local_discriminator.train()
 
         for i, batch in enumerate(task_loader):
-            if not epoch:
+            if not epoch and count_classes:
                 class_counter = torch.unique(batch[1], return_counts=True)
                 table_tmp[class_counter[0]] += class_counter[1].cpu()
 
             # Configure input
-            real_imgs = Variable(batch[0].type(Tensor)).to(local_generator.device)
+            real_imgs = batch[0].to(local_generator.device, torch.float)
             if not class_cond:
                 task_ids = (torch.zeros([len(batch[0])]) + task_id).to(
                     local_generator.device
@@ -58,30 +72,38 @@ def train_local_biggan(
             #  Train Discriminator (Critic)
             # ---------------------
 
-            local_discriminator.optim.zero_grad()
-
             # Sample noise as generator input
-            z = Variable(
-                Tensor(
-                    np.random.normal(
-                        0, 1, (real_imgs.shape[0], local_generator.latent_dim)
+            z = torch.randn(
+                real_imgs.shape[0],
+                local_generator.latent_dim,
+                device=local_generator.device,
+            )
+
+            def critic_step():
+                local_discriminator.optim.zero_grad()
+
+                with precision_policy.autocast():
+                    d_output_fake, d_output_real = local_GD(
+                        z, task_ids.long(), real_imgs, task_ids.long(), train_G=False
                     )
-                )
-            ).to(local_generator.device)
 
-            d_output_fake, d_output_real = local_GD(
-                z, task_ids.long(), real_imgs, task_ids.long(), train_G=False
-            )
+                # Train on real images -> compare predictions to 1
+                d_loss_real = torch.mean(F.relu(1.0 - d_output_real.float()))
 
-            # Train on real images -> compare predictions to 1
-            d_loss_real = torch.mean(F.relu(1.0 - d_output_real))
+                # Train on fake images -> compare predictions to -1
+                d_loss_fake = torch.mean(F.relu(1.0 + d_output_fake.float()))
+                d_loss = d_loss_real + d_loss_fake
 
-            # Train on fake images -> compare predictions to -1
-            d_loss_fake = torch.mean(F.relu(1.0 + d_output_fake))
-            d_loss = d_loss_real + d_loss_fake
+                scaler_d.scale(d_loss).backward()
+                return d_loss, d_loss_fake, d_loss_real
 
-            d_loss.backward()
-            local_discriminator.optim.step()
+            # Step over all epochs for anomaly checks
+            step = epoch * len(task_loader) + i
+            d_loss, d_loss_fake, d_loss_real = anomaly_monitor.run(
+                step, critic_step, [local_discriminator], scaler_d
+            )
+            scaler_d.step(local_discriminator.optim)
+            scaler_d.update()
 
             # Train the generator every n_critic steps
             if i % n_critic_steps == 0:
@@ -89,34 +111,41 @@ def train_local_biggan(
                 #  Train Generator
                 # -----------------
 
-                local_generator.optim.zero_grad()
+                def generator_step():
+                    local_generator.optim.zero_grad()
 
-                # Loss measures generator's ability to fool the discriminator
-                # Train on fake images -> compare predictions to 1
-                d_output_fake = local_GD(z, task_ids.long(), train_G=True)
-                g_loss = -torch.mean(d_output_fake)
+                    # Loss measures generator's ability to fool the discriminator
+                    # Train on fake images -> compare predictions to 1
+                    with precision_policy.autocast():
+                        d_output_fake = local_GD(z, task_ids.long(), train_G=True)
+                    g_loss = -torch.mean(d_output_fake.float())
 
-                g_loss.backward()
-                local_generator.optim.step()
+                    scaler_g.scale(g_loss).backward()
+                    return (g_loss,)
+
+                (g_loss,) = anomaly_monitor.run(
+                    step, generator_step, [local_generator], scaler_g
+                )
+                scaler_g.step(local_generator.optim)
+                scaler_g.update()
 
                 if i % 40 == 0:
+                    d_loss_value, d_loss_fake_value, d_loss_real_value, g_loss_value = (
+                        torch.stack([d_loss, d_loss_fake, d_loss_real, g_loss]).tolist()
+                    )
                     print(
-                        f"[Local D] [Epoch {epoch + 1}/{n_epochs}] [Batch {i + 1}/{len(task_loader)}] [D loss: {d_loss.item():.3f}] [D loss fake: {d_loss_fake.item():.3f}] [D loss real: {d_loss_real.item():.3f}]"
+                        f"[Local D] [Epoch {epoch + 1}/{n_epochs}] [Batch {i + 1}/{len(task_loader)}] [D loss: {d_loss_value:.3f}] [D loss fake: {d_loss_fake_value:.3f}] [D loss real: {d_loss_real_value:.3f}]"
                     )
                     print(
-                        f"[Local G] [Epoch {epoch + 1}/{n_epochs}] [Batch {i + 1}/{len(task_loader)}] [G loss: {g_loss.item():.3f}]"
+                        f"[Local G] [Epoch {epoch + 1}/{n_epochs}] [Batch {i + 1}/{len(task_loader)}] [G loss: {g_loss_value:.3f}]"
                     )
 
-            wandb.log(
+            metric_logger.log(
                 {
-                    f"local_d_loss/task_{task_id}": np.round(d_loss.item(), 3),
-                    f"local_d_loss_fake/task_{task_id}": np.round(
-                        d_loss_fake.item(), 3
-                    ),
-                    f"local_d_loss_real/task_{task_id}": np.round(
-                        d_loss_real.item(), 3
-                    ),
-                    f"local_g_loss/task_{task_id}": np.round(g_loss.item(), 3),
+                    f"local_d_loss/task_{task_id}": d_loss,
+                    f"local_d_loss_fake/task_{task_id}": d_loss_fake,
+                    f"local_d_loss_real/task_{task_id}": d_loss_real,
+                    f"local_g_loss/task_{task_id}": g_loss,
                 }
             )
 
@@ -147,8 +176,11 @@ def train_local_biggan(
             generations = local_generator(
                 fixed_noise, local_generator.shared(task_ids.long())
             )
-            wandb.log({f"local_generations/task_{task_id}": wandb.Image(generations)})
+            metric_logger.log_now(
+                {f"local_generations/task_{task_id}": wandb.Image(generations)}
+            )
 
+    metric_logger.close()
     return table_tmp
 
 
@@ -168,7 +200,25 @@ def train_local_wgan_gp(
     b2,
     class_cond=False,
     num_classes=None,
+    class_histogram=None,
+    metrics_flush_every=100,
+    anomaly_check_every=0,
+    precision="fp32",
+    gp_every=1,
+    gp_batch_fraction=1.0,
 ):
+    """
+    Train the local WGAN-GP on a task. With gp_every > 1 the gradient penalty
+    is computed lazily, only every gp_every critic steps with its weight
+    multiplied by gp_every, and with gp_batch_fraction < 1 only on that
+    fraction of the examples of the batch.
+    """
+    if gp_every < 1:
+        raise ValueError(f"gp_every must be at least 1, got {gp_every}")
+    if not 0 < gp_batch_fraction <= 1:
+        raise ValueError(
+            f"gp_batch_fraction must be in (0, 1], got {gp_batch_fraction}"
+        )
     # Optimizers
     optimizer_g = torch.optim.Adam(
         local_generator.parameters(), lr=local_gen_lr, betas=(b1, b2)
@@ -192,18 +242,35 @@ def train_local_wgan_gp(
     fixed_noise = torch.randn(
         num_gen_images, local_generator.latent_dim, device=local_generator.device
     )
-
-    table_tmp = torch.zeros(num_classes, dtype=torch.long)
+    metric_logger = gan_utils.MetricLogger(flush_every=metrics_flush_every)
+    anomaly_monitor = gan_utils.AnomalyMonitor(
+        anomaly_check_every, name=f"Local task {task_id}", device=local_generator.device
+    )
+    precision_policy = gan_utils.PrecisionPolicy(precision, local_generator.device)
+    scaler_d = precision_policy.grad_scaler()
+    scaler_g = precision_policy.grad_scaler()
+
+    # Count classes in the first epoch unless known from the split manifest
+    count_classes = class_histogram is None
+    table_tmp = (
+        torch.zeros(num_classes, dtype=torch.long)
+        if count_classes
+        else class_histogram.clone().long()
+    )
+    # Critic steps over all epochs, counted for anomaly checks and the lazy
+    # gradient penalty
+    n_critic_iterations = 0
+    gradient_penalty = torch.zeros([], device=local_generator.device)
 
     for epoch in range(n_epochs):
         local_generator.train()
         for i, batch in enumerate(task_loader):
-            if not epoch:
+            if not epoch and count_classes:
                 class_counter = torch.unique(batch[1], return_counts=True)
                 table_tmp[class_counter[0]] += class_counter[1].cpu()
 
             # Configure input
-            real_imgs = Variable(batch[0].type(Tensor)).to(local_generator.device)
+            real_imgs = batch[0].to(local_generator.device, torch.float)
             if not class_cond:
                 task_ids = (torch.zeros([len(batch[0])]) + task_id).to(
                     local_generator.device
@@ -218,99 +285,162 @@ def train_local_wgan_gp(
             #  Train Discriminator (Critic)
             # ---------------------
 
-            optimizer_d.zero_grad()
-
             # Sample noise as generator input
-            z = Variable(
-                Tensor(
-                    np.random.normal(
-                        0, 1, (real_imgs.shape[0], local_generator.latent_dim)
+            z = torch.randn(
+                real_imgs.shape[0],
+                local_generator.latent_dim,
+                device=local_generator.device,
+            )
+
+            train_generator = i % n_critic_steps == 0
+            step = n_critic_iterations
+            regularize = step % gp_every == 0
+            n_critic_iterations += 1
+            # Output of the generator kept for its own step, see generator_step
+            generated = {}
+
+            def critic_step():
+                optimizer_d.zero_grad()
+
+                with precision_policy.autocast():
+                    # Generate a batch of images, keeping the graph of the
+                    # generator only if it is trained in this iteration
+                    with torch.set_grad_enabled(train_generator):
+                        fake_imgs = local_generator(z, task_ids)
+                    if train_generator:
+                        generated["fake_imgs"] = fake_imgs
+                    # Detach so the backward() will not reach the generator
+                    fake_imgs = fake_imgs.detach()
+
+                    # Single pass of the critic over real and fake images. The
+                    # critic normalizes every example separately, so its outputs
+                    # are the same as with separate passes
+                    d_output = local_discriminator(
+                        torch.cat([real_imgs, fake_imgs.float()]),
+                        torch.cat([task_ids, task_ids]) if class_cond else None,
                     )
+                    d_output_real, d_output_fake = d_output.split(len(real_imgs))
+
+                    # Train on real images -> compare predictions to 1
+                    d_loss_real = -torch.mean(d_output_real.float())
+                    # Train on fake images -> compare predictions to -1
+                    d_loss_fake = torch.mean(d_output_fake.float())
+
+                    # Gradient penalty, in its own pass since the double
+                    # backward through a pass fused with the interpolates would
+                    # run over the real and fake images as well. The batch is
+                    # random, so its first examples are a random subsample
+                    if regularize:
+                        n_gp = max(1, round(gp_batch_fraction * len(real_imgs)))
+                        gradient_penalty = gan_utils.compute_gradient_penalty(
+                            local_discriminator,
+                            real_imgs[:n_gp],
+                            fake_imgs[:n_gp].float(),
+                            local_generator.device,
+                            task_ids=task_ids[:n_gp] if class_cond else None,
+                            scaler=scaler_d,
+                        )
+                # Wasserstein distance
+                wasserstein_distance = -(d_loss_real + d_loss_fake)
+
+                # Adversarial loss
+                d_loss = d_loss_fake + d_loss_real
+                if not regularize:
+                    scaler_d.scale(d_loss).backward()
+                    return d_loss, d_loss_fake, d_loss_real, wasserstein_distance
+
+                # Lazy regularization: the penalty of every gp_every-th step
+                # is weighted for all steps since the previous one
+                d_loss = d_loss + lambda_gp * gp_every * gradient_penalty
+
+                scaler_d.scale(d_loss).backward()
+                return (
+                    d_loss,
+                    d_loss_fake,
+                    d_loss_real,
+                    wasserstein_distance,
+                    gradient_penalty,
                 )
-            ).to(local_generator.device)
-
-            # Generate a batch of images
-            fake_imgs = local_generator(z, task_ids)
-
-            # Add detach() so the backward() will not change the weights of generator
-            fake_imgs.detach()
-
-            # Train on real images -> compare predictions to 1
-            d_output_real = local_discriminator(
-                real_imgs, task_ids if class_cond else None
-            )
-            d_loss_real = -torch.mean(d_output_real)
 
-            # Train on fake images -> compare predictions to -1
-            d_output_fake = local_discriminator(
-                fake_imgs, task_ids if class_cond else None
-            )
-            d_loss_fake = torch.mean(d_output_fake)
-
-            # Gradient penalty
-            gradient_penalty = gan_utils.compute_gradient_penalty(
-                local_discriminator,
-                real_imgs.data,
-                fake_imgs.data,
-                local_generator.device,
-                task_ids=task_ids if class_cond else None,
+            critic_losses = anomaly_monitor.run(
+                step, critic_step, [local_discriminator], scaler_d
             )
-            # Wasserstein distance
-            wasserstein_distance = -(d_loss_real + d_loss_fake)
-
-            # Adversarial loss
-            d_loss = d_loss_fake + d_loss_real + lambda_gp * gradient_penalty
-
-            d_loss.backward()
-            optimizer_d.step()
+            d_loss, d_loss_fake, d_loss_real, wasserstein_distance = critic_losses[:4]
+            if regularize:
+                gradient_penalty = critic_losses[4]
+            scaler_d.step(optimizer_d)
+            scaler_d.update()
 
             optimizer_g.zero_grad()
 
             # Train the generator every n_critic steps
-            if i % n_critic_steps == 0:
+            if train_generator:
                 # -----------------
                 #  Train Generator
                 # -----------------
 
-                # Generate a batch of images
-                fake_imgs = local_generator(z, task_ids)
+                def generator_step():
+                    optimizer_g.zero_grad()
+
+                    with precision_policy.autocast():
+                        # The generator is not changed by the critic step, so
+                        # its output from the same noise is reused (generated
+                        # again only if the step is rerun by anomaly_monitor)
+                        fake_imgs = generated.pop("fake_imgs", None)
+                        if fake_imgs is None:
+                            fake_imgs = local_generator(z, task_ids)
+
+                        # Loss measures generator's ability to fool the discriminator
+                        # Train on fake images -> compare predictions to 1
+                        d_output_fake = local_discriminator(
+                            fake_imgs, task_ids if class_cond else None
+                        )
+                    g_loss = -torch.mean(d_output_fake.float())
 
-                # Loss measures generator's ability to fool the discriminator
-                # Train on fake images -> compare predictions to 1
-                d_output_fake = local_discriminator(
-                    fake_imgs, task_ids if class_cond else None
-                )
-                g_loss = -torch.mean(d_output_fake)
+                    scaler_g.scale(g_loss).backward()
+                    return (g_loss,)
 
-                g_loss.backward()
-                optimizer_g.step()
+                (g_loss,) = anomaly_monitor.run(
+                    step, generator_step, [local_generator], scaler_g
+                )
+                scaler_g.step(optimizer_g)
+                scaler_g.update()
 
                 if i % 40 == 0:
+                    (
+                        d_loss_value,
+                        d_loss_fake_value,
+                        d_loss_real_value,
+                        gradient_penalty_value,
+                        wasserstein_distance_value,
+                        g_loss_value,
+                    ) = torch.stack(
+                        [
+                            d_loss,
+                            d_loss_fake,
+                            d_loss_real,
+                            gradient_penalty,
+                            wasserstein_distance,
+                            g_loss,
+                        ]
+                    ).tolist()
                     print(
-                        f"[Local D] [Epoch {epoch + 1}/{n_epochs}] [Batch {i + 1}/{len(task_loader)}] [D loss: {d_loss.item():.3f}] [D loss fake: {d_loss_fake.item():.3f}] [D loss real: {d_loss_real.item():.3f}] [Gradient penalty: {gradient_penalty.item():.3f}] [Wasserstein distance: {wasserstein_distance.item():.3f}]"
+                        f"[Local D] [Epoch {epoch + 1}/{n_epochs}] [Batch {i + 1}/{len(task_loader)}] [D loss: {d_loss_value:.3f}] [D loss fake: {d_loss_fake_value:.3f}] [D loss real: {d_loss_real_value:.3f}] [Gradient penalty: {gradient_penalty_value:.3f}] [Wasserstein distance: {wasserstein_distance_value:.3f}]"
                     )
                     print(
-                        f"[Local G] [Epoch {epoch + 1}/{n_epochs}] [Batch {i + 1}/{len(task_loader)}] [G loss: {g_loss.item():.3f}]"
+                        f"[Local G] [Epoch {epoch + 1}/{n_epochs}] [Batch {i + 1}/{len(task_loader)}] [G loss: {g_loss_value:.3f}]"
                     )
 
-            wandb.log(
-                {
-                    f"local_d_loss/task_{task_id}": np.round(d_loss.item(), 3),
-                    f"local_d_loss_fake/task_{task_id}": np.round(
-                        d_loss_fake.item(), 3
-                    ),
-                    f"local_d_loss_real/task_{task_id}": np.round(
-                        d_loss_real.item(), 3
-                    ),
-                    f"local_g_loss/task_{task_id}": np.round(g_loss.item(), 3),
-                    f"local_gradient_penalty/task_{task_id}": np.round(
-                        gradient_penalty.item(), 3
-                    ),
-                    f"local_wasserstein_distance/task_{task_id}": np.round(
-                        wasserstein_distance.item(), 3
-                    ),
-                }
-            )
+            metrics = {
+                f"local_d_loss/task_{task_id}": d_loss,
+                f"local_d_loss_fake/task_{task_id}": d_loss_fake,
+                f"local_d_loss_real/task_{task_id}": d_loss_real,
+                f"local_g_loss/task_{task_id}": g_loss,
+                f"local_wasserstein_distance/task_{task_id}": wasserstein_distance,
+            }
+            if regularize:
+                metrics[f"local_gradient_penalty/task_{task_id}"] = gradient_penalty
+            metric_logger.log(metrics)
 
         if epoch % 50 == 0:
             local_generator.eval()
@@ -337,11 +467,14 @@ def train_local_wgan_gp(
                         ]
                     )
             generations = local_generator(fixed_noise, task_ids)
-            wandb.log({f"local_generations/task_{task_id}": wandb.Image(generations)})
+            metric_logger.log_now(
+                {f"local_generations/task_{task_id}": wandb.Image(generations)}
+            )
 
         scheduler_g.step()
         scheduler_d.step()
 
+    metric_logger.close()
     return table_tmp
 
 
@@ -362,6 +495,12 @@ def train_local(
     class_cond=False,
     num_classes=None,
     local_GD=None,
+    class_histogram=None,
+    metrics_flush_every=100,
+    anomaly_check_every=0,
+    precision="fp32",
+    gp_every=1,
+    gp_batch_fraction=1.0,
 ):
     local_generator.train()
     local_discriminator.train()
@@ -379,6 +518,10 @@ def train_local(
             n_critic_steps,
             class_cond,
             num_classes,
+            class_histogram,
+            metrics_flush_every,
+            anomaly_check_every,
+            precision,
         )
     else:
         return train_local_wgan_gp(
@@ -397,9 +540,81 @@ def train_local(
             b2,
             class_cond,
             num_classes,
+            class_histogram,
+            metrics_flush_every,
+            anomaly_check_every,
+            precision,
+            gp_every,
+            gp_batch_fraction,
         )
 
 
+def train_encoder(
+    local_generator,
+    task_id,
+    n_iterations,
+    lr,
+    batch_size=256,
+    num_features=32,
+    class_cond=False,
+    class_table=None,
+    biggan_training=False,
+):
+    """
+    Train encoder predicting noise of the frozen local generator on
+    (noise, generation) pairs sampled from it. Its predictions are used to
+    initialize noise optimization in global training.
+    """
+    local_generator.eval()
+    if class_cond:
+        class_sampler = torch.distributions.categorical.Categorical(
+            probs=class_table[task_id] * 1.0 / torch.sum(class_table[task_id])
+        )
+
+    def sample_pairs():
+        z = torch.randn(
+            batch_size, local_generator.latent_dim, device=local_generator.device
+        )
+        if class_cond:
+            task_ids = class_sampler.sample([batch_size]).float()
+        else:
+            task_ids = torch.zeros([batch_size]) + task_id
+        task_ids = task_ids.to(local_generator.device)
+        with torch.no_grad():
+            generations = local_generator(
+                z,
+                local_generator.shared(task_ids.long()) if biggan_training else task_ids,
+            )
+        return z, generations, task_ids
+
+    _, generations, _ = sample_pairs()
+    encoder = models_definition.Encoder(
+        latent_dim=local_generator.latent_dim,
+        img_shape=generations.shape[1:],
+        device=local_generator.device,
+        num_features=num_features,
+        num_embeddings=local_generator.translator.num_embeddings,
+        embedding_dim=local_generator.translator.embedding_dim,
+    ).to(local_generator.device)
+    encoder.train()
+
+    criterion = torch.nn.MSELoss()
+    optimizer = torch.optim.Adam(encoder.parameters(), lr=lr)
+    for i in range(n_iterations):
+        z, generations, task_ids = sample_pairs()
+        optimizer.zero_grad()
+        loss = criterion(encoder(generations, task_ids), z)
+        loss.backward()
+        optimizer.step()
+        if i % 100 == 0:
+            print(
+                f"[Encoder] [Iteration {i}/{n_iterations}] [Loss: {loss.item():.3f}]"
+            )
+
+    encoder.eval()
+    return encoder
+
+
 def train_global_generator(
     batch_size,
     task_id,
@@ -418,14 +633,34 @@ def train_global_generator(
     class_table=None,
     biggan_training=False,
     only_generations=False,
+    replay_pool_size=0,
+    replay_pool_refresh=0,
+    replay_pool_dir=None,
+    noise_optim_batch_size=2048,
+    noise_cache_dir=None,
+    noise_optim_tolerance=0.0,
+    noise_optim_patience=0,
+    noise_optim_min_delta=1e-3,
+    encoder=None,
+    anomaly_check_every=0,
+    precision="fp32",
+    metrics_flush_every=100,
 ):
     global_generator = copy.deepcopy(curr_global_generator)
     global_generator.to(curr_global_generator.device)
+    anomaly_monitor = gan_utils.AnomalyMonitor(
+        anomaly_check_every,
+        name=f"Global task {task_id}",
+        device=global_generator.device,
+    )
+    precision_policy = gan_utils.PrecisionPolicy(precision, global_generator.device)
+    scaler_g = precision_policy.grad_scaler()
     curr_local_generator.eval()
     curr_global_generator.eval()
     curr_global_generator.translator.eval()
 
     criterion = torch.nn.MSELoss()
+    metric_logger = gan_utils.MetricLogger(flush_every=metrics_flush_every)
 
     optimizer_g = torch.optim.Adam(
         global_generator.translator.parameters(), lr=global_gen_lr
@@ -443,7 +678,44 @@ def train_global_generator(
     # How many examples from all prev tasks we want to generate
     n_prev_examples = int(batch_size * min(task_id, 3) * limit_previous_examples)
 
-    curr_noise_all = []
+    # Sample replays of previous tasks once instead of regenerating them every batch
+    replay_pool = None
+    if replay_pool_size and n_prev_examples:
+        replay_pool = gan_utils.ReplayPool(
+            pool_size=max(replay_pool_size, n_prev_examples),
+            n_prev_tasks=task_id,
+            curr_global_generator=curr_global_generator,
+            class_table=class_table,
+            biggan_training=biggan_training,
+            # Files of every process are separate, so concurrent runs can share
+            # replay_pool_dir
+            mmap_path=os.path.join(
+                replay_pool_dir, f"replay_pool_{os.getpid()}_task_{task_id}"
+            )
+            if replay_pool_dir is not None
+            else None,
+        )
+
+    if not only_generations:
+        # Optimize noise for the whole task at once. task_loader is not shuffled,
+        # so latents of the consecutive batches are consecutive slices of this tensor
+        curr_noise_all = gan_utils.optimize_noise_for_task(
+            task_loader,
+            curr_local_generator,
+            num_epochs_noise_optim,
+            task_id,
+            lr=optim_noise_lr,
+            chunk_size=noise_optim_batch_size,
+            log=True,
+            class_cond=class_cond,
+            biggan_training=biggan_training,
+            cache_dir=noise_cache_dir,
+            tolerance=noise_optim_tolerance,
+            patience=noise_optim_patience,
+            min_delta=noise_optim_min_delta,
+            encoder=encoder,
+            precision=precision,
+        ).to(global_generator.device)
 
     for epoch in range(n_epochs):
         global_generator.train()
@@ -456,15 +728,29 @@ def train_global_generator(
                 optimizer_g, gamma=global_scheduler_rate
             )
 
+        if replay_pool is not None and replay_pool_refresh and epoch:
+            if epoch % replay_pool_refresh == 0:
+                replay_pool.refresh()
+
+        batch_start = 0
         for i, batch in enumerate(task_loader):
             # Generate data -> (noise, generation) pairs for each previous task
-            prev_examples, prev_noise, prev_task_ids = gan_utils.generate_previous_data(
-                n_prev_tasks=task_id,
-                n_prev_examples=n_prev_examples,
-                curr_global_generator=curr_global_generator,
-                class_table=class_table,
-                biggan_training=biggan_training,
-            )
+            if replay_pool is not None:
+                prev_examples, prev_noise, prev_task_ids = replay_pool.sample(
+                    n_prev_examples
+                )
+            else:
+                (
+                    prev_examples,
+                    prev_noise,
+                    prev_task_ids,
+                ) = gan_utils.generate_previous_data(
+                    n_prev_tasks=task_id,
+                    n_prev_examples=n_prev_examples,
+                    curr_global_generator=curr_global_generator,
+                    class_table=class_table,
+                    biggan_training=biggan_training,
+                )
             curr_labels = batch[1] if class_cond else None
             if not class_cond:
                 curr_task_ids = torch.zeros([len(batch[0])]) + task_id
@@ -473,20 +759,8 @@ def train_global_generator(
             if not only_generations:
                 # Real images and optimized noise of current task
                 curr_examples = batch[0]
-                if not epoch:
-                    curr_noise = gan_utils.optimize_noise(
-                        curr_examples,
-                        curr_local_generator,
-                        num_epochs_noise_optim,
-                        task_id,
-                        lr=optim_noise_lr,
-                        log=not i,  # log only first batch for readability
-                        labels=curr_labels,
-                        biggan_training=biggan_training,
-                    )
-                    curr_noise_all.append(curr_noise.to("cpu"))
-                else:
-                    curr_noise = curr_noise_all[i].to(global_generator.device)
+                curr_noise = curr_noise_all[batch_start : batch_start + len(batch[0])]
+                batch_start += len(batch[0])
             else:
                 curr_noise = torch.randn(
                     len(batch[0]),
@@ -509,40 +783,36 @@ def train_global_generator(
             noise_concat = noise_concat[shuffle]
             task_ids_concat = task_ids_concat[shuffle]
 
-            optimizer_g.zero_grad()
-
-            if biggan_training:
-                task_ids_concat = global_generator.shared(task_ids_concat.long())
-            global_generations = global_generator(noise_concat, task_ids_concat)
-            g_loss = criterion(global_generations, examples_concat)
-
-            g_loss.backward()
-            optimizer_g.step()
+            def generator_step():
+                optimizer_g.zero_grad()
+
+                with precision_policy.autocast():
+                    task_ids = task_ids_concat
+                    if biggan_training:
+                        task_ids = global_generator.shared(task_ids.long())
+                    global_generations = global_generator(noise_concat, task_ids)
+                # Reconstruction loss in fp32
+                g_loss = criterion(global_generations.float(), examples_concat.float())
+
+                scaler_g.scale(g_loss).backward()
+                return (g_loss,)
+
+            # Step over all epochs for anomaly checks
+            (g_loss,) = anomaly_monitor.run(
+                epoch * len(task_loader) + i,
+                generator_step,
+                [global_generator],
+                scaler_g,
+            )
+            scaler_g.step(optimizer_g)
+            scaler_g.update()
 
-            if i % 20 == 0 or not epoch:
+            if i % 20 == 0:
                 print(
                     f"[Global G] [Epoch {epoch + 1}/{n_epochs}] [Batch {i + 1}/{len(task_loader)}] [G loss: {g_loss.item():.3f}]"
                 )
 
-            if n_prev_examples:
-                wandb.log(
-                    {
-                        # f"prev_examples_task_{task_id}": wandb.Image(prev_examples),
-                        # f"global_generations_task_{task_id}": wandb.Image(
-                        #     global_generations
-                        # ),
-                        f"global_g_loss/task_{task_id}": np.round(g_loss.item(), 3),
-                    }
-                )
-            else:
-                wandb.log(
-                    {
-                        # f"global_generations_task_{task_id}": wandb.Image(
-                        #     global_generations
-                        # ),
-                        f"global_g_loss/task_{task_id}": np.round(g_loss.item(), 3),
-                    }
-                )
+            metric_logger.log({f"global_g_loss/task_{task_id}": g_loss})
 
         scheduler_g.step()
 
@@ -592,7 +862,7 @@ def train_global_generator(
                     fixed_noise,
                     task_ids,
                 )
-                wandb.log(
+                metric_logger.log_now(
                     {
                         f"global_generations/task_{task_id}_of_task_{learned_task_id}": wandb.Image(
                             generations
@@ -600,4 +870,7 @@ def train_global_generator(
                     }
                 )
 
+    metric_logger.close()
+    if replay_pool is not None:
+        replay_pool.close()
     return global_generator
@@ -3,8 +3,14 @@ import os
 import numpy as np
 import torch
 
-from gan_experiments.fid import calculate_frechet_distance
-from gan_experiments.prd import compute_prd_from_embedding, prd_to_max_f_beta_pair
+from gan_experiments.feature_statistics import RunningStatistics, ReservoirSample
+from gan_experiments.feature_store import FeatureStore
+from gan_experiments.fid import FrechetDistanceEngine
+from gan_experiments.prd import (
+    compute_prd_from_embedding,
+    compute_prd_from_embedding_torch,
+    prd_to_max_f_beta_pair,
+)
 from scipy.stats import wasserstein_distance
 
 
@@ -17,12 +23,28 @@ class Validator:
         stats_file_name,
         dataloaders,
         score_model_device=None,
+        prd_sample_size=10000,
+        fid_backend="numpy",
+        prd_backend="sklearn",
+        feature_store=None,
     ):
         self.n_classes = n_classes
         self.device = device
         self.dataset = dataset
         self.score_model_device = score_model_device
         self.dataloaders = dataloaders
+        # Number of feature vectors kept for precision and recall
+        self.prd_sample_size = prd_sample_size
+        # Caches factorization of reference covariances between evaluations
+        self.fid_engine = FrechetDistanceEngine(backend=fid_backend, device=device)
+        self.prd_backend = prd_backend
+        # Reference features shared between runs, keyed by split and scoring model
+        self.feature_store = (
+            feature_store
+            if feature_store is not None
+            else FeatureStore(os.path.join("results", "orig_stats"))
+        )
+        self.reference_keys = {}
 
         print("Preparing validator")
         if dataset in ["MNIST", "Omniglot"]:  # , "DoubleMNIST"]:
@@ -38,6 +60,7 @@ class Validator:
             net.to(device)
             net.eval()
             self.model = net
+            self.score_model = net
             self.dims = 128 if dataset  == "Omniglot" else 84
             self.score_model_func = net.part_forward
         elif dataset.lower() in [
@@ -57,11 +80,92 @@ class Validator:
             if score_model_device:
                 model = model.to(score_model_device)
             model.eval()
+            self.score_model = model
             self.score_model_func = lambda batch: model(
                 batch.to(score_model_device)
             )[0]
         self.stats_file_name = f"{stats_file_name}_dims_{self.dims}"
 
+    def reference_statistics(self, task_id):
+        """
+        Statistics of the features of original data of given task, loaded from
+        the feature store if the same split was already scored. Returns key of
+        the store entry, running statistics, sample of features for PRD and
+        labels of the original data.
+        """
+        test_loader = self.dataloaders[task_id]
+        if task_id not in self.reference_keys:
+            self.reference_keys[task_id] = self.feature_store.key(
+                self.dataset,
+                test_loader.dataset,
+                self.score_model,
+                dims=self.dims,
+                prd_sample_size=self.prd_sample_size,
+            )
+        key = self.reference_keys[task_id]
+
+        with self.feature_store.lock(key):
+            entry = self.feature_store.load(key)
+            if entry is not None:
+                print(f"Loading cached original data statistics: {key}")
+                stats_orig = RunningStatistics.from_moments(
+                    entry["mu"], entry["sigma"], entry["n"]
+                )
+                prd_sample_orig = entry["prd_sample"]
+                labels = entry["labels"]
+            else:
+                stats_orig = RunningStatistics(self.dims)
+                reservoir_orig = ReservoirSample(self.prd_sample_size, self.dims)
+                labels = []
+                with torch.no_grad():
+                    for idx, batch in enumerate(test_loader):
+                        x = batch[0].to(self.device)
+                        y = batch[1]
+                        labels.extend(y.numpy())
+
+                        if self.dataset.lower() in ["fashionmnist", "doublemnist"]:
+                            x = x.repeat([1, 3, 1, 1])
+                        features = self.score_model_func(x).cpu().detach().numpy()
+                        stats_orig.update(features)
+                        reservoir_orig.update(features)
+
+                        print(f"{idx}/{len(test_loader)} original distribution")
+
+                prd_sample_orig = reservoir_orig.data
+                labels = np.array(labels)
+                self.feature_store.save(
+                    key,
+                    mu=stats_orig.mu,
+                    sigma=stats_orig.sigma,
+                    n=stats_orig.n,
+                    prd_sample=prd_sample_orig,
+                    labels=labels,
+                )
+
+        self.fid_engine.add_reference(key, stats_orig.mu, stats_orig.sigma)
+        return key, stats_orig, prd_sample_orig, labels
+
+    def precision_recall(self, prd_sample_gen, prd_sample_orig):
+        num_data_for_prd = min(len(prd_sample_orig), len(prd_sample_gen))
+
+        eval_data = prd_sample_gen[
+            np.random.choice(len(prd_sample_gen), num_data_for_prd, replace=False)
+        ]
+        ref_data = prd_sample_orig[
+            np.random.choice(len(prd_sample_orig), num_data_for_prd, replace=False)
+        ]
+        if self.prd_backend == "torch":
+            precision, recall = compute_prd_from_embedding_torch(
+                eval_data=eval_data, ref_data=ref_data, device=self.device
+            )
+        else:
+            precision, recall = compute_prd_from_embedding(
+                eval_data=eval_data, ref_data=ref_data
+            )
+        precision, recall = prd_to_max_f_beta_pair(precision, recall)
+        print(f"Precision:{precision},recall: {recall}")
+        return precision, recall
+
     def calculate_results(
         self,
         curr_global_generator,
@@ -71,116 +175,143 @@ class Validator:
         class_cond=False,
         biggan_training=False,
     ):
-        curr_global_generator.eval()
+        results = self.calculate_results_all_tasks(
+            curr_global_generator=curr_global_generator,
+            task_ids=[task_id],
+            batch_size=batch_size,
+            calculate_class_dist=calculate_class_dist,
+            class_cond=class_cond,
+            biggan_training=biggan_training,
+        )[task_id]
+        return (
+            results["fid"],
+            results["precision"],
+            results["recall"],
+            results["generated_classes"],
+        )
 
-        test_loader = self.dataloaders[task_id]
+    def calculate_results_all_tasks(
+        self,
+        curr_global_generator,
+        task_ids,
+        batch_size,
+        calculate_class_dist=True,
+        class_cond=False,
+        biggan_training=False,
+        num_gen_images=0,
+    ):
+        """
+        Evaluate generator on all given tasks at once. Examples of all tasks are
+        generated in shuffled mixed-task batches, scored in one pass, and their
+        features are split per task. Returns dictionary {task_id: results} with
+        fid, precision, recall, generated_classes and first num_gen_images
+        generations of each task, e.g. for logging.
+        """
+        curr_global_generator.eval()
 
-        with torch.no_grad():
-            distribution_orig = []
-            distribution_gen = []
-            precalculated_statistics = False
-            os.makedirs(os.path.join("results", "orig_stats"), exist_ok=True)
-            stats_file_path = os.path.join(
-                "results",
-                "orig_stats",
-                f"{self.dataset}_{self.stats_file_name}_{task_id}_{class_cond}.npy",
+        if calculate_class_dist:
+            if self.dataset.lower() != "mnist":
+                raise NotImplementedError  # Missing classifier for this dataset
+
+        references = {
+            task_id: self.reference_statistics(task_id)
+            for task_id in task_ids
+        }
+
+        # Condition of every example to generate and task it is generated for
+        example_tasks = []
+        example_conditions = []
+        for task_id in task_ids:
+            _, stats_orig, _, labels = references[task_id]
+            example_tasks.append(
+                torch.zeros(stats_orig.n, dtype=torch.long) + task_id
             )
-            if os.path.exists(stats_file_path) and not class_cond:
-                print(
-                    f"Loading cached original data statistics from: {self.stats_file_name}"
-                )
-                distribution_orig = np.load(stats_file_path)
-                precalculated_statistics = True
-
-            print("Calculating FID...")
-            labels = []
-            if not precalculated_statistics or class_cond:
-                for idx, batch in enumerate(test_loader):
-                    x = batch[0].to(self.device)
-                    y = batch[1]
-                    labels.extend(y.numpy())
-                    
-                    if self.dataset.lower() in ["fashionmnist", "doublemnist"]:
-                        x = x.repeat([1, 3, 1, 1])
-                    distribution_orig.append(
-                        self.score_model_func(x).cpu().detach().numpy()
-                    )
-                    
-                    print(f"{idx}/{len(test_loader)} original distribution")
-
-                distribution_orig = np.array(np.concatenate(distribution_orig)).reshape(
-                    -1, self.dims
+            if class_cond:
+                example_conditions.append(
+                    torch.from_numpy(labels).reshape(-1).float()
                 )
-                np.save(stats_file_path, distribution_orig)
-
-            if calculate_class_dist:
-                if self.dataset.lower() != "mnist":
-                    raise NotImplementedError  # Missing classifier for this dataset
-            generated_classes = []
-
-            labels = torch.from_numpy(np.concatenate([labels]))
-            examples_to_generate = len(distribution_orig)
-            n_batches_generated = 0
-            while examples_to_generate:
-                n_batch_to_generate = min(batch_size, examples_to_generate)
+            else:
+                example_conditions.append(torch.zeros(stats_orig.n) + task_id)
+        shuffle = torch.randperm(sum(len(tasks) for tasks in example_tasks))
+        example_tasks = torch.cat(example_tasks)[shuffle]
+        example_conditions = torch.cat(example_conditions)[shuffle]
+
+        stats_gen = {task_id: RunningStatistics(self.dims) for task_id in task_ids}
+        reservoirs_gen = {
+            task_id: ReservoirSample(self.prd_sample_size, self.dims)
+            for task_id in task_ids
+        }
+        generated_classes = {task_id: [] for task_id in task_ids}
+        generations = {task_id: [] for task_id in task_ids}
+        n_logged = {task_id: 0 for task_id in task_ids}
+
+        print("Calculating FID...")
+        with torch.no_grad():
+            for start in range(0, len(example_tasks), batch_size):
+                batch_tasks = example_tasks[start : start + batch_size]
                 z = torch.randn(
-                    [n_batch_to_generate, curr_global_generator.latent_dim]
+                    [len(batch_tasks), curr_global_generator.latent_dim]
                 ).to(self.device)
-
-                if class_cond:
-                    curr_labels = labels[n_batches_generated*batch_size:(n_batches_generated*batch_size)+n_batch_to_generate].to(curr_global_generator.device)
-                    task_ids = torch.zeros(n_batch_to_generate).to(curr_global_generator.device) + torch.squeeze(curr_labels)
-                else:
-                    task_ids = torch.zeros(n_batch_to_generate) + task_id
+                conditions = example_conditions[start : start + batch_size].to(
+                    curr_global_generator.device
+                )
                 if biggan_training:
-                    task_ids = curr_global_generator.shared(task_ids.long())
-                example = curr_global_generator(z, task_ids)
+                    conditions = curr_global_generator.shared(conditions.long())
+                example = curr_global_generator(z, conditions)
+
+                for task_id in task_ids:
+                    if n_logged[task_id] < num_gen_images:
+                        task_examples = example[
+                            (batch_tasks == task_id).to(example.device)
+                        ][: num_gen_images - n_logged[task_id]]
+                        generations[task_id].append(task_examples.cpu())
+                        n_logged[task_id] += len(task_examples)
 
                 if self.dataset.lower() in ["fashionmnist", "doublemnist"]:
                     example = example.repeat([1, 3, 1, 1])
 
-                distribution_gen.append(self.score_model_func(example).cpu().detach())
-
+                features = self.score_model_func(example).cpu().detach().numpy()
                 if calculate_class_dist:
-                    generated_classes.append(
-                        self.model(example).cpu().detach().argmax(1)
-                    )
-
-                examples_to_generate -= n_batch_to_generate
-                n_batch_to_generate += 1
+                    classes = self.model(example).cpu().detach().argmax(1)
+
+                batch_tasks = batch_tasks.numpy()
+                for task_id in task_ids:
+                    mask = batch_tasks == task_id
+                    if not mask.any():
+                        continue
+                    stats_gen[task_id].update(features[mask])
+                    reservoirs_gen[task_id].update(features[mask])
+                    if calculate_class_dist:
+                        generated_classes[task_id].extend(
+                            classes[torch.from_numpy(mask)].tolist()
+                        )
+
+                examples_to_generate = len(example_tasks) - start - len(batch_tasks)
                 print(f"examples_to_generate: {examples_to_generate}")
-                
-            if calculate_class_dist:
-                generated_classes = [
-                    item.item() for sublist in generated_classes for item in sublist
-                ]
-            print("Classified generated classes")
-            distribution_gen = (
-                torch.cat(distribution_gen).numpy().reshape(-1, self.dims)
-            )
-            num_data_for_prd = min(len(distribution_orig), len(distribution_gen))
 
-            precision, recall = compute_prd_from_embedding(
-                eval_data=distribution_gen[
-                    np.random.choice(
-                        len(distribution_gen), num_data_for_prd, replace=False
-                    )
-                ],
-                ref_data=distribution_orig[
-                    np.random.choice(
-                        len(distribution_orig), num_data_for_prd, replace=False
-                    )
-                ],
+        # FID of all tasks in one batched call of the torch backend
+        fids = self.fid_engine.distances(
+            [references[task_id][0] for task_id in task_ids],
+            [stats_gen[task_id].mu for task_id in task_ids],
+            [stats_gen[task_id].sigma for task_id in task_ids],
+        )
+        results = {}
+        for task_id, fid in zip(task_ids, fids):
+            _, _, prd_sample_orig, _ = references[task_id]
+            precision, recall = self.precision_recall(
+                reservoirs_gen[task_id].data, prd_sample_orig
             )
-            precision, recall = prd_to_max_f_beta_pair(precision, recall)
-            print(f"Precision:{precision},recall: {recall}")
+            results[task_id] = {
+                "fid": fid,
+                "precision": precision,
+                "recall": recall,
+                "generated_classes": generated_classes[task_id],
+                "generations": torch.cat(generations[task_id])
+                if generations[task_id]
+                else torch.Tensor(),
+            }
 
-            return (
-                calculate_frechet_distance(distribution_gen, distribution_orig),
-                precision,
-                recall,
-                generated_classes,
-            )
+        return results
 
 
 # def compute_results_from_examples(self, args, generations, task_id, join_tasks=False):
@@ -268,10 +399,15 @@ class Validator:
 
 
 class CERN_Validator:
-    def __init__(self, dataloaders, stats_file_name, device):
+    def __init__(self, dataloaders, stats_file_name, device, feature_store=None):
         self.dataloaders = dataloaders
         self.stats_file_name = stats_file_name
         self.device = device
+        self.feature_store = (
+            feature_store
+            if feature_store is not None
+            else FeatureStore(os.path.join("results", "orig_stats"))
+        )
 
     def sum_channels_parallel(self, data):
         coords = np.ogrid[0 : data.shape[1], 0 : data.shape[2]]
@@ -324,17 +460,13 @@ class CERN_Validator:
             distribution_gen = []
 
             precalculated_statistics = False
-            os.makedirs(os.path.join("results", "orig_stats"), exist_ok=True)
-            stats_file_path = os.path.join(
-                "results",
-                "orig_stats",
-                f"CERN_{self.stats_file_name}_{task_id}.npy",
+            reference_key = self.feature_store.key(
+                "CERN", test_loader.dataset, None, statistic="sum_channels"
             )
-            if os.path.exists(stats_file_path):
-                print(
-                    f"Loading cached original data statistics from: {self.stats_file_name}"
-                )
-                distribution_orig = np.load(stats_file_path)
+            entry = self.feature_store.load(reference_key)
+            if entry is not None:
+                print(f"Loading cached original data statistics: {reference_key}")
+                distribution_orig = entry["distribution"]
                 precalculated_statistics = True
 
             print("Calculating CERN scores...")
@@ -370,7 +502,7 @@ class CERN_Validator:
             # distribution_gen = np.array(np.concatenate(distribution_gen)).reshape(-1, self.dims)
             if not precalculated_statistics:
                 distribution_orig = np.hstack(distribution_orig)
-                np.save(stats_file_path, distribution_orig)
+                self.feature_store.save(reference_key, distribution=distribution_orig)
 
             return (
                 wasserstein_distance(
@@ -381,6 +513,41 @@ class CERN_Validator:
                 []
             )
 
+    def calculate_results_all_tasks(
+        self,
+        curr_global_generator,
+        task_ids,
+        batch_size,
+        calculate_class_dist=False,
+        class_cond=False,
+        num_gen_images=0,
+    ):
+        """Same interface as Validator.calculate_results_all_tasks"""
+        results = {}
+        for task_id in task_ids:
+            fid, precision, recall, generated_classes = self.calculate_results(
+                curr_global_generator=curr_global_generator,
+                task_id=task_id,
+                batch_size=batch_size,
+                calculate_class_dist=calculate_class_dist,
+                class_cond=class_cond,
+            )
+            with torch.no_grad():
+                generations = curr_global_generator(
+                    torch.randn(num_gen_images, curr_global_generator.latent_dim).to(
+                        self.device
+                    ),
+                    (torch.zeros([num_gen_images]) + task_id).to(self.device),
+                ).cpu()
+            results[task_id] = {
+                "fid": fid,
+                "precision": precision,
+                "recall": recall,
+                "generated_classes": generated_classes,
+                "generations": generations,
+            }
+        return results
+
     # def compute_results_from_examples(
     #     self, args, generations, task_id, join_tasks=False
     # ):
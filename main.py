@@ -3,7 +3,6 @@ import copy
 import os
 import random
 import sys
-from glob import glob
 from collections import OrderedDict, Counter
 import numpy as np
 import torch
@@ -11,16 +10,24 @@ import torch.utils.data as data
 
 import continual_benchmark.dataloaders as dataloaders
 import continual_benchmark.dataloaders.base
+from continual_benchmark.dataloaders.base import FastCelebA
 from continual_benchmark.dataloaders.datasetGen import data_split
+from continual_benchmark.dataloaders.loader import TensorLoader
+from continual_benchmark.dataloaders.shards import ShardedDataset, stream_split
+from continual_benchmark.dataloaders.wrapper import FlatIndexDataset
 from gan_experiments import models_definition, gan_utils, multiband_training
+from gan_experiments.feature_store import FeatureStore
 from gan_experiments.validation import Validator, CERN_Validator
 from visualise import *
 from utils import count_parameters
 
 
 def run(args):
+    dataset_kwargs = (
+        {"batch_augment": args.batch_augment} if args.dataset.lower() == "flowers" else {}
+    )
     train_dataset, val_dataset = dataloaders.base.__dict__[args.dataset](
-        args.dataroot, args.skip_normalization, args.train_aug
+        args.dataroot, args.skip_normalization, args.train_aug, **dataset_kwargs
     )
 
     if args.dataset.lower() == "celeba":
@@ -48,6 +55,7 @@ def run(args):
         reverse=args.reverse,
         limit_classes=args.limit_classes,
         generator=torch_g,
+        manifest_dir=args.split_manifest_dir,
     )
     if args.dataset.lower() != "celeba":
         val_dataset_splits, _, _ = data_split(
@@ -62,6 +70,7 @@ def run(args):
             reverse=args.reverse,
             limit_classes=args.limit_classes,
             generator=torch_g,
+            manifest_dir=args.split_manifest_dir,
         )
 
     # Calculate constants
@@ -69,7 +78,7 @@ def run(args):
     for task_name, task in train_dataset_splits.items():
         labels_tasks[int(task_name)] = task.dataset.class_list
 
-    if hasattr(train_dataset.dataset, "classes"):
+    if hasattr(getattr(train_dataset, "dataset", None), "classes"):
         tasks_num_classes_dict = {
             task_id: [train_dataset.dataset.classes[i] for i in class_idxs[0]]
             if (args.dataset.lower() == "cifar100" and args.num_batches > 1)
@@ -142,35 +151,77 @@ def run(args):
         # Manually shuffle train dataset to disable shuffling by global DataLoader.
         # This way we are getting the same order of batches each epoch, thus we are
         # able to optimize noise during global training only in first epoch.
-        train_data_shuffle = torch.randperm(
-            len(train_dataset_splits[task_name].dataset)
-        )
+        if hasattr(train_dataset_splits[task_name], "shuffle"):
+            # Fixed shuffle saved in the split manifest
+            train_data_shuffle = train_dataset_splits[task_name].shuffle
+        else:
+            train_data_shuffle = torch.randperm(
+                len(train_dataset_splits[task_name].dataset)
+            )
         train_dataset_splits[task_name].dataset = data.Subset(
             dataset=train_dataset_splits[task_name].dataset, indices=train_data_shuffle
         )
-        global_train_dataset_loader = data.DataLoader(
-            dataset=train_dataset_splits[task_name],
-            batch_size=args.batch_size,
-            shuffle=False,
-            drop_last=False,
-            generator=torch_g,
-        )
+        # Single index array into the base dataset instead of nested wrappers
+        train_data = FlatIndexDataset(train_dataset_splits[task_name])
+        sharded = isinstance(train_data.dataset, ShardedDataset)
+        if sharded:
+            # Examples of the task streamed from shards in a fixed order
+            train_data = stream_split(train_dataset_splits[task_name])
+        if sharded and args.tensor_loader == "off":
+            global_train_dataset_loader = data.DataLoader(
+                dataset=train_data,
+                batch_size=args.batch_size,
+                num_workers=args.workers,
+            )
+            local_train_dataset_loader = data.DataLoader(
+                dataset=train_data.with_shuffle(True),
+                batch_size=args.batch_size,
+                num_workers=args.workers,
+            )
+        elif args.tensor_loader != "off":
+            # Whole task split stored once, batches sliced without DataLoader
+            global_train_dataset_loader = TensorLoader(
+                dataset=train_data,
+                batch_size=args.batch_size,
+                shuffle=False,
+                device=device,
+                pin_memory=args.tensor_loader == "pinned",
+                generator=torch_g,
+                num_workers=args.workers,
+            )
+            local_train_dataset_loader = global_train_dataset_loader.with_shuffle(True)
+        else:
+            global_train_dataset_loader = data.DataLoader(
+                dataset=train_data,
+                batch_size=args.batch_size,
+                shuffle=False,
+                drop_last=False,
+                generator=torch_g,
+            )
 
-        local_train_dataset_loader = data.DataLoader(
-            dataset=train_dataset_splits[task_name],
-            batch_size=args.batch_size,
-            shuffle=True,
-            drop_last=False,
-            generator=torch_g,
-        )
+            local_train_dataset_loader = data.DataLoader(
+                dataset=train_data,
+                batch_size=args.batch_size,
+                shuffle=True,
+                drop_last=False,
+                generator=torch_g,
+            )
 
         local_train_loaders.append(local_train_dataset_loader)
         global_train_loaders.append(global_train_dataset_loader)
-        val_data = (
-            val_dataset_splits[task_name]
-            if args.score_on_val
-            else train_dataset_splits[task_name]
-        )
+        if not args.score_on_val:
+            val_data = train_data
+        elif sharded:
+            val_data = stream_split(val_dataset_splits[task_name])
+        else:
+            val_data = FlatIndexDataset(val_dataset_splits[task_name])
+        if isinstance(getattr(val_data, "dataset", None), FastCelebA) and (
+            val_data.dataset.flip
+        ):
+            # CelebA splits are scored on training images, without random flips
+            # so that reference statistics are deterministic
+            val_data = copy.copy(val_data)
+            val_data.dataset = val_data.dataset.with_flip(False)
         val_loader = data.DataLoader(
             dataset=val_data,
             batch_size=args.val_batch_size,
@@ -195,14 +246,9 @@ def run(args):
     if not args.skip_validation:
         stats_file_name = f"seed_{args.seed}_batches_{args.num_batches}_labels_{labels_tasks_str}_val_{args.score_on_val}_random_{args.random_split}_shuffle_{args.random_shuffle}_dirichlet_{args.dirichlet}_limit_{args.limit_data}_reverse_{args.reverse}_class_cond_{args.class_cond}"
 
-        print("Removing previous stats files: ")
-        for f in glob(
-            os.path.join(
-                "results", "orig_stats", f"{args.dataset}_{stats_file_name}*.npy"
-            )
-        ):
-            print(f)
-            os.remove(f)
+        feature_store = FeatureStore(
+            args.feature_store_dir, max_size_gb=args.feature_store_size_gb
+        )
 
         if args.dataset.lower() != "cern":
             validator = Validator(
@@ -212,10 +258,16 @@ def run(args):
                 stats_file_name=stats_file_name,
                 score_model_device=args.score_model_device,
                 dataloaders=val_loaders,
+                feature_store=feature_store,
+                fid_backend=args.fid_backend,
+                prd_backend=args.prd_backend,
             )
         else:
             validator = CERN_Validator(
-                dataloaders=val_loaders, stats_file_name=stats_file_name, device=device
+                dataloaders=val_loaders,
+                stats_file_name=stats_file_name,
+                device=device,
+                feature_store=feature_store,
             )
 
     curr_global_generator = None
@@ -265,7 +317,25 @@ def run(args):
                 class_cond=args.class_cond,
                 class_table=class_table,
                 num_classes=num_classes,
+                class_histogram=getattr(
+                    train_dataset_splits[task_id], "class_histogram", None
+                ),
                 only_generations=args.only_generations,
+                replay_pool_size=args.replay_pool_size,
+                replay_pool_refresh=args.replay_pool_refresh,
+                replay_pool_dir=args.replay_pool_dir,
+                noise_optim_batch_size=args.noise_optim_batch_size,
+                noise_cache_dir=args.noise_cache_dir,
+                noise_optim_tolerance=args.noise_optim_tolerance,
+                noise_optim_patience=args.noise_optim_patience,
+                noise_optim_min_delta=args.noise_optim_min_delta,
+                encoder_iterations=args.encoder_iterations,
+                encoder_lr=args.encoder_lr,
+                metrics_flush_every=args.metrics_flush_every,
+                anomaly_check_every=args.anomaly_check_every,
+                precision=args.precision,
+                gp_every=args.gp_every,
+                gp_batch_fraction=args.gp_batch_fraction,
             )
         else:
             print("Wrong training procedure")
@@ -337,24 +407,23 @@ def run(args):
                     )
                     print(f"Generated classes: {Counter(generated_classes)}")
 
+            # Evaluate global generator on all learned tasks with shared generations
+            global_results = validator.calculate_results_all_tasks(
+                curr_global_generator=curr_global_generator,
+                task_ids=list(range(task_id + 1)),
+                calculate_class_dist=args.dataset.lower() == "mnist",
+                batch_size=args.val_batch_size,
+                class_cond=args.class_cond,
+                num_gen_images=args.num_gen_images,
+            )
             for j in range(task_id + 1):
                 val_name = task_names[j]
                 print("validation split name:", val_name)
-                (
-                    fid_result,
-                    precision,
-                    recall,
-                    generated_classes,
-                ) = validator.calculate_results(
-                    curr_global_generator=curr_global_generator,
-                    task_id=j,
-                    calculate_class_dist=args.dataset.lower() == "mnist",
-                    batch_size=args.val_batch_size,
-                    class_cond=args.class_cond,
-                )
+                fid_result = global_results[j]["fid"]
+                generated_classes = global_results[j]["generated_classes"]
                 fid_table[j][task_name] = fid_result
-                precision_table[j][task_name] = precision
-                recall_table[j][task_name] = recall
+                precision_table[j][task_name] = global_results[j]["precision"]
+                recall_table[j][task_name] = global_results[j]["recall"]
                 print(f"FID task {j}: {fid_result}")
 
                 wandb.log({f"global_gan_FID/task_{j}": fid_result})
@@ -368,47 +437,11 @@ def run(args):
                     )
                     print(f"Generated classes: {Counter(generated_classes)}")
 
-                if args.class_cond:
-                    n_classes_per_task = num_classes // num_batches
-                    classes_to_generate = [
-                        c for c in range(j * 2, (j * 2) + n_classes_per_task)
-                    ]
-                    task_ids = torch.cat(
-                        [
-                            (
-                                torch.zeros(
-                                    [
-                                        max(
-                                            args.num_gen_images
-                                            // len(classes_to_generate),
-                                            1,
-                                        )
-                                    ]
-                                )
-                                + c
-                            )
-                            for c in classes_to_generate
-                        ]
-                    ).to(curr_global_generator.device)
-                    generations = curr_global_generator(
-                        torch.randn(len(task_ids), curr_global_generator.latent_dim).to(
-                            curr_global_generator.device
-                        ),
-                        task_ids,
-                    )
-                else:
-                    generations = curr_global_generator(
-                        torch.randn(
-                            args.num_gen_images, curr_global_generator.latent_dim
-                        ).to(curr_global_generator.device),
-                        (torch.zeros([args.num_gen_images]) + j).to(
-                            curr_global_generator.device
-                        ),
-                    )
-
                 wandb.log(
                     {
-                        f"final_generations/task_{j}": wandb.Image(generations),
+                        f"final_generations/task_{j}": wandb.Image(
+                            global_results[j]["generations"]
+                        ),
                     }
                 )
 
@@ -560,6 +593,19 @@ def get_args(argv):
     parser.add_argument(
         "--workers", type=int, default=0, help="Number of threads for dataloader"
     )
+    parser.add_argument(
+        "--split_manifest_dir",
+        type=str,
+        default=None,
+        help="Directory of saved task splits, shuffles and class histograms reused between runs, None -> compute splits every run",
+    )
+    parser.add_argument(
+        "--tensor_loader",
+        type=str,
+        default="off",
+        choices=["off", "device", "pinned"],
+        help="Keep train task splits as tensors on the training device or in pinned host memory instead of using DataLoader",
+    )
     parser.add_argument("--skip_validation", default=False, action="store_true")
     parser.add_argument(
         "--score_model_device",
@@ -568,6 +614,32 @@ def get_args(argv):
         help="Device to score model on",
         choices=["cpu", "gpu"],
     )
+    parser.add_argument(
+        "--feature_store_dir",
+        default=os.path.join("results", "orig_stats"),
+        type=str,
+        help="Directory of reference features shared between runs",
+    )
+    parser.add_argument(
+        "--feature_store_size_gb",
+        default=20.0,
+        type=float,
+        help="Size of reference feature store above which least recently used entries are removed",
+    )
+    parser.add_argument(
+        "--fid_backend",
+        default="numpy",
+        type=str,
+        help="Backend used to compute FID",
+        choices=["numpy", "torch"],
+    )
+    parser.add_argument(
+        "--prd_backend",
+        default="sklearn",
+        type=str,
+        help="Backend used for k-means clustering in precision and recall",
+        choices=["sklearn", "torch"],
+    )
     parser.add_argument(
         "--training_procedure",
         type=str,
@@ -592,6 +664,43 @@ def get_args(argv):
         default=1000,
         help="Number of epochs to optimize noise in global training",
     )
+    parser.add_argument(
+        "--noise_optim_batch_size",
+        type=int,
+        default=2048,
+        help="Number of examples optimized together during noise optimization, 0 -> whole task at once",
+    )
+    parser.add_argument(
+        "--noise_cache_dir",
+        type=str,
+        default=None,
+        help="Directory to cache optimized noise of each task between runs, if not set noise is not cached",
+    )
+    parser.add_argument(
+        "--noise_optim_tolerance",
+        type=float,
+        default=0.0,
+        help="Stop optimizing noise of an example when its reconstruction loss is below this value",
+    )
+    parser.add_argument(
+        "--noise_optim_patience",
+        type=int,
+        default=0,
+        help="Stop optimizing noise of an example that did not improve for this number of iterations, 0 -> never",
+    )
+    parser.add_argument(
+        "--noise_optim_min_delta",
+        type=float,
+        default=1e-3,
+        help="Minimal relative improvement of reconstruction loss counted by --noise_optim_patience",
+    )
+    parser.add_argument(
+        "--encoder_iterations",
+        type=int,
+        default=0,
+        help="Number of iterations to train encoder initializing noise optimization, 0 -> start from random noise",
+    )
+    parser.add_argument("--encoder_lr", type=float, default=0.001)
     parser.add_argument("--local_dis_lr", type=float, default=0.0002)
     parser.add_argument("--local_gen_lr", type=float, default=0.0002)
     parser.add_argument("--global_gen_lr", type=float, default=0.001)
@@ -611,12 +720,42 @@ def get_args(argv):
         help="Train the generator every n_critic steps",
     )
     parser.add_argument("--lambda_gp", type=int, default=10)
+    parser.add_argument(
+        "--gp_every",
+        type=int,
+        default=1,
+        help="Compute the gradient penalty every gp_every critic steps, with its weight multiplied by gp_every",
+    )
+    parser.add_argument(
+        "--gp_batch_fraction",
+        type=float,
+        default=1.0,
+        help="Fraction of the batch on which the gradient penalty is computed",
+    )
     parser.add_argument(
         "--limit_previous",
         default=0.5,
         type=float,
         help="How much of previous data we want to generate each epoch",
     )
+    parser.add_argument(
+        "--replay_pool_size",
+        default=0,
+        type=int,
+        help="Number of replays of previous tasks sampled once per task in global training, 0 -> generate replays every batch",
+    )
+    parser.add_argument(
+        "--replay_pool_refresh",
+        default=0,
+        type=int,
+        help="Resample replay pool every n global epochs, 0 -> never",
+    )
+    parser.add_argument(
+        "--replay_pool_dir",
+        default=None,
+        type=str,
+        help="Directory for memory-mapped replay pool, if not set pool is kept on device",
+    )
     parser.add_argument(
         "--d_n_features",
         type=int,
@@ -664,6 +803,30 @@ def get_args(argv):
         type=int,
         help="Number of epochs for global warmup - only translator training",
     )
+    parser.add_argument(
+        "--metrics_flush_every",
+        type=int,
+        default=100,
+        help="Number of local training steps whose metrics are copied from the device and logged together",
+    )
+    parser.add_argument(
+        "--anomaly_check_every",
+        type=int,
+        default=0,
+        help="Check losses and gradients for non-finite values every this number of steps and rerun a failing step under autograd anomaly detection, 0 -> off",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=["fp32", "bf16", "fp16"],
+        help="Precision of training: fp32, bf16 autocast or fp16 autocast with gradient scaling",
+    )
+    parser.add_argument(
+        "--batch_augment",
+        action="store_true",
+        help="Flowers only: decode images once at a fixed size and augment them in batches, with random crops limited to the central square",
+    )
     parser.add_argument("--wandb_project", type=str, default="MultibandGAN")
     parser.add_argument(
         "--class_cond",
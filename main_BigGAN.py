@@ -12,7 +12,6 @@ import copy
 import os
 import random
 import sys
-from glob import glob
 from collections import OrderedDict, Counter
 import numpy as np
 import torch
@@ -22,6 +21,7 @@ import continual_benchmark.dataloaders as dataloaders
 import continual_benchmark.dataloaders.base
 from continual_benchmark.dataloaders.datasetGen import data_split
 from gan_experiments import models_definition, gan_utils, multiband_training, BigGAN
+from gan_experiments.feature_store import FeatureStore
 from gan_experiments.validation import Validator, CERN_Validator
 from visualise import *
 from utils import count_parameters
@@ -56,7 +56,7 @@ def run(args):
     for task_name, task in train_dataset_splits.items():
         labels_tasks[int(task_name)] = task.dataset.class_list
 
-    if hasattr(train_dataset.dataset, "classes"):
+    if hasattr(getattr(train_dataset, "dataset", None), "classes"):
         try:
             tasks_num_classes_dict = {
                 task_id: [train_dataset.dataset.classes[i] for i in class_idxs]
@@ -173,14 +173,9 @@ def run(args):
     if not args.skip_validation:
         stats_file_name = f"seed_{args.seed}_batches_{args.num_batches}_labels_{labels_tasks_str}_random_{args.random_split}_shuffle_{args.random_shuffle}_dirichlet_{args.dirichlet}_limit_{args.limit_data}_reverse_{args.reverse}_class_cond_{args.class_cond}"
 
-        print("Removing previous stats files: ")
-        for f in glob(
-            os.path.join(
-                "results", "orig_stats", f"{args.dataset}_{stats_file_name}*.npy"
-            )
-        ):
-            print(f)
-            os.remove(f)
+        feature_store = FeatureStore(
+            args.feature_store_dir, max_size_gb=args.feature_store_size_gb
+        )
 
         if args.dataset.lower() != "cern":
             validator = Validator(
@@ -190,10 +185,14 @@ def run(args):
                 stats_file_name=stats_file_name,
                 score_model_device=args.score_model_device,
                 dataloaders=val_loaders,
+                feature_store=feature_store,
             )
         else:
             validator = CERN_Validator(
-                dataloaders=val_loaders, stats_file_name=stats_file_name, device=device
+                dataloaders=val_loaders,
+                stats_file_name=stats_file_name,
+                device=device,
+                feature_store=feature_store,
             )
 
     curr_global_generator = None
@@ -280,6 +279,9 @@ def run(args):
                 class_cond=args.class_cond,
                 class_table=class_table,
                 num_classes=num_classes,
+                metrics_flush_every=args.metrics_flush_every,
+                anomaly_check_every=args.anomaly_check_every,
+                precision=args.precision,
             )
         else:
             print("Wrong training procedure")
@@ -573,6 +575,18 @@ def get_args(argv):
         help="Device to score model on",
         choices=["cpu", "gpu"],
     )
+    parser.add_argument(
+        "--feature_store_dir",
+        default=os.path.join("results", "orig_stats"),
+        type=str,
+        help="Directory of reference features shared between runs",
+    )
+    parser.add_argument(
+        "--feature_store_size_gb",
+        default=20.0,
+        type=float,
+        help="Size of reference feature store above which least recently used entries are removed",
+    )
     parser.add_argument(
         "--training_procedure",
         type=str,
@@ -669,6 +683,25 @@ def get_args(argv):
         type=int,
         help="Number of epochs for global warmup - only translator training",
     )
+    parser.add_argument(
+        "--metrics_flush_every",
+        type=int,
+        default=100,
+        help="Number of local training steps whose metrics are copied from the device and logged together",
+    )
+    parser.add_argument(
+        "--anomaly_check_every",
+        type=int,
+        default=0,
+        help="Check losses and gradients for non-finite values every this number of steps and rerun a failing step under autograd anomaly detection, 0 -> off",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=["fp32", "bf16", "fp16"],
+        help="Precision of training: fp32, bf16 autocast or fp16 autocast with gradient scaling",
+    )
     parser.add_argument("--wandb_project", type=str, default="MultibandGAN")
     parser.add_argument(
         "--class_cond",
@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+import torch
+
+# Modules of the repository are imported from its root, as in main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def make_models():
+    """Factory of small seeded generators and critics of the multiband GAN"""
+    from gan_experiments import models_definition
+
+    def make(img_shape, num_embeddings=0):
+        torch.manual_seed(0)
+        translator = models_definition.Translator(
+            latent_size=16, device="cpu", num_embeddings=3, embedding_dim=3
+        )
+        generator = models_definition.Generator(
+            latent_dim=16,
+            img_shape=img_shape,
+            device="cpu",
+            translator=translator,
+            num_features=8,
+        )
+        discriminator = models_definition.Discriminator(
+            img_shape=img_shape,
+            device="cpu",
+            num_features=8,
+            num_embeddings=num_embeddings,
+            embedding_dim=num_embeddings,
+        )
+        return generator, discriminator
+
+    return make
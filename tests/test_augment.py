@@ -0,0 +1,87 @@
+import pytest
+import torch
+from torchvision import transforms
+from torchvision.transforms import InterpolationMode
+from torchvision.transforms import functional as TF
+
+from continual_benchmark.dataloaders.augment import BatchAugment
+
+TO_FLOAT = transforms.ConvertImageDtype(torch.float)
+
+
+def uint8_images(n=8, channels=3, size=28):
+    generator = torch.Generator().manual_seed(0)
+    return torch.randint(
+        0, 256, (n, channels, size, size), dtype=torch.uint8, generator=generator
+    )
+
+
+def test_deterministic_steps_match_torchvision():
+    imgs = uint8_images()
+    steps = [TO_FLOAT, transforms.Normalize((0.5, 0.4, 0.3), (0.2, 0.3, 0.4))]
+    expected = torch.stack([transforms.Compose(steps)(img) for img in imgs])
+    torch.testing.assert_close(BatchAugment(steps)(imgs), expected)
+
+
+@pytest.mark.parametrize(
+    "interpolation", [InterpolationMode.NEAREST, InterpolationMode.BILINEAR]
+)
+@pytest.mark.parametrize("angle", [30, -90])
+def test_rotation_matches_torchvision(interpolation, angle):
+    imgs = uint8_images()
+    step = transforms.RandomRotation((angle, angle), interpolation=interpolation)
+    expected = TF.rotate(TO_FLOAT(imgs), angle, interpolation=interpolation)
+    torch.testing.assert_close(
+        BatchAugment([TO_FLOAT, step])(imgs), expected, rtol=0, atol=1e-5
+    )
+
+
+def test_crop_matches_torchvision_at_drawn_positions(monkeypatch):
+    imgs = uint8_images(n=4)
+    draws = torch.tensor([0.0, 0.3, 0.6, 0.99])
+    monkeypatch.setattr(BatchAugment, "_rand", lambda self, n, device: draws)
+    result = BatchAugment([TO_FLOAT, transforms.RandomCrop(24, padding=4)])(imgs)
+
+    # Offsets in [0, 36 - 24], the same for rows and columns
+    offsets = (draws * 13).long().tolist()
+    padded = TF.pad(TO_FLOAT(imgs), 4)
+    expected = torch.stack(
+        [TF.crop(img, offset, offset, 24, 24) for img, offset in zip(padded, offsets)]
+    )
+    torch.testing.assert_close(result, expected, rtol=0, atol=0)
+
+
+def test_flip_matches_torchvision_for_drawn_images(monkeypatch):
+    imgs = uint8_images(n=4)
+    draws = torch.tensor([0.1, 0.7, 0.4, 0.9])
+    monkeypatch.setattr(BatchAugment, "_rand", lambda self, n, device: draws)
+    result = BatchAugment([TO_FLOAT, transforms.RandomHorizontalFlip(p=0.5)])(imgs)
+
+    expected = [
+        TF.hflip(img) if draw < 0.5 else img for img, draw in zip(TO_FLOAT(imgs), draws)
+    ]
+    torch.testing.assert_close(result, torch.stack(expected), rtol=0, atol=0)
+
+
+def test_random_parameters_are_reproducible_with_seed():
+    imgs = uint8_images()
+    steps = [
+        TO_FLOAT,
+        transforms.RandomRotation(30),
+        transforms.RandomCrop(28, padding=4),
+        transforms.RandomHorizontalFlip(),
+    ]
+    torch.testing.assert_close(
+        BatchAugment(steps, seed=1)(imgs), BatchAugment(steps, seed=1)(imgs)
+    )
+    assert not torch.equal(
+        BatchAugment(steps, seed=1)(imgs), BatchAugment(steps, seed=2)(imgs)
+    )
+
+
+def test_unsupported_steps():
+    assert BatchAugment.supports([TO_FLOAT, transforms.RandomCrop(24, padding=4)])
+    assert not BatchAugment.supports(
+        [transforms.RandomCrop(24, padding=4, padding_mode="reflect")]
+    )
+    assert not BatchAugment.supports([transforms.ColorJitter(0.5)])
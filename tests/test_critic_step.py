@@ -0,0 +1,127 @@
+import pytest
+import torch
+import torch.utils.data as data
+import wandb
+
+from gan_experiments import gan_utils, training_functions
+
+IMG_SHAPE = (1, 28, 28)
+NUM_GEN_IMAGES = 4
+LAMBDA_GP = 10
+
+
+def make_loader(class_cond):
+    torch.manual_seed(1)
+    images = torch.rand(8, *IMG_SHAPE) * 2 - 1
+    labels = torch.randint(0, 3, [8]) if class_cond else torch.zeros(8).long()
+    return data.DataLoader(data.TensorDataset(images, labels), batch_size=8)
+
+
+def training_step(monkeypatch, models, loader, class_cond, gp_batch_fraction):
+    """Losses and gradients of one step of train_local_wgan_gp"""
+    generator, discriminator = models
+    monkeypatch.setattr(wandb, "log", lambda metrics: None)
+    monkeypatch.setattr(wandb, "Image", lambda images: None)
+    losses = []
+    gradients = []
+    run = gan_utils.AnomalyMonitor.run
+
+    def recorded_run(self, *args, **kwargs):
+        step_losses = run(self, *args, **kwargs)
+        losses.append([loss.detach() for loss in step_losses])
+        return step_losses
+
+    def recorded_step(self, *args, **kwargs):
+        # Gradients of the critic step, then of the generator step. Weights
+        # are not updated
+        gradients.append(
+            [p.grad.clone() for group in self.param_groups for p in group["params"]]
+        )
+
+    monkeypatch.setattr(gan_utils.AnomalyMonitor, "run", recorded_run)
+    monkeypatch.setattr(torch.optim.Adam, "step", recorded_step)
+    torch.manual_seed(2)
+    training_functions.train_local(
+        generator,
+        discriminator,
+        n_epochs=1,
+        task_loader=loader,
+        task_id=0,
+        local_dis_lr=1e-4,
+        local_gen_lr=1e-4,
+        num_gen_images=NUM_GEN_IMAGES,
+        local_scheduler_rate=0.99,
+        n_critic_steps=1,
+        lambda_gp=LAMBDA_GP,
+        b1=0.5,
+        b2=0.999,
+        class_cond=class_cond,
+        num_classes=3,
+        gp_batch_fraction=gp_batch_fraction,
+    )
+    (d_loss, d_loss_fake, d_loss_real, _, _), (g_loss,) = losses
+    return [d_loss, d_loss_fake, d_loss_real, g_loss], gradients
+
+
+def baseline_step(models, loader, class_cond, gp_batch_fraction):
+    """The same step with separate critic passes over real and fake images"""
+    generator, discriminator = models
+    generator.train()
+    discriminator.train()
+    # Random numbers drawn in the same order as by train_local_wgan_gp
+    torch.manual_seed(2)
+    torch.randn(NUM_GEN_IMAGES, generator.latent_dim)
+    real_imgs, labels = next(iter(loader))
+    task_ids = labels.float() if class_cond else torch.zeros(len(real_imgs))
+    z = torch.randn(len(real_imgs), generator.latent_dim)
+    critic_ids = task_ids if class_cond else None
+
+    fake_imgs = generator(z, task_ids).detach()
+    d_loss_real = -torch.mean(discriminator(real_imgs, critic_ids))
+    d_loss_fake = torch.mean(discriminator(fake_imgs, critic_ids))
+    n_gp = max(1, round(gp_batch_fraction * len(real_imgs)))
+    gradient_penalty = gan_utils.compute_gradient_penalty(
+        discriminator,
+        real_imgs[:n_gp],
+        fake_imgs[:n_gp],
+        "cpu",
+        task_ids=critic_ids[:n_gp] if class_cond else None,
+    )
+    d_loss = d_loss_fake + d_loss_real + LAMBDA_GP * gradient_penalty
+    discriminator.zero_grad()
+    d_loss.backward()
+    critic_gradients = [p.grad.clone() for p in discriminator.parameters()]
+
+    generator.zero_grad()
+    g_loss = -torch.mean(discriminator(generator(z, task_ids), critic_ids))
+    g_loss.backward()
+    generator_gradients = [p.grad.clone() for p in generator.parameters()]
+    losses = [d_loss, d_loss_fake, d_loss_real, g_loss]
+    return [loss.detach() for loss in losses], [critic_gradients, generator_gradients]
+
+
+@pytest.mark.parametrize("class_cond", [False, True])
+@pytest.mark.parametrize("gp_batch_fraction", [1.0, 0.5])
+def test_fused_critic_step_matches_separate_passes(
+    monkeypatch, make_models, class_cond, gp_batch_fraction
+):
+    num_embeddings = 3 if class_cond else 0
+    loader = make_loader(class_cond)
+    expected_losses, expected_gradients = baseline_step(
+        make_models(IMG_SHAPE, num_embeddings), loader, class_cond, gp_batch_fraction
+    )
+    losses, gradients = training_step(
+        monkeypatch,
+        make_models(IMG_SHAPE, num_embeddings),
+        loader,
+        class_cond,
+        gp_batch_fraction,
+    )
+
+    for loss, expected in zip(losses, expected_losses):
+        torch.testing.assert_close(loss, expected, rtol=1e-5, atol=1e-6)
+    assert len(gradients) == 2
+    for step_gradients, step_expected in zip(gradients, expected_gradients):
+        assert len(step_gradients) == len(step_expected)
+        for gradient, expected in zip(step_gradients, step_expected):
+            torch.testing.assert_close(gradient, expected, rtol=1e-4, atol=1e-6)
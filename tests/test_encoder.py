@@ -0,0 +1,29 @@
+import torch
+
+from gan_experiments import models_definition, training_functions
+
+
+def test_encoder_mirrors_the_translator_embedding():
+    torch.manual_seed(0)
+    translator = models_definition.Translator(
+        latent_size=16, device="cpu", num_embeddings=3, embedding_dim=5
+    )
+    generator = models_definition.Generator(
+        latent_dim=16,
+        img_shape=(1, 28, 28),
+        device="cpu",
+        translator=translator,
+        num_features=8,
+    )
+    encoder = training_functions.train_encoder(
+        generator, task_id=2, n_iterations=2, lr=1e-3, batch_size=8, num_features=8
+    )
+
+    assert encoder.task_embedding.num_embeddings == 3
+    assert encoder.task_embedding.embedding_dim == 5
+    assert encoder.fc[0].in_features == 8 * 4 + 5
+    with torch.no_grad():
+        z = encoder(
+            generator(torch.randn(4, 16), torch.full([4], 2.0)), torch.full([4], 2.0)
+        )
+    assert z.shape == (4, 16)
@@ -0,0 +1,33 @@
+import numpy as np
+
+from gan_experiments.feature_statistics import RunningStatistics
+
+
+def test_running_statistics_match_statistics_of_all_features():
+    rng = np.random.default_rng(0)
+    features = rng.normal(size=(1000, 8)) * rng.uniform(1, 100, size=8) + 50
+    features = features.astype(np.float32)
+    stats = RunningStatistics(8)
+    # Batches of uneven sizes, a single row and an empty batch
+    for start, end in [(0, 1), (1, 1), (1, 300), (300, 301), (301, 1000)]:
+        stats.update(features[start:end])
+
+    # Statistics of all features at once, accumulated in float64
+    features = features.astype(np.float64)
+    assert stats.n == 1000
+    np.testing.assert_allclose(stats.mu, np.mean(features, axis=0), rtol=1e-10)
+    np.testing.assert_allclose(
+        stats.sigma, np.cov(features, rowvar=False), rtol=1e-8, atol=1e-8
+    )
+
+
+def test_running_statistics_continue_from_moments():
+    rng = np.random.default_rng(1)
+    features = rng.normal(size=(500, 4))
+    stats = RunningStatistics(4)
+    stats.update(features[:200])
+    stats = RunningStatistics.from_moments(stats.mu, stats.sigma, stats.n)
+    stats.update(features[200:])
+
+    np.testing.assert_allclose(stats.mu, features.mean(axis=0), rtol=1e-10)
+    np.testing.assert_allclose(stats.sigma, np.cov(features, rowvar=False), rtol=1e-10)
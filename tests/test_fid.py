@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from gan_experiments.fid import (
+    FrechetDistanceEngine,
+    calculate_frechet_distance_from_moments,
+)
+
+
+def random_moments(rng, dims=32, n=200):
+    features = rng.normal(size=(n, dims)).dot(rng.normal(size=(dims, dims)))
+    features += rng.normal(size=dims)
+    return features.mean(axis=0), np.cov(features, rowvar=False)
+
+
+@pytest.mark.parametrize("backend", ["numpy", "torch"])
+def test_engine_matches_sqrtm_implementation(backend):
+    rng = np.random.default_rng(0)
+    references = [random_moments(rng) for _ in range(3)]
+    generated = [random_moments(rng) for _ in range(3)]
+    engine = FrechetDistanceEngine(backend=backend)
+    for key, (mu, sigma) in enumerate(references):
+        engine.add_reference(key, mu, sigma)
+
+    expected = [
+        calculate_frechet_distance_from_moments(mu, sigma, mu_ref, sigma_ref)
+        for (mu, sigma), (mu_ref, sigma_ref) in zip(generated, references)
+    ]
+    distances = engine.distances(
+        [0, 1, 2], [mu for mu, _ in generated], [sigma for _, sigma in generated]
+    )
+    np.testing.assert_allclose(distances, expected, rtol=1e-8)
+    assert engine.distance(1, *generated[1]) == pytest.approx(expected[1], rel=1e-8)
+
+
+def test_engine_distance_of_reference_to_itself_is_zero():
+    rng = np.random.default_rng(1)
+    mu, sigma = random_moments(rng, dims=16, n=1000)
+    engine = FrechetDistanceEngine()
+    engine.add_reference("reference", mu, sigma)
+    # Same reference added again is not factorized again
+    engine.add_reference("reference", mu + 1, sigma)
+    assert engine.distance("reference", mu, sigma) == pytest.approx(0, abs=1e-8)
@@ -0,0 +1,75 @@
+import pytest
+import torch
+import torch.utils.data as data
+import wandb
+
+from gan_experiments import training_functions
+
+IMG_SHAPE = (1, 28, 28)
+
+
+def train_and_log(monkeypatch, make_models, **kwargs):
+    logged = []
+    monkeypatch.setattr(wandb, "log", logged.append)
+    monkeypatch.setattr(wandb, "Image", lambda images: None)
+    generator, discriminator = make_models(IMG_SHAPE)
+    torch.manual_seed(3)
+    dataset = data.TensorDataset(
+        torch.rand(64, *IMG_SHAPE) * 2 - 1, torch.zeros(64, dtype=torch.long)
+    )
+    training_functions.train_local(
+        generator,
+        discriminator,
+        n_epochs=2,
+        task_loader=data.DataLoader(dataset, batch_size=16),
+        task_id=0,
+        local_dis_lr=1e-4,
+        local_gen_lr=1e-4,
+        num_gen_images=4,
+        local_scheduler_rate=0.99,
+        n_critic_steps=2,
+        lambda_gp=10,
+        b1=0.5,
+        b2=0.999,
+        num_classes=1,
+        **kwargs
+    )
+    return [record for record in logged if "local_d_loss/task_0" in record]
+
+
+@pytest.mark.parametrize("gp_every", [1, 3])
+def test_lazy_gradient_penalty_schedule(monkeypatch, make_models, gp_every):
+    records = train_and_log(monkeypatch, make_models, gp_every=gp_every)
+    # Critic steps are counted across both epochs of 4 batches
+    assert len(records) == 8
+    for step, record in enumerate(records):
+        regularized = step % gp_every == 0
+        assert ("local_gradient_penalty/task_0" in record) == regularized
+        adversarial_loss = (
+            record["local_d_loss_fake/task_0"] + record["local_d_loss_real/task_0"]
+        )
+        penalty = (
+            10 * gp_every * record["local_gradient_penalty/task_0"]
+            if regularized
+            else 0
+        )
+        # Logged values are rounded to 3 decimals
+        assert record["local_d_loss/task_0"] == pytest.approx(
+            adversarial_loss + penalty, abs=0.002 + 0.0005 * 10 * gp_every
+        )
+
+
+def test_default_schedule_is_the_full_gradient_penalty(monkeypatch, make_models):
+    default = train_and_log(monkeypatch, make_models)
+    explicit = train_and_log(
+        monkeypatch, make_models, gp_every=1, gp_batch_fraction=1.0
+    )
+    assert default == explicit
+
+
+@pytest.mark.parametrize(
+    "kwargs", [{"gp_every": 0}, {"gp_batch_fraction": 0}, {"gp_batch_fraction": 1.5}]
+)
+def test_invalid_lazy_gradient_penalty_settings(monkeypatch, make_models, kwargs):
+    with pytest.raises(ValueError):
+        train_and_log(monkeypatch, make_models, **kwargs)
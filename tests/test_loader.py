@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import torch
+import torchvision
+from torchvision import transforms
+
+from continual_benchmark.dataloaders.base import FastCelebA
+from continual_benchmark.dataloaders.datasetGen import data_split
+from continual_benchmark.dataloaders.loader import TensorLoader
+from continual_benchmark.dataloaders.wrapper import FlatIndexDataset
+
+
+@pytest.fixture
+def celeba(tmp_path):
+    rng = np.random.default_rng(0)
+    images = rng.integers(0, 256, size=(32, 3, 8, 8), dtype=np.uint8)
+    np.save(tmp_path / "images.npy", images)
+    np.save(tmp_path / "attr.npy", rng.integers(0, 2, size=(32, 40)))
+    return FastCelebA(str(tmp_path), normalize=False), torch.from_numpy(images)
+
+
+def test_batch_transform_is_applied_to_every_batch(celeba):
+    dataset, images = celeba
+    loader = TensorLoader(dataset, batch_size=8)
+    assert loader.tensors[0].dtype == torch.uint8
+
+    epochs = [torch.cat([batch[0] for batch in loader]) for _ in range(2)]
+    expected = images.float() / 255
+    for epoch in epochs:
+        # Every image is the decoded one, flipped or not
+        flipped = (epoch == expected.flip(-1)).flatten(1).all(1)
+        assert torch.all(flipped | (epoch == expected).flatten(1).all(1))
+    assert not torch.equal(epochs[0], epochs[1])
+
+
+def test_without_random_transform_batches_match_dataset(celeba):
+    dataset, images = celeba
+    loader = TensorLoader(dataset.with_flip(False), batch_size=8)
+    torch.testing.assert_close(
+        torch.cat([batch[0] for batch in loader]), images.float() / 255
+    )
+
+
+def test_without_flip_keeps_labels_of_data_split(celeba):
+    dataset, _ = celeba
+    _, val_splits, _ = data_split(
+        dataset, "celeba", num_batches=5, num_classes=10, generator=torch.Generator()
+    )
+    for split in val_splits.values():
+        val_data = FlatIndexDataset(split)
+        unflipped = val_data.dataset.with_flip(False)
+        assert not unflipped.flip
+        for index in val_data.indices.tolist():
+            label = unflipped[index][1]
+            assert label.shape == (1,)
+            assert torch.equal(label, val_data.dataset[index][1])
+
+
+def test_random_transform_without_batch_version_is_refused():
+    dataset = torchvision.datasets.FakeData(
+        size=8,
+        image_size=(3, 8, 8),
+        transform=transforms.Compose(
+            [transforms.RandomHorizontalFlip(), transforms.ToTensor()]
+        ),
+    )
+    with pytest.raises(ValueError):
+        TensorLoader(dataset, batch_size=4)
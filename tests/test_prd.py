@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import torch
+
+from gan_experiments import prd
+
+
+def clustered_data(rng, weights, n=400, dims=8):
+    """Points around well separated centers, with given fractions per center"""
+    centers = np.eye(len(weights), dims) * 100
+    labels = rng.choice(len(weights), size=n, p=weights)
+    return (centers[labels] + rng.normal(size=(n, dims))).astype(np.float32)
+
+
+@pytest.mark.parametrize("minibatch_size", [128, None])
+def test_torch_prd_matches_sklearn_on_separated_clusters(minibatch_size):
+    rng = np.random.default_rng(0)
+    eval_data = clustered_data(rng, [0.4, 0.4, 0.1, 0.1])
+    ref_data = clustered_data(rng, [0.25, 0.25, 0.25, 0.25])
+    np.random.seed(0)
+    torch.manual_seed(0)
+
+    expected = prd.compute_prd_from_embedding(
+        eval_data, ref_data, num_clusters=4, num_runs=2
+    )
+    result = prd.compute_prd_from_embedding_torch(
+        eval_data, ref_data, num_clusters=4, num_runs=2, minibatch_size=minibatch_size
+    )
+    np.testing.assert_allclose(result, expected, atol=1e-12)
+
+
+def test_torch_prd_reads_memory_mapped_data(tmp_path):
+    rng = np.random.default_rng(1)
+    eval_data = clustered_data(rng, [0.5, 0.5, 0.0, 0.0])
+    ref_data = clustered_data(rng, [0.25, 0.25, 0.25, 0.25])
+    np.save(tmp_path / "eval.npy", eval_data)
+    torch.manual_seed(0)
+    expected = prd.compute_prd_from_embedding_torch(
+        eval_data, ref_data, num_clusters=4, num_runs=2
+    )
+    torch.manual_seed(0)
+    result = prd.compute_prd_from_embedding_torch(
+        np.load(tmp_path / "eval.npy", mmap_mode="r"),
+        ref_data,
+        num_clusters=4,
+        num_runs=2,
+    )
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_minibatch_kmeans_stops_early():
+    rng = np.random.default_rng(2)
+    data = torch.from_numpy(clustered_data(rng, [0.25, 0.25, 0.25, 0.25], n=2000))
+    fetches = []
+
+    def fetch_rows(idx):
+        fetches.append(len(idx))
+        return data[idx]
+
+    torch.manual_seed(0)
+    labels, inertia = prd._batched_kmeans(
+        fetch_rows, len(data), 4, num_fits=3, max_iter=100, minibatch_size=256
+    )
+    # k-means++ sample, minibatch updates and the final assignment
+    n_updates = len(fetches) - 2
+    assert n_updates < 100
+    assert labels.shape == (3, 2000)
+    assert torch.all(inertia < 2 * 8 * len(data))
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+from continual_benchmark.dataloaders.base import quantile_bins
+
+pd = pytest.importorskip("pandas")
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        np.random.default_rng(0).exponential(size=10001),
+        # Many ties, some of them at the edges of bins
+        np.random.default_rng(1).integers(0, 50, size=5000).astype(np.float64),
+        np.arange(100, dtype=np.float32),
+    ],
+)
+def test_quantile_bins_match_qcut(values):
+    expected = pd.qcut(values, q=10, labels=list(range(10)))
+    np.testing.assert_array_equal(quantile_bins(values, 10), np.asarray(expected))